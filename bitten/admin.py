@@ -16,7 +16,9 @@ from trac.core import *
 from trac.admin import IAdminPanelProvider
 from trac.web.chrome import add_stylesheet, add_script, add_warning, add_notice
 
+from bitten.master import invalidate_recipe
 from bitten.model import BuildConfig, TargetPlatform
+from bitten.queue import invalidate_platform_index
 from bitten.recipe import Recipe, InvalidRecipeError
 from bitten.util import xmlio
 
@@ -71,6 +73,19 @@ class BuildMasterAdminPageProvider(Component):
             self.config['bitten'].set('slave_timeout', str(slave_timeout))
             changed = True
 
+        long_poll_timeout = int(req.args.get('long_poll_timeout',
+                                             master.long_poll_timeout))
+        if long_poll_timeout != master.long_poll_timeout:
+            self.config['bitten'].set('long_poll_timeout',
+                                      str(long_poll_timeout))
+            changed = True
+
+        populate_on_poll = 'populate_on_poll' in req.args
+        if populate_on_poll != master.populate_on_poll:
+            self.config['bitten'].set('populate_on_poll',
+                                      populate_on_poll and 'yes' or 'no')
+            changed = True
+
         quick_status = 'quick_status' in req.args
         if quick_status != master.quick_status:
             self.config['bitten'].set('quick_status',
@@ -232,6 +247,7 @@ class BuildConfigurationsAdminPageProvider(Component):
             config.active = config.name in active
             config.update(db=db)
         db.commit()
+        invalidate_platform_index(self.env)
 
     def _create_config(self, req):
         req.perm.assert_permission('BUILD_CREATE')
@@ -260,11 +276,14 @@ class BuildConfigurationsAdminPageProvider(Component):
             if not config:
                 raise TracError('Configuration %r not found' % name)
             config.delete(db=db)
+            invalidate_recipe(self.env, name)
         db.commit()
+        invalidate_platform_index(self.env)
 
     def _update_config(self, req, config):
         warnings = []
         req.perm.assert_permission('BUILD_MODIFY')
+        old_name = config.name
 
         name = req.args.get('name')
         if not name:
@@ -319,6 +338,10 @@ class BuildConfigurationsAdminPageProvider(Component):
             config.update()
         else:
             config.insert()
+        invalidate_platform_index(self.env)
+        if old_name:
+            invalidate_recipe(self.env, old_name)
+        invalidate_recipe(self.env, config.name)
         return []
 
     def _create_platform(self, req, config_name):
@@ -328,8 +351,16 @@ class BuildConfigurationsAdminPageProvider(Component):
         if not name:
             raise TracError('Missing required field "name"', 'Missing field')
 
+        db = self.env.get_db_cnx()
         platform = TargetPlatform(self.env, config=config_name, name=name)
-        platform.insert()
+        platform.insert(db=db)
+        # Make sure the build queue considers the new platform for
+        # revisions it has already looked at
+        config = BuildConfig.fetch(self.env, config_name, db=db)
+        if config:
+            config.set_scanned_rev(None, db=db)
+        db.commit()
+        invalidate_platform_index(self.env)
         return platform
 
     def _remove_platforms(self, req):
@@ -347,6 +378,7 @@ class BuildConfigurationsAdminPageProvider(Component):
                 raise TracError('Target platform %r not found' % platform_id)
             platform.delete(db=db)
         db.commit()
+        invalidate_platform_index(self.env)
 
     def _update_platform(self, req, platform):
         platform.name = req.args.get('name')
@@ -366,6 +398,7 @@ class BuildConfigurationsAdminPageProvider(Component):
             platform.update()
         else:
             platform.insert()
+        invalidate_platform_index(self.env)
 
         add_rules = [int(key[9:]) for key in req.args.keys()
                      if key.startswith('add_rule_')]
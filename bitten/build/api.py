@@ -10,10 +10,14 @@
 
 """Functions and classes used to simplify the implementation recipe commands."""
 
+import errno
 import logging
 import fnmatch
 import os
+import re
+import select
 import shlex
+import signal
 import time
 import subprocess
 import sys
@@ -23,6 +27,9 @@ log = logging.getLogger('bitten.build.api')
 
 __docformat__ = 'restructuredtext en'
 
+# Number of bytes read from the output pipes of a command at a time
+_READ_SIZE = 65536
+
 
 class BuildError(Exception):
     """Exception raised when a build fails."""
@@ -84,6 +91,149 @@ class CommandLine(object):
                         should be aborted (not supported on Windows without
                         ``subprocess`` module / Python 2.4+)
         """
+        if os.name == 'nt':
+            # select() does not work with pipes on Windows
+            return self._execute_threaded(timeout)
+        return self._execute_select(timeout)
+
+    def _popen(self, args, **kwargs):
+        try:
+            return subprocess.Popen(args,
+                        stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        cwd=(self.cwd or None),
+                        shell=self.shell,
+                        env=None, **kwargs)
+        except Exception, e:
+            raise BuildError('Error executing %s: %s %s' % (args,
+                                        e.__class__.__name__, str(e)))
+
+    def _input_data(self):
+        if self.input:
+            if isinstance(self.input, basestring):
+                return self.input
+            return self.input.read()
+        return None
+
+    def _execute_select(self, timeout):
+        args = [self.executable] + self.arguments
+        # Run the command in a process group of its own, so that the
+        # processes it starts can be killed along with it
+        p = self._popen(args, preexec_fn=os.setpgrp)
+        log.debug('Executing %s, (pid = %s, timeout = %s)', args, p.pid, timeout)
+
+        in_data = self._input_data()
+        if not in_data:
+            p.stdin.close()
+        limit = timeout and timeout + time.time() or 0
+        buffers = {p.stdout.fileno(): '', p.stderr.fileno(): ''}
+        readers = buffers.keys()
+
+        def output(fd, lines):
+            for line in lines:
+                line = _decode(line.rstrip().replace('\x00', ''))
+                if fd == p.stderr.fileno():
+                    yield (None, line)
+                else:
+                    yield (line, None)
+
+        def incomplete():
+            # Incomplete lines are passed on if the output is not read up to
+            # its end
+            lines = []
+            for fd in sorted(buffers):
+                if buffers[fd]:
+                    lines.extend(output(fd, [buffers[fd]]))
+                    buffers[fd] = ''
+            return lines
+
+        def cleanup():
+            if p.returncode is None:
+                log.debug('Killing process group %s.', p.pid)
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                p.wait()
+            for pipe in (p.stdin, p.stdout, p.stderr):
+                if not pipe.closed:
+                    pipe.close()
+
+        # Python 2.4 does not allow yield in a try/finally block, so the
+        # process is cleaned up on every way out of the loop instead
+        try:
+            while readers:
+                writers = not p.stdin.closed and [p.stdin.fileno()] or []
+                # Wake up at least once a second to notice when the process
+                # exits while processes it started keep its pipes open
+                wait = 1.0
+                if limit:
+                    wait = min(wait, limit - time.time())
+                    if wait <= 0:
+                        for item in incomplete():
+                            yield item
+                        raise TimeoutError('Command %s timed out' %
+                                           self.executable)
+                try:
+                    readable, writable, _ = select.select(readers, writers,
+                                                          [], wait)
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                if writable:
+                    try:
+                        written = os.write(writable[0],
+                                           in_data[:select.PIPE_BUF])
+                        in_data = in_data[written:]
+                    except OSError, e:
+                        if e.errno != errno.EPIPE:
+                            raise
+                        in_data = None
+                    if not in_data:
+                        p.stdin.close()
+
+                for fd in readable:
+                    data = os.read(fd, _READ_SIZE)
+                    if not data:
+                        readers.remove(fd)
+                        lines = buffers[fd] and [buffers[fd]] or []
+                    else:
+                        lines = (buffers[fd] + data).splitlines(True)
+                        # Keep an incomplete line for the next read; a line
+                        # ending in '\r' may still be followed by '\n'
+                        if lines[-1].endswith('\n'):
+                            buffers[fd] = ''
+                        else:
+                            buffers[fd] = lines.pop()
+                    for item in output(fd, lines):
+                        yield item
+
+                if not readable and not writable and p.poll() is not None:
+                    # Processes started by the command still hold the pipes
+                    for item in incomplete():
+                        yield item
+                    break
+
+            # The process may have closed its output before exiting
+            while p.poll() is None:
+                if limit and limit < time.time():
+                    raise TimeoutError('Command %s timed out' %
+                                       self.executable)
+                time.sleep(.1)
+            self.returncode = p.returncode
+        except:
+            exc_info = sys.exc_info()
+            cleanup()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        cleanup()
+
+        log.debug('%s exited with code %s', self.executable,
+                  self.returncode)
+
+    def _execute_threaded(self, timeout):
         from threading import Thread
         from Queue import Queue, Empty
 
@@ -103,28 +253,12 @@ class CommandLine(object):
                 pipe.close()
 
         args = [self.executable] + self.arguments
-        try:
-            p = subprocess.Popen(args, bufsize=1, # Line buffered
-                        stdin=subprocess.PIPE,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        cwd=(self.cwd or None),
-                        shell=self.shell,
-                        universal_newlines=True,
-                        env=None)
-        except Exception, e:
-            raise BuildError('Error executing %s: %s %s' % (args,
-                                        e.__class__.__name__, str(e)))
+        p = self._popen(args, bufsize=1, # Line buffered
+                        universal_newlines=True)
 
         log.debug('Executing %s, (pid = %s, timeout = %s)', args, p.pid, timeout)
 
-        if self.input:
-            if isinstance(self.input, basestring):
-                in_data = self.input
-            else:
-                in_data = self.input.read()
-        else:
-            in_data = None
+        in_data = self._input_data()
         
         queue = Queue()
         limit = timeout and timeout + time.time() or 0
@@ -159,6 +293,104 @@ class CommandLine(object):
                   self.returncode)
 
 
+def _compile_patterns(patterns):
+    """Compile a list of shell-style patterns into a single regular expression
+    matching any of them, or return `None` if the list is empty."""
+    if not patterns:
+        return None
+    return re.compile('|'.join(['(?:%s)' % fnmatch.translate(pattern)
+                                for pattern in patterns]))
+
+
+def _prune_patterns(exclude):
+    """Return the regular expression matching the directories below which all
+    files are excluded by the given patterns.
+    
+    A pattern ending in "/*" excludes everything below any directory matching
+    the rest of the pattern, so such directories need not be walked at all.
+    """
+    return _compile_patterns([pattern[:-2] for pattern in exclude
+                              if pattern.endswith('/*')])
+
+def _walk(basedir, prune_re=None):
+    """Walk the given directory, generating the path of every subdirectory
+    relative to `basedir`, the same path with forward slashes as separators,
+    and the names of the files it contains."""
+    for dirpath, dirnames, filenames in os.walk(basedir):
+        dirpath = dirpath[len(basedir) + 1:]
+        ndirpath = dirpath
+        if os.sep != '/':
+            ndirpath = ndirpath.replace(os.sep, '/')
+        if prune_re is not None:
+            dirnames[:] = [dirname for dirname in dirnames
+                           if not prune_re.match(ndirpath and
+                                                 ndirpath + '/' + dirname
+                                                 or dirname)]
+        yield dirpath, ndirpath, filenames
+
+
+class FileIndex(object):
+    """Listing of all the files in a directory tree, which can be shared by
+    any number of `FileSet` instances instead of each walking the tree.
+    
+    The listing is created on first use. After `touch()` has been called, the
+    modification times of the directories are compared to those recorded
+    while walking the tree, and the listing is recreated if they differ.
+    """
+
+    # Modifications less than this many seconds before the tree was walked
+    # may not be reflected in the recorded modification times
+    MTIME_RESOLUTION = 2
+
+    def __init__(self, basedir):
+        """Create the index.
+        
+        :param basedir: the base directory of the tree
+        """
+        self.basedir = basedir
+        self.dirs = None
+        self.mtimes = {}
+        self.timestamp = None
+        self.modified = False
+
+    def __iter__(self):
+        """Iterate over the ``(dirpath, ndirpath, filenames)`` tuples of all
+        directories in the tree, see `_walk()`."""
+        if self.dirs is None or self.modified and self._changed():
+            self._update()
+        self.modified = False
+        return iter(self.dirs)
+
+    def touch(self):
+        """Note that files in the tree may have been added or removed."""
+        self.modified = True
+
+    def _changed(self):
+        for dirpath, mtime in self.mtimes.iteritems():
+            if mtime >= self.timestamp - self.MTIME_RESOLUTION:
+                return True
+            try:
+                if os.stat(dirpath).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def _update(self):
+        log.debug('Indexing files in %s', self.basedir)
+        self.timestamp = time.time()
+        self.dirs = []
+        self.mtimes = {}
+        prune_re = _prune_patterns(FileSet.DEFAULT_EXCLUDES)
+        for dirpath, ndirpath, filenames in _walk(self.basedir, prune_re):
+            path = os.path.join(self.basedir, dirpath)
+            try:
+                self.mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                continue
+            self.dirs.append((dirpath, ndirpath, filenames))
+
+
 class FileSet(object):
     """Utility class for collecting a list of files in a directory that match
     given name/path patterns."""
@@ -166,7 +398,7 @@ class FileSet(object):
     DEFAULT_EXCLUDES = ['CVS/*', '*/CVS/*', '.svn/*', '*/.svn/*',
                         '.DS_Store', 'Thumbs.db']
 
-    def __init__(self, basedir, include=None, exclude=None):
+    def __init__(self, basedir, include=None, exclude=None, index=None):
         """Create a file set.
         
         :param basedir: the base directory for all files in the set
@@ -174,6 +406,8 @@ class FileSet(object):
                         included in the set
         :param exclude: a list of patterns that define which files should be
                         excluded from the set
+        :param index: the `FileIndex` of the base directory to use instead of
+                      walking the directory
         """
         self.files = []
         self.basedir = basedir
@@ -186,32 +420,35 @@ class FileSet(object):
         if exclude is not None:
             self.exclude += shlex.split(exclude)
 
-        for dirpath, dirnames, filenames in os.walk(self.basedir):
-            dirpath = dirpath[len(self.basedir) + 1:]
+        include_re = _compile_patterns(self.include)
+        exclude_re = _compile_patterns(self.exclude)
+        prune_re = _prune_patterns(self.exclude)
+
+        if index is None:
+            index = _walk(self.basedir, prune_re)
+        pruned = ()
+        for dirpath, ndirpath, filenames in index:
+            # Directories are only listed below excluded ones when using an
+            # index, which lists them top-down
+            if pruned and (ndirpath + '/').startswith(pruned):
+                continue
+            if ndirpath and prune_re.match(ndirpath):
+                pruned += (ndirpath + '/',)
+                continue
 
             for filename in filenames:
-                filepath = nfilepath = os.path.join(dirpath, filename)
-                if os.sep != '/':
-                    nfilepath = nfilepath.replace(os.sep, '/')
-
-                if self.include:
-                    included = False
-                    for pattern in self.include:
-                        if fnmatch.fnmatchcase(nfilepath, pattern) or \
-                           fnmatch.fnmatchcase(filename, pattern):
-                            included = True
-                            break
-                    if not included:
-                        continue
+                filepath = os.path.join(dirpath, filename)
+                nfilepath = ndirpath and ndirpath + '/' + filename or filename
+
+                if include_re is not None and \
+                        not include_re.match(nfilepath) and \
+                        not include_re.match(filename):
+                    continue
+                if exclude_re.match(nfilepath) or exclude_re.match(filename):
+                    continue
+                self.files.append(filepath)
 
-                excluded = False
-                for pattern in self.exclude:
-                    if fnmatch.fnmatchcase(nfilepath, pattern) or \
-                       fnmatch.fnmatchcase(filename, pattern):
-                        excluded = True
-                        break
-                if not excluded:
-                    self.files.append(filepath)
+        self._filenames = frozenset(self.files)
 
     def __iter__(self):
         """Iterate over the names of all files in the set."""
@@ -223,4 +460,4 @@ class FileSet(object):
         
         :param filename: the name of the file to check
         """
-        return filename in self.files
+        return filename in self._filenames
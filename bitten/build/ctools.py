@@ -14,9 +14,12 @@ import logging
 import re
 import os
 import posixpath
+import Queue
 import shlex
+import sys
+import threading
 
-from bitten.build import CommandLine, FileSet
+from bitten.build import CommandLine
 from bitten.util import xmlio
 
 log = logging.getLogger('bitten.build.ctools')
@@ -283,9 +286,59 @@ def cunit (ctxt, file_=None, srcdir=None):
         print e
         log.warning('Error parsing CUnit results file (%s)', e)
 
-def gcov(ctxt, include=None, exclude=None, prefix=None, root=""):
+def _map_parallel(function, items, workers):
+    """Call `function` for each of the given items from up to `workers`
+    threads, and return the results in the order of the items."""
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for idx in range(len(items)):
+        queue.put(idx)
+
+    def work():
+        while not errors:
+            try:
+                idx = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[idx] = function(items[idx])
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=work)
+               for idx in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.4 and 2.5
+    multiprocessing = None
+
+def _cpu_count():
+    if multiprocessing is None:
+        return 1
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def gcov(ctxt, include=None, exclude=None, prefix=None, root="", jobs=None):
     """Run ``gcov`` to extract coverage data where available.
     
+    ``gcov`` is run separately for every object file, but several of these
+    runs are processed at the same time. The lines of header files reported
+    by a run are counted towards the source file of that run, so a header
+    included by several source files counts for each of them.
+    
     :param ctxt: the build context
     :type ctxt: `Context`
     :param include: patterns of files and directories to include
@@ -294,12 +347,14 @@ def gcov(ctxt, include=None, exclude=None, prefix=None, root=""):
                    build system
     :param root: optional root path in which the build system puts the object
                  files
+    :param jobs: the number of ``gcov`` processes to run at the same time,
+                 defaults to the number of CPUs (one before Python 2.6)
     """
     file_re = re.compile(r'^File (?:\'|\`)(?P<file>[^\']+)\'\s*$')
     lines_re = re.compile(r'^Lines executed:(?P<cov>\d+\.\d+)\% of (?P<num>\d+)\s*$')
 
     files = []
-    for filename in FileSet(ctxt.basedir, include, exclude):
+    for filename in ctxt.fileset(include, exclude):
         if os.path.splitext(filename)[1] in ('.c', '.cpp', '.cc', '.cxx'):
             files.append(filename)
 
@@ -315,6 +370,18 @@ def gcov(ctxt, include=None, exclude=None, prefix=None, root=""):
         log.error (msg)
         log_elem.append (xmlio.Element ('message', level='error')[msg])
 
+    # Directory listings of the object file directories, so that every
+    # directory is only read once
+    listings = {}
+    def exists(dirname, filename):
+        if dirname not in listings:
+            try:
+                listings[dirname] = set(os.listdir(ctxt.resolve(dirname)))
+            except OSError:
+                listings[dirname] = set()
+        return filename in listings[dirname]
+
+    objfiles = {}
     for srcfile in files:
         # Determine the coverage for each source file by looking for a .gcno
         # and .gcda pair
@@ -324,42 +391,58 @@ def gcov(ctxt, include=None, exclude=None, prefix=None, root=""):
         if prefix is not None:
             stem = prefix + '-' + stem
 
-        objfile = os.path.join (root, filepath, stem + '.o')
-        if not os.path.isfile(ctxt.resolve(objfile)):
+        objdir = os.path.join (root, filepath)
+        objfile = os.path.join (objdir, stem + '.o')
+        if not exists(objdir, stem + '.o'):
             warning ('No object file found for %s at %s' % (srcfile, objfile))
             continue
-        if not os.path.isfile (ctxt.resolve (os.path.join (root, filepath, stem + '.gcno'))):
-            warning ('No .gcno file found for %s at %s' % (srcfile, os.path.join (root, filepath, stem + '.gcno')))
+        if not exists(objdir, stem + '.gcno'):
+            warning ('No .gcno file found for %s at %s' % (srcfile, os.path.join (objdir, stem + '.gcno')))
             continue
-        if not os.path.isfile (ctxt.resolve (os.path.join (root, filepath, stem + '.gcda'))):
-            warning ('No .gcda file found for %s at %s' % (srcfile, os.path.join (root, filepath, stem + '.gcda')))
+        if not exists(objdir, stem + '.gcda'):
+            warning ('No .gcda file found for %s at %s' % (srcfile, os.path.join (objdir, stem + '.gcda')))
             continue
+        objfiles[srcfile] = objfile
 
+    def run_gcov(srcfile):
+        """Run gcov for a single source file and return the number of lines
+        and covered lines, or `None` if gcov failed."""
         num_lines, num_covered = 0, 0
-        skip_block = False
-        cmd = CommandLine('gcov', ['-b', '-n', '-o', objfile, srcfile],
-                          cwd=ctxt.basedir)
+        in_block = False
+        cmd = CommandLine('gcov', ['-b', '-n', '-o', objfiles[srcfile],
+                                   srcfile], cwd=ctxt.basedir)
         for out, err in cmd.execute():
-            if out == '': # catch blank lines, reset the block state...
-                skip_block = False
-            elif out and not skip_block:
-                # Check for a file name
-                match = file_re.match(out)
-                if match:
-                    if os.path.isabs(match.group('file')):
-                        skip_block = True
-                        continue
-                else:
-                    # check for a "Lines executed" message
-                    match = lines_re.match(out)
-                    if match:
-                        lines = float(match.group('num'))
-                        cov = float(match.group('cov'))
-                        num_covered += int(lines * cov / 100)
-                        num_lines += int(lines)
+            if not out:
+                continue
+            # Check for a file name; blocks of system headers are skipped
+            match = file_re.match(out)
+            if match:
+                in_block = not os.path.isabs(match.group('file'))
+                continue
+            # check for a "Lines executed" message. Only the first one in a
+            # file block counts, the summary that newer gcov versions print
+            # at the end is outside of any block
+            match = lines_re.match(out)
+            if match and in_block:
+                lines = float(match.group('num'))
+                cov = float(match.group('cov'))
+                num_covered += int(lines * cov / 100)
+                num_lines += int(lines)
+                in_block = False
         if cmd.returncode != 0:
-            continue
+            return None
+        return num_lines, num_covered
+
+    srcfiles = [srcfile for srcfile in files if srcfile in objfiles]
+    if jobs is None:
+        jobs = _cpu_count()
+    results = dict(zip(srcfiles, _map_parallel(run_gcov, srcfiles,
+                                               max(int(jobs), 1))))
 
+    for srcfile in srcfiles:
+        if results[srcfile] is None:
+            continue
+        num_lines, num_covered = results[srcfile]
         module = xmlio.Element('coverage', name=os.path.basename(srcfile),
                                 file=srcfile.replace(os.sep, '/'),
                                 lines=num_lines, percentage=0)
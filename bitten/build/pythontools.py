@@ -24,7 +24,7 @@ except NameError:
 import shlex
 import sys
 
-from bitten.build import CommandLine, FileSet
+from bitten.build import CommandLine
 from bitten.util import loc, xmlio
 
 log = logging.getLogger('bitten.build.pythontools')
@@ -199,7 +199,7 @@ def coverage(ctxt, summary=None, coverdir=None, include=None, exclude=None):
                                  r'(?:(?P<missing>(?:\d+(?:-\d+)?(?:, )?)*)\s+)?'
                                  r'(?P<file>.+)$')
 
-    fileset = FileSet(ctxt.basedir, include, exclude)
+    fileset = ctxt.fileset(include, exclude)
     missing_files = []
     for filename in fileset:
         if os.path.splitext(filename)[1] != '.py':
@@ -272,7 +272,7 @@ def trace(ctxt, summary=None, coverdir=None, include=None, exclude=None):
                                  r'(?P<module>.*?)\s+\((?P<filename>.*?)\)')
     coverage_line_re = re.compile(r'\s*(?:(?P<hits>\d+): )?(?P<line>.*)')
 
-    fileset = FileSet(ctxt.basedir, include, exclude)
+    fileset = ctxt.fileset(include, exclude)
     missing_files = []
     for filename in fileset:
         if os.path.splitext(filename)[1] != '.py':
@@ -402,7 +402,7 @@ def figleaf(ctxt, summary=None, include=None, exclude=None):
         log.warning('Error opening coverage summary file (%s)', e)
         return
     coverage_data = pickle.load(fileobj)
-    fileset = FileSet(ctxt.basedir, include, exclude)
+    fileset = ctxt.fileset(include, exclude)
     for filename in fileset:
         base, ext = os.path.splitext(filename)
         if ext != '.py':
@@ -14,6 +14,7 @@ import codecs
 import logging
 import os
 import shlex
+import time
 
 from bitten.build import CommandLine
 from bitten.util import xmlio
@@ -22,8 +23,30 @@ log = logging.getLogger('bitten.build.shtools')
 
 __docformat__ = 'restructuredtext en'
 
+# When log output is handled while commands run, the output collected so far
+# is passed on after this many seconds
+LOG_FLUSH_INTERVAL = 1
+
+# Number of lines of output kept in memory before the log output of a command
+# is written to a temporary file
+LOG_SPOOL_SIZE = 10000
+
+def _log_fragment(log_head=None, log_tail=None):
+    """Return a fragment for collecting the log output of a command, which
+    is truncated if `log_head` or `log_tail` lines are given."""
+    if log_head is not None:
+        log_head = int(log_head)
+    if log_tail is not None:
+        log_tail = int(log_tail)
+    def omitted(count):
+        return xmlio.Element('message', level='warning')[
+            '[%d lines of output omitted]' % count
+        ]
+    return xmlio.SpooledFragment(LOG_SPOOL_SIZE, head=log_head, tail=log_tail,
+                                 omitted=omitted)
+
 def exec_(ctxt, executable=None, file_=None, output=None, args=None,
-          dir_=None, timeout=None):
+          dir_=None, timeout=None, log_head=None, log_tail=None):
     """Execute a program or shell script.
     
     :param ctxt: the build context
@@ -37,19 +60,24 @@ def exec_(ctxt, executable=None, file_=None, output=None, args=None,
     :param dir\_: directory to change to before executing the command
     :param timeout: the number of seconds before the external process should
                     be aborted (has same constraints as CommandLine)
+    :param log_head: the number of lines at the start of the output to keep
+                     in the build log, if it should be truncated
+    :param log_tail: the number of lines at the end of the output to keep in
+                     the build log, if it should be truncated
     """
     assert executable or file_, \
         'Either "executable" or "file" attribute required'
 
     returncode = execute(ctxt, executable=executable, file_=file_,
                          output=output, args=args, dir_=dir_,
-                         timeout=timeout)
+                         timeout=timeout, log_head=log_head,
+                         log_tail=log_tail)
     if returncode != 0:
         ctxt.error('Executing %s failed (error code %s)' % (executable or file_,
                                                             returncode))
 
 def pipe(ctxt, executable=None, file_=None, input_=None, output=None,
-         args=None, dir_=None):
+         args=None, dir_=None, log_head=None, log_tail=None):
     """Pipe the contents of a file through a program or shell script.
     
     :param ctxt: the build context
@@ -63,19 +91,25 @@ def pipe(ctxt, executable=None, file_=None, input_=None, output=None,
                    written
     :param args: command-line arguments to pass to the script
     :param dir\_: directory to change to before executing the command
+    :param log_head: the number of lines at the start of the output to keep
+                     in the build log, if it should be truncated
+    :param log_tail: the number of lines at the end of the output to keep in
+                     the build log, if it should be truncated
     """
     assert executable or file_, \
         'Either "executable" or "file" attribute required'
     assert input_, 'Missing required attribute "input"'
 
     returncode = execute(ctxt, executable=executable, file_=file_,
-                         input_=input_, output=output, args=args, dir_=dir_)
+                         input_=input_, output=output, args=args, dir_=dir_,
+                         log_head=log_head, log_tail=log_tail)
     if returncode != 0:
         ctxt.error('Piping through %s failed (error code %s)'
                    % (executable or file_, returncode))
 
 def execute(ctxt, executable=None, file_=None, input_=None, output=None,
-            args=None, dir_=None, filter_=None, timeout=None):
+            args=None, dir_=None, filter_=None, timeout=None, log_head=None,
+            log_tail=None):
     """Generic external program execution.
     
     This function is not itself bound to a recipe command, but rather used from
@@ -95,6 +129,10 @@ def execute(ctxt, executable=None, file_=None, input_=None, output=None,
     :param filter\_: function to filter out messages from the executable stdout
     :param timeout: the number of seconds before the external process should
                     be aborted (has same constraints as CommandLine)
+    :param log_head: the number of lines at the start of the output to keep
+                     in the build log, if it should be truncated
+    :param log_tail: the number of lines at the end of the output to keep in
+                     the build log, if it should be truncated
     """
     if args:
         if isinstance(args, basestring):
@@ -151,7 +189,8 @@ def execute(ctxt, executable=None, file_=None, input_=None, output=None,
     try:
         cmdline = CommandLine(executable, args, input=input_file,
                               cwd=dir_, shell=shell)
-        log_elem = xmlio.Fragment()
+        log_elem = _log_fragment(log_head, log_tail)
+        last_flush = time.time()
         for out, err in cmdline.execute(timeout=timeout):
             if out is not None:
                 log.info(out)
@@ -171,6 +210,13 @@ def execute(ctxt, executable=None, file_=None, input_=None, output=None,
                 ])
                 if output:
                     output_file.write(err + os.linesep)
+            # Truncated output can only be passed on once it is complete
+            if ctxt.log_handler is not None and log_elem.children and \
+                    log_head is None and log_tail is None and \
+                    time.time() - last_flush >= LOG_FLUSH_INTERVAL:
+                ctxt.log(log_elem)
+                log_elem = _log_fragment(log_head, log_tail)
+                last_flush = time.time()
         ctxt.log(log_elem)
     finally:
         if input_:
@@ -12,9 +12,11 @@ import os
 import shutil
 import sys
 import tempfile
+import time
 import unittest
 
-from bitten.build import CommandLine, FileSet, TimeoutError, BuildError
+from bitten.build import CommandLine, FileIndex, FileSet, TimeoutError, \
+                         BuildError
 
 
 class CommandLineTestCase(unittest.TestCase):
@@ -142,6 +144,62 @@ print 'Done'
         iterable = iter(cmdline.execute(timeout=.5))
         self.assertRaises(TimeoutError, iterable.next)
 
+    def test_long_and_partial_lines(self):
+        script_file = self._create_file('test.py', content="""
+import sys
+sys.stdout.write('a' * 100000 + '\\n')
+sys.stdout.write('b\\r\\n\\nc')
+""")
+        cmdline = CommandLine(sys.executable, [script_file])
+        stdout = [out for out, err in cmdline.execute(timeout=5.0)]
+        self.assertEqual(['a' * 100000, 'b', '', 'c'], stdout)
+        self.assertEqual(0, cmdline.returncode)
+
+    def test_timeout_kills_process_group(self):
+        if os.name == 'nt':
+            return
+        marker = os.path.join(self.basedir, 'marker')
+        script_file = self._create_file('test.py', content="""
+import subprocess, sys, time
+subprocess.Popen([sys.executable, '-c', %r])
+time.sleep(5)
+""" % ('import time; time.sleep(1); open(%r, "w").close()' % marker))
+        cmdline = CommandLine(sys.executable, [script_file])
+        started = time.time()
+        iterable = iter(cmdline.execute(timeout=.5))
+        self.assertRaises(TimeoutError, iterable.next)
+        self.assert_(time.time() - started < 1)
+        time.sleep(1.5)
+        self.assertEqual(False, os.path.exists(marker))
+
+    def test_incomplete_line_passed_on(self):
+        if os.name == 'nt':
+            return
+        # The command exits while a process it started keeps its output open
+        script_file = self._create_file('test.py', content="""
+import subprocess, sys
+subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(2)'])
+sys.stdout.write('partial')
+""")
+        cmdline = CommandLine(sys.executable, [script_file])
+        stdout = [out for out, err in cmdline.execute(timeout=5.0)]
+        self.assertEqual(['partial'], stdout)
+        self.assertEqual(0, cmdline.returncode)
+
+    def test_incomplete_line_before_timeout(self):
+        if os.name == 'nt':
+            return
+        script_file = self._create_file('test.py', content="""
+import sys, time
+sys.stdout.write('partial')
+sys.stdout.flush()
+time.sleep(2)
+""")
+        cmdline = CommandLine(sys.executable, [script_file])
+        iterable = iter(cmdline.execute(timeout=.5))
+        self.assertEqual(('partial', None), iterable.next())
+        self.assertRaises(TimeoutError, iterable.next)
+
     def test_nonexisting_command(self):
         cmdline = CommandLine('doesnotexist', [])
         iterable = iter(cmdline.execute())
@@ -207,6 +265,32 @@ class FileSetTestCase(unittest.TestCase):
         fileset = FileSet(self.basedir, include='tests/*.txt', exclude='bar.*')
         assert foo_txt in fileset and bar_txt not in fileset
 
+    def test_excluded_dirs(self):
+        self._create_dir('build', 'lib')
+        self._create_dir('src', 'build')
+        os.mkdir(os.path.join(self.basedir, 'src', 'build', '.svn'))
+        lib_c = self._create_file('build', 'lib', 'foo.c')
+        src_c = self._create_file('src', 'build', 'foo.c')
+        entries = self._create_file('src', 'build', '.svn', 'entries')
+        fileset = FileSet(self.basedir, exclude='build/*')
+        self.assertEqual([src_c], list(fileset))
+        assert lib_c not in fileset and entries not in fileset
+
+    def test_index(self):
+        self._create_dir('build', 'lib')
+        foo_c = self._create_file('foo.c')
+        lib_c = self._create_file('build', 'lib', 'foo.c')
+        index = FileIndex(self.basedir)
+        fileset = FileSet(self.basedir, include='*.c', exclude='build/*',
+                          index=index)
+        self.assertEqual([foo_c], list(fileset))
+        bar_c = self._create_file('bar.c')
+        fileset = FileSet(self.basedir, include='*.c', index=index)
+        self.assertEqual(sorted([foo_c, lib_c]), sorted(fileset))
+        index.touch()
+        fileset = FileSet(self.basedir, include='*.c', index=index)
+        self.assertEqual(sorted([foo_c, bar_c, lib_c]), sorted(fileset))
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -145,6 +145,58 @@ Calls executed:100.00% of 1
         self.assertEqual(888, elem.attr['lines'])
         self.assertEqual(45, elem.attr['percentage'])
 
+    def test_multiple_files_shared_header(self):
+        for name in ('aa', 'bb'):
+            for ext in ('.c', '.o', '.gcno', '.gcda'):
+                self._create_file('src', name + ext)
+        # Output of gcov 12, which has no blank lines between the blocks and
+        # ends with a summary for all reported files
+        stdout = {
+            os.path.join('src', 'aa.o'): """File 'aa.c'
+Lines executed:100.00% of 2
+No branches
+Calls executed:100.00% of 1
+File '/usr/include/stdlib.h'
+Lines executed:0.00% of 3
+No branches
+No calls
+File 'common.h'
+Lines executed:75.00% of 4
+Branches executed:100.00% of 2
+Taken at least once:50.00% of 2
+No calls
+Lines executed:66.67% of 9
+""",
+            os.path.join('src', 'bb.o'): """File 'bb.c'
+Lines executed:80.00% of 5
+Branches executed:100.00% of 2
+Taken at least once:50.00% of 2
+Calls executed:100.00% of 1
+File 'common.h'
+Lines executed:75.00% of 4
+Branches executed:100.00% of 2
+Taken at least once:50.00% of 2
+No calls
+Lines executed:77.78% of 9
+"""}
+        calls = []
+        def gcov(executable, args, input=None, cwd=None):
+            self.assertEqual(['-b', '-n', '-o'], args[:3])
+            calls.append(args[3])
+            return dummy.CommandLine(stdout=stdout[args[3]])
+        ctools.CommandLine = gcov
+        ctools.gcov(self.ctxt, jobs=2)
+        type, category, generator, xml = self.ctxt.output.pop()
+        type, category, generator, xml = self.ctxt.output.pop()
+        self.assertEqual('coverage', category)
+        self.assertEqual(sorted(stdout.keys()), sorted(calls))
+        # The shared header counts for both source files, the summary lines
+        # and system headers are not counted
+        results = sorted([(elem.attr['file'], elem.attr['lines'],
+                           elem.attr['percentage'])
+                          for elem in xml.children])
+        self.assertEqual([('src/aa.c', 6, 83), ('src/bb.c', 9, 77)], results)
+
 
 def suite():
     suite = unittest.TestSuite()
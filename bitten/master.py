@@ -11,35 +11,181 @@
 """Build master implementation."""
 
 import calendar
+import gzip
+import os
 import re
+import shutil
+import tempfile
+import threading
 import time
+import zlib
 from StringIO import StringIO
 
 from trac.attachment import Attachment
 from trac.config import BoolOption, IntOption, Option
 from trac.core import *
 from trac.resource import ResourceNotFound
+from trac.util.compat import sha1
 from trac.web import IRequestHandler, RequestDone
+try:
+    from trac.versioncontrol.api import IRepositoryChangeListener
+except ImportError: # Trac < 0.12
+    IRepositoryChangeListener = None
 
 from bitten import PROTOCOL_VERSION
 from bitten.model import BuildConfig, Build, BuildStep, BuildLog, Report, \
                      TargetPlatform
 
 from bitten.main import BuildSystem
-from bitten.queue import BuildQueue
+from bitten.queue import BuildQueue, notify_pending_builds, \
+                         wait_for_pending_builds
 from bitten.recipe import Recipe
 from bitten.util import xmlio
 
-__all__ = ['BuildMaster']
+__all__ = ['BuildMaster', 'BuildQueueUpdater', 'get_recipe',
+           'invalidate_recipe']
 __docformat__ = 'restructuredtext en'
 
 
+HTTP_ACCEPTED = 202
 HTTP_BAD_REQUEST = 400
 HTTP_FORBIDDEN = 403
 HTTP_NOT_FOUND = 404
 HTTP_METHOD_NOT_ALLOWED = 405
 HTTP_CONFLICT = 409
 
+# Number of log messages or report items of a step result that are collected
+# before they are written out
+_RESULT_BATCH_SIZE = 1000
+
+# While holding a request for a build, the queue is checked again after this
+# many seconds even without a notification, to pick up builds that have been
+# added by other processes
+_LONG_POLL_RECHECK = 10
+
+# Size of the chunks in which slaves are asked to upload attachments, so that
+# an interrupted upload can be resumed
+_UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class RequestBody(object):
+    """File-like access to the body of a request, which never reads past the
+    content length announced by the client, and decompresses the body if it
+    has been sent with ``Content-Encoding: gzip``."""
+
+    def __init__(self, req):
+        self.req = req
+        length = req.get_header('Content-Length')
+        self.remaining = length is not None and int(length) or None
+        self.decompressor = None
+        if req.get_header('Content-Encoding') == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, size=-1):
+        if self.decompressor is None:
+            return self._read(size)
+        if size < 0:
+            return self.decompressor.decompress(self._read()) + \
+                   self.decompressor.flush()
+        while True:
+            data = self.decompressor.unconsumed_tail or self._read(size)
+            if not data:
+                return self.decompressor.flush()
+            # Limit the output, so that highly compressed data doesn't
+            # blow up in memory
+            data = self.decompressor.decompress(data, size)
+            if data:
+                return data
+
+    def _read(self, size=-1):
+        if self.remaining is None:
+            # Without a known length, the body can only be read in one go
+            self.remaining = 0
+            return self.req.read()
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ''
+        data = self.req.read(size)
+        self.remaining = data and self.remaining - len(data) or 0
+        return data
+
+
+def _gzip(data):
+    """Return the data compressed in gzip format."""
+    buf = StringIO()
+    gzfile = gzip.GzipFile(fileobj=buf, mode='wb')
+    try:
+        gzfile.write(data)
+    finally:
+        gzfile.close()
+    return buf.getvalue()
+
+
+class ParsedRecipe(object):
+    """The steps of a build recipe, in the order they are defined in the
+    recipe, along with the position of every step."""
+
+    def __init__(self, recipe_xml):
+        self.steps = list(Recipe(xmlio.parse(recipe_xml)))
+        self.index = dict([(step.id, num) for num, step
+                           in enumerate(self.steps)])
+
+
+# Parsed recipes by environment path, configuration name and recipe digest,
+# along with the keys in order of use (least recently used first)
+_recipes = {}
+_recipes_lru = []
+_recipes_lock = threading.Lock()
+_RECIPE_CACHE_SIZE = 100
+
+def get_recipe(env, config):
+    """Return the `ParsedRecipe` of a build configuration, parsing the recipe
+    only if it isn't cached already.
+
+    :param config: the build configuration
+    :type config: `BuildConfig`
+    """
+    recipe_xml = config.recipe or ''
+    if isinstance(recipe_xml, unicode):
+        recipe_xml = recipe_xml.encode('utf-8')
+    key = (env.path, config.name, sha1(recipe_xml).hexdigest())
+
+    _recipes_lock.acquire()
+    try:
+        recipe = _recipes.get(key)
+        if recipe is not None:
+            _recipes_lru.remove(key)
+            _recipes_lru.append(key)
+            return recipe
+    finally:
+        _recipes_lock.release()
+
+    recipe = ParsedRecipe(config.recipe)
+
+    _recipes_lock.acquire()
+    try:
+        if key not in _recipes:
+            _recipes_lru.append(key)
+            while len(_recipes_lru) > _RECIPE_CACHE_SIZE:
+                del _recipes[_recipes_lru.pop(0)]
+        _recipes[key] = recipe
+    finally:
+        _recipes_lock.release()
+    return recipe
+
+def invalidate_recipe(env, config_name):
+    """Discard the cached recipes of a build configuration, for example after
+    the configuration has been changed or removed."""
+    _recipes_lock.acquire()
+    try:
+        for key in [key for key in _recipes_lru
+                    if key[:2] == (env.path, config_name)]:
+            _recipes_lru.remove(key)
+            del _recipes[key]
+    finally:
+        _recipes_lock.release()
+
 
 class BuildMaster(Component):
     """Trac request handler implementation for the build master."""
@@ -69,6 +215,22 @@ class BuildMaster(Component):
     logs_dir = Option('bitten', 'logs_dir', "log/bitten", doc=
          """The directory on the server in which client log files will be stored.""")
 
+    populate_on_poll = BoolOption('bitten', 'populate_on_poll', True, doc=
+        """Whether new builds should be added to the queue every time a
+        build slave asks for a build. This can be disabled when Trac is
+        notified about repository changes (using `trac-admin changeset added`
+        from the repository hooks), which adds new builds to the queue as
+        soon as changesets are added, but only if `stabilize_wait` is 0:
+        otherwise the builds are only queued once the repository has been
+        stable for that time, which a short-lived `trac-admin` process does
+        not wait for.""")
+
+    long_poll_timeout = IntOption('bitten', 'long_poll_timeout', 60, doc=
+        """The maximum time in seconds to hold a request for a build open
+        when the build slave asks to wait until a build is available (long
+        polling), instead of answering immediately that there is nothing to
+        build. Set to 0 to disable long polling.""")
+
     quick_status = BoolOption('bitten', 'quick_status', False, doc=
          """Whether to show the current build status within the Trac main
             navigation bar. '''Note:''' The feature requires expensive database and
@@ -83,13 +245,14 @@ class BuildMaster(Component):
     # IRequestHandler methods
 
     def match_request(self, req):
-        match = re.match(r'/builds(?:/(\d+)(?:/(\w+)/([^/]+)?)?)?$',
+        match = re.match(r'/builds(?:/(\d+)(?:/(\w+)/(?:([^/]+)(?:/(log))?)?)?)?$',
                          req.path_info)
         if match:
             if match.group(1):
                 req.args['id'] = match.group(1)
                 req.args['collection'] = match.group(2)
                 req.args['member'] = match.group(3)
+                req.args['action'] = match.group(4)
             return True
 
     def process_request(self, req):
@@ -130,6 +293,8 @@ class BuildMaster(Component):
                                   'Method %s not allowed' % req.method)
 
         if req.args['collection'] == 'steps':
+            if req.args.get('action') == 'log':
+                return self._process_build_log(req, config, build)
             return self._process_build_step(req, config, build)
         elif req.args['collection'] == 'attach':
             return self._process_attachment(req, config, build)
@@ -163,11 +328,12 @@ class BuildMaster(Component):
         queue = BuildQueue(self.env, build_all=self.build_all,
                            stabilize_wait=self.stabilize_wait,
                            timeout=self.slave_timeout)
-        try:
-            queue.populate()
-        except AssertionError, e:
-            self.log.error(e.message, exc_info=True)
-            self._send_error(req, HTTP_BAD_REQUEST, e.message)
+        if self.populate_on_poll:
+            try:
+                queue.populate()
+            except AssertionError, e:
+                self.log.error(e.message, exc_info=True)
+                self._send_error(req, HTTP_BAD_REQUEST, e.message)
 
         try:
             elem = xmlio.parse(req.read())
@@ -177,6 +343,11 @@ class BuildMaster(Component):
             self._send_error(req, HTTP_BAD_REQUEST, 'XML parser error')
 
         slave_version = int(elem.attr.get('version', 1))
+        try:
+            wait = min(int(elem.attr.get('wait', 0)), self.long_poll_timeout)
+        except ValueError:
+            self._send_error(req, HTTP_BAD_REQUEST,
+                             'Invalid wait time %r' % elem.attr.get('wait'))
 
         # FIXME: Remove version compatibility code.
         # The initial difference between protocol version 3 and 4 is that
@@ -216,12 +387,27 @@ class BuildMaster(Component):
         self.log.debug('Build slave configuration: %r', properties)
 
         build = queue.get_build_for_slave(slavename, properties)
+        deadline = time.time() + wait
+        while not build and time.time() < deadline:
+            wait_for_pending_builds(min(deadline - time.time(),
+                                        _LONG_POLL_RECHECK))
+            build = queue.get_build_for_slave(slavename, properties)
         if not build:
-            self._send_response(req, 204, '', {})
-
+            headers = {}
+            if wait > 0:
+                # Let the slave know it doesn't need to sleep before asking
+                # again
+                headers['X-Bitten-Long-Poll'] = str(wait)
+            self._send_response(req, 204, '', headers)
+
+        # Let the slave know that it may compress what it uploads, and that
+        # it may upload attachments in chunks
         self._send_response(req, 201, 'Build pending', headers={
                             'Content-Type': 'text/plain',
-                            'Location': req.abs_href.builds(build.id)})
+                            'Location': req.abs_href.builds(build.id),
+                            'Accept-Encoding': 'gzip',
+                            'X-Bitten-Upload-Chunk-Size':
+                                str(_UPLOAD_CHUNK_SIZE)})
 
     def _process_build_cancellation(self, req, config, build):
         self.log.info('Build slave %r cancelled build %d', build.slave,
@@ -231,13 +417,14 @@ class BuildMaster(Component):
         build.slave_info = {}
         build.started = 0
         db = self.env.get_db_cnx()
-        for step in list(BuildStep.select(self.env, build=build.id, db=db)):
-            step.delete(db=db)
+        BuildStep.delete_many(self.env, [build.id], db=db)
         build.update(db=db)
+        Build.delete_uploads(self.env, [build.id])
 
         Attachment.delete_all(self.env, 'build', build.resource.id, db)
 
         db.commit()
+        notify_pending_builds()
 
         for listener in BuildSystem(self.env).listeners:
             listener.build_aborted(build)
@@ -264,95 +451,84 @@ class BuildMaster(Component):
         xml.attr['name'] = build.slave
         xml.attr['form_token'] = req.form_token # For posting attachments
         body = str(xml)
+        headers = {'Content-Type': 'application/x-bitten+xml',
+                   'Content-Disposition':
+                        'attachment; filename=recipe_%s_r%s.xml' %
+                        (config.name, build.rev)}
+        if 'gzip' in (req.get_header('Accept-Encoding') or ''):
+            body = _gzip(body)
+            headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(len(body))
 
         self.log.info('Build slave %r initiated build %d', build.slave,
                       build.id)
 
         # create the first step, mark it as in-progress.
 
-        recipe = Recipe(xmlio.parse(config.recipe))
-        stepname = recipe.__iter__().next().id
+        recipe = get_recipe(self.env, config)
+        stepname = recipe.steps[0].id
 
         step = self._start_new_step(build, stepname)
         step.insert()
 
-        self._send_response(req, 200, body, headers={
-                    'Content-Type': 'application/x-bitten+xml',
-                    'Content-Length': str(len(body)),
-                    'Content-Disposition':
-                        'attachment; filename=recipe_%s_r%s.xml' %
-                        (config.name, build.rev)})
+        self._send_response(req, 200, body, headers=headers)
 
     def _process_build_step(self, req, config, build):
+        # The result is parsed while it is being read, and only the root
+        # element is needed up front
+        results = xmlio.iterparse(RequestBody(req))
         try:
-            elem = xmlio.parse(req.read())
-        except xmlio.ParseError, e:
+            attr = results.next()[2]
+        except (xmlio.ParseError, zlib.error, StopIteration), e:
             self.log.error('Error parsing build step result: %s', e,
                            exc_info=True)
             self._send_error(req, HTTP_BAD_REQUEST, 'XML parser error')
-        stepname = elem.attr['step']
+        stepname = attr['step']
 
         # we should have created this step previously; if it hasn't,
         # the master and slave are processing steps out of order.
         step = BuildStep.fetch(self.env, build=build.id, name=stepname)
         if not step:
             self._send_error(req, HTTP_CONFLICT, 'Build step has not been created.')
+        if step.status != BuildStep.IN_PROGRESS:
+            # The result has already been processed, most likely the slave
+            # sent it again after the response got lost
+            self._send_error(req, HTTP_CONFLICT,
+                             'Build step has already been processed.')
 
-        recipe = Recipe(xmlio.parse(config.recipe))
-        index = None
-        current_step = None
-        for num, recipe_step in enumerate(recipe):
-            if recipe_step.id == stepname:
-                index = num
-                current_step = recipe_step
+        recipe = get_recipe(self.env, config)
+        index = recipe.index.get(stepname)
         if index is None:
             self._send_error(req, HTTP_FORBIDDEN,
                                 'No such build step' % stepname)
-        last_step = index == num
+        current_step = recipe.steps[index]
+        last_step = index == len(recipe.steps) - 1
 
         self.log.debug('Slave %s (build %d) completed step %d (%s) with '
                        'status %s', build.slave, build.id, index, stepname,
-                       elem.attr['status'])
+                       attr['status'])
 
         db = self.env.get_db_cnx()
 
         step.stopped = int(time.time())
 
-        if elem.attr['status'] == 'failure':
+        if attr['status'] == 'failure':
             self.log.warning('Build %s step %s failed', build.id, stepname)
             step.status = BuildStep.FAILURE
             if current_step.onerror == 'fail':
                 last_step = True
         else:
             step.status = BuildStep.SUCCESS
-        step.errors += [error.gettext() for error in elem.children('error')]
 
-        # TODO: step.update(db=db)
-        step.delete(db=db)
-        step.insert(db=db)
-
-        # Collect log messages from the request body
-        for idx, log_elem in enumerate(elem.children('log')):
-            build_log = BuildLog(self.env, build=build.id, step=stepname,
-                                 generator=log_elem.attr.get('generator'),
-                                 orderno=idx)
-            for message_elem in log_elem.children('message'):
-                build_log.messages.append((message_elem.attr['level'],
-                                           message_elem.gettext()))
-            build_log.insert(db=db)
+        try:
+            self._store_step_results(results, build, step, db)
+        except (xmlio.ParseError, zlib.error), e:
+            db.rollback()
+            self.log.error('Error parsing build step result: %s', e,
+                           exc_info=True)
+            self._send_error(req, HTTP_BAD_REQUEST, 'XML parser error')
 
-        # Collect report data from the request body
-        for report_elem in elem.children('report'):
-            report = Report(self.env, build=build.id, step=stepname,
-                            category=report_elem.attr.get('category'),
-                            generator=report_elem.attr.get('generator'))
-            for item_elem in report_elem.children():
-                item = {'type': item_elem.name}
-                item.update(item_elem.attr)
-                for child_elem in item_elem.children():
-                    item[child_elem.name] = child_elem.gettext()
-                report.items.append(item)
-            report.insert(db=db)
+        step.update(db=db)
 
         # If this was the last step in the recipe we mark the build as
         # completed otherwise just update last_activity
@@ -365,9 +541,11 @@ class BuildMaster(Component):
             # Determine overall outcome of the build by checking the outcome
             # of the individual steps against the "onerror" specification of
             # each step in the recipe
-            for num, recipe_step in enumerate(recipe):
-                step = BuildStep.fetch(self.env, build.id, recipe_step.id)
-                if step.status == BuildStep.FAILURE:
+            steps = BuildStep.select_many(self.env, [build.id],
+                                          db=db)[build.id]
+            statuses = dict([(s.name, s.status) for s in steps])
+            for recipe_step in recipe.steps:
+                if statuses.get(recipe_step.id) == BuildStep.FAILURE:
                     if recipe_step.onerror == 'fail' or \
                             recipe_step.onerror == 'continue':
                         build.status = Build.FAILURE
@@ -376,18 +554,14 @@ class BuildMaster(Component):
                 build.status = Build.SUCCESS
 
             build.update(db=db)
+            # Uploads the slave did not complete will not be resumed
+            Build.delete_uploads(self.env, [build.id])
         else:
             build.last_activity = step.stopped
             build.update(db=db)
 
             # start the next step.
-            for num, recipe_step in enumerate(recipe):
-                if num == index + 1:
-                    next_step = recipe_step
-            if next_step is None:
-                self._send_error(req, HTTP_FORBIDDEN,
-                                 'Unable to find step after ' % stepname)
-
+            next_step = recipe.steps[index + 1]
             step = self._start_new_step(build, next_step.id)
             step.insert(db=db)
 
@@ -404,38 +578,218 @@ class BuildMaster(Component):
                             'Location': req.abs_href.builds(
                                     build.id, 'steps', stepname)})
 
+    def _store_step_results(self, results, build, step, db):
+        """Store the errors, logs and reports of a build step result while it
+        is being parsed, writing log messages and report items in batches.
+
+        :param results: the parser events for the children of the ``result``
+                        element, as returned by `xmlio.iterparse()`
+        """
+        # Logs are added after those sent while the step was running
+        last_log = BuildLog.fetch_last(self.env, build.id, step.name, db=db)
+        orderno = last_log and last_log.orderno + 1 or 0
+
+        new_logs = []
+        build_log = report = item = None
+        messages = []
+        items = []
+        depth = 1
+        try:
+            for event, name, attr, text in results:
+                if event == 'start':
+                    depth += 1
+                    if depth == 2 and name == 'log':
+                        build_log = BuildLog(self.env, build=build.id,
+                                             step=step.name,
+                                             generator=attr.get('generator'),
+                                             orderno=orderno)
+                        build_log.insert(db=db)
+                        new_logs.append(build_log)
+                        orderno += 1
+                    elif depth == 2 and name == 'report':
+                        report = Report(self.env, build=build.id,
+                                        step=step.name,
+                                        category=attr.get('category'),
+                                        generator=attr.get('generator'))
+                        report.insert(db=db)
+                    elif depth == 3 and report is not None:
+                        item = {'type': name}
+                        item.update(attr)
+                    continue
+
+                depth -= 1
+                if depth == 1:
+                    if name == 'error':
+                        step.errors.append(text)
+                    elif build_log is not None:
+                        build_log.append(messages)
+                        build_log, messages = None, []
+                    elif report is not None:
+                        report.add_items(items, db=db)
+                        report, items = None, []
+                elif depth == 2:
+                    if build_log is not None and name == 'message':
+                        messages.append((attr['level'], text))
+                        if len(messages) >= _RESULT_BATCH_SIZE:
+                            build_log.append(messages)
+                            messages = []
+                    elif report is not None:
+                        items.append(item)
+                        item = None
+                        if len(items) >= _RESULT_BATCH_SIZE:
+                            report.add_items(items, db=db)
+                            items = []
+                elif depth == 3 and item is not None:
+                    item[name] = text
+        except (xmlio.ParseError, zlib.error):
+            for build_log in new_logs:
+                build_log._delete_files()
+            raise
+
+    def _process_build_log(self, req, config, build):
+        stepname = req.args['member']
+        try:
+            elem = xmlio.parse(req.read())
+        except xmlio.ParseError, e:
+            self.log.error('Error parsing build log: %s', e, exc_info=True)
+            self._send_error(req, HTTP_BAD_REQUEST, 'XML parser error')
+
+        step = BuildStep.fetch(self.env, build=build.id, name=stepname)
+        if not step or step.status != BuildStep.IN_PROGRESS:
+            self._send_error(req, HTTP_CONFLICT,
+                             'Build step is not in progress.')
+
+        generator = elem.attr.get('generator') or ''
+        messages = [(message_elem.attr['level'], message_elem.gettext())
+                    for message_elem in elem.children('message')]
+
+        db = self.env.get_db_cnx()
+
+        # Continue the last log of the step if it is from the same generator
+        build_log = BuildLog.fetch_last(self.env, build.id, stepname, db=db)
+        if not build_log or build_log.generator != generator:
+            orderno = build_log and build_log.orderno + 1 or 0
+            build_log = BuildLog(self.env, build=build.id, step=stepname,
+                                 generator=generator, orderno=orderno)
+            build_log.insert(db=db)
+        build_log.append(messages)
+
+        build.last_activity = int(time.time())
+        build.update(db=db)
+        db.commit()
+
+        self.log.debug('Slave %s (build %d) sent %d log messages for step %s',
+                       build.slave, build.id, len(messages), stepname)
+
+        body = 'Build log appended'
+        self._send_response(req, 201, body, {
+                            'Content-Type': 'text/plain',
+                            'Content-Length': str(len(body)),
+                            'Location': req.abs_href.builds(
+                                    build.id, 'steps', stepname, 'log')})
+
     def _process_attachment(self, req, config, build):
         resource_id = req.args['member'] == 'config' \
                     and build.config or build.resource.id
-        upload = req.args['file']
-        if not upload.file:
-            send_error(req, message="Attachment not received.")
+        upload = req.args.get('file')
+        if not getattr(upload, 'file', None):
+            self._send_error(req, HTTP_BAD_REQUEST, 'Attachment not received.')
         self.log.debug('Received attachment %s for attaching to build:%s',
                       upload.filename, resource_id)
 
-        # Determine size of file
-        upload.file.seek(0, 2) # to the end
-        size = upload.file.tell()
-        upload.file.seek(0)    # beginning again
-
-        # Delete attachment if it already exists
+        fileobj = upload.file
+        chunks = None
+        if 'offset' in req.args:
+            chunks_path = self._receive_upload_chunk(req, build, resource_id,
+                                                     upload)
+            fileobj = chunks = open(chunks_path, 'rb')
         try:
-            old_attach = Attachment(self.env, 'build',
+            if req.args.get('encoding') == 'gzip':
+                compressed, fileobj = fileobj, tempfile.TemporaryFile()
+                try:
+                    shutil.copyfileobj(gzip.GzipFile(fileobj=compressed,
+                                                     mode='rb'), fileobj)
+                except (IOError, zlib.error), e:
+                    self.log.error('Error decompressing attachment %s: %s',
+                                   upload.filename, e)
+                    self._send_error(req, HTTP_BAD_REQUEST,
+                                     'Invalid compressed attachment')
+
+            # Determine size of file
+            fileobj.seek(0, 2) # to the end
+            size = fileobj.tell()
+            fileobj.seek(0)    # beginning again
+
+            # Delete attachment if it already exists
+            try:
+                old_attach = Attachment(self.env, 'build',
                             parent_id=resource_id, filename=upload.filename)
-            old_attach.delete()
-        except ResourceNotFound:
-            pass
-
-        # Save new attachment
-        attachment = Attachment(self.env, 'build', parent_id=resource_id)
-        attachment.description = req.args.get('description', '')
-        attachment.author = req.authname
-        attachment.insert(upload.filename, upload.file, size)
+                old_attach.delete()
+            except ResourceNotFound:
+                pass
+
+            # Save new attachment
+            attachment = Attachment(self.env, 'build', parent_id=resource_id)
+            attachment.description = req.args.get('description', '')
+            attachment.author = req.authname
+            attachment.insert(upload.filename, fileobj, size)
+        finally:
+            if chunks is not None:
+                chunks.close()
+                os.remove(chunks_path)
 
         self._send_response(req, 201, 'Attachment created', headers={
                             'Content-Type': 'text/plain',
                             'Content-Length': str(len('Attachment created'))})
 
+    def _receive_upload_chunk(self, req, build, resource_id, upload):
+        """Add a chunk of an attachment that is uploaded in several requests
+        to the part of the file received so far.
+
+        Unless the chunk completes the file, this responds with the offset at
+        which the slave should continue. Otherwise the path of the complete
+        file is returned.
+        """
+        try:
+            offset = int(req.args['offset'])
+            size = int(req.args['size'])
+        except (KeyError, ValueError):
+            self._send_error(req, HTTP_BAD_REQUEST, 'Invalid upload offset')
+
+        chunks_dir = Build.get_uploads_dir(self.env, build.id)
+        if not os.path.isdir(chunks_dir):
+            os.makedirs(chunks_dir)
+        path = os.path.join(chunks_dir, sha1(repr((resource_id,
+                                                   upload.filename))
+                                             ).hexdigest())
+        received = os.path.isfile(path) and os.path.getsize(path) or 0
+        if offset and offset != received:
+            # Probably a retry after the response to an earlier chunk got lost
+            body = 'Upload offset mismatch'
+            self._send_response(req, HTTP_CONFLICT, body, headers={
+                                'Content-Type': 'text/plain',
+                                'Content-Length': str(len(body)),
+                                'X-Bitten-Upload-Offset': str(received)})
+
+        # The first chunk starts the file over
+        fileobj = open(path, offset and 'ab' or 'wb')
+        try:
+            shutil.copyfileobj(upload.file, fileobj)
+        finally:
+            fileobj.close()
+        received = os.path.getsize(path)
+        if received > size:
+            os.remove(path)
+            self._send_error(req, HTTP_BAD_REQUEST,
+                             'Attachment larger than announced')
+        elif received < size:
+            body = 'Attachment chunk received'
+            self._send_response(req, HTTP_ACCEPTED, body, headers={
+                                'Content-Type': 'text/plain',
+                                'Content-Length': str(len(body)),
+                                'X-Bitten-Upload-Offset': str(received)})
+        return path
+
     def _process_keepalive(self, req, config, build):
         build.last_activity = int(time.time())
         build.update()
@@ -458,3 +812,66 @@ class BuildMaster(Component):
         step.stopped = 0
 
         return step
+
+
+class BuildQueueUpdater(Component):
+    """Adds new builds to the build queue when changesets are added to the
+    repository, instead of waiting for a build slave to ask for a build.
+
+    If the `[bitten] stabilize_wait` option is set, the queue is populated
+    again once that time has passed after the last changeset was added. The
+    delayed update only happens in a long-running process (such as `tracd`),
+    and not when notifications come from `trac-admin changeset added` in the
+    repository hooks, so the `[bitten] populate_on_poll` option must stay
+    enabled unless `stabilize_wait` is 0.
+    """
+
+    if IRepositoryChangeListener is not None:
+        implements(IRepositoryChangeListener)
+
+    def __init__(self):
+        self._timer = None
+        self._timer_lock = threading.Lock()
+
+    # IRepositoryChangeListener methods
+
+    def changeset_added(self, repos, changeset):
+        default_repos = self.env.get_repository()
+        if not default_repos or getattr(repos, 'reponame', None) != \
+                getattr(default_repos, 'reponame', None):
+            # Builds are only done for the default repository
+            return
+
+        self.log.debug('Changeset [%s] added, populating build queue',
+                       changeset.rev)
+        self.populate()
+
+        stabilize_wait = BuildMaster(self.env).stabilize_wait
+        if stabilize_wait:
+            self._timer_lock.acquire()
+            try:
+                if self._timer:
+                    self._timer.cancel()
+                self._timer = threading.Timer(stabilize_wait + 1,
+                                              self.populate)
+                self._timer.setDaemon(True)
+                self._timer.start()
+            finally:
+                self._timer_lock.release()
+
+    def changeset_modified(self, repos, changeset, old_changeset):
+        pass
+
+    # Public methods
+
+    def populate(self):
+        """Add the builds for any new changesets to the build queue."""
+        master = BuildMaster(self.env)
+        queue = BuildQueue(self.env, build_all=master.build_all,
+                           stabilize_wait=master.stabilize_wait,
+                           timeout=master.slave_timeout)
+        try:
+            queue.populate()
+        except Exception, e:
+            self.log.error('Error populating the build queue: %s', e,
+                           exc_info=True)
@@ -18,9 +18,20 @@ from trac.util.datefmt import to_timestamp, utcmin, utcmax
 from datetime import datetime
 import codecs
 import os
+import shutil
 
 __docformat__ = 'restructuredtext en'
 
+# Maximum number of parameters passed in a single ``IN (...)`` clause
+_IN_CHUNK_SIZE = 500
+
+def _chunks(seq, size=_IN_CHUNK_SIZE):
+    """Split a sequence into lists of at most `size` items, so that they can
+    safely be used as parameters of an ``IN (...)`` clause."""
+    seq = list(seq)
+    for idx in range(0, len(seq), size):
+        yield seq[idx:idx + size]
+
 
 class BuildConfig(object):
     """Representation of a build configuration."""
@@ -30,6 +41,9 @@ class BuildConfig(object):
             Column('name'), Column('path'), Column('active', type='int'),
             Column('recipe'), Column('min_rev'), Column('max_rev'),
             Column('label'), Column('description')
+        ],
+        Table('bitten_scan', key='config')[
+            Column('config'), Column('rev')
         ]
     ]
 
@@ -79,6 +93,7 @@ class BuildConfig(object):
         Attachment.delete_all(self.env, 'build', self.resource.id, db)
 
         cursor = db.cursor()
+        cursor.execute("DELETE FROM bitten_scan WHERE config=%s", (self.name,))
         cursor.execute("DELETE FROM bitten_config WHERE name=%s", (self.name,))
 
         if handle_ta:
@@ -129,6 +144,10 @@ class BuildConfig(object):
                            "WHERE config=%s", (self.name, self._old_name))
             cursor.execute("UPDATE bitten_build SET config=%s "
                            "WHERE config=%s", (self.name, self._old_name))
+        # The path, revision range or active state may have changed, so the
+        # build queue needs to look at the whole history again
+        cursor.execute("DELETE FROM bitten_scan WHERE config=%s",
+                       (self._old_name,))
 
         if handle_ta:
             db.commit()
@@ -188,6 +207,42 @@ class BuildConfig(object):
 
     select = classmethod(select)
 
+    def get_scanned_rev(self, db=None):
+        """Return the newest revision of this configuration that has already
+        been examined by the build queue, or `None` if the whole history
+        needs to be scanned.
+        """
+        if not db:
+            db = self.env.get_db_cnx()
+
+        cursor = db.cursor()
+        cursor.execute("SELECT rev FROM bitten_scan WHERE config=%s",
+                       (self.name,))
+        row = cursor.fetchone()
+        return row and row[0] or None
+
+    def set_scanned_rev(self, rev, db=None):
+        """Record the newest revision of this configuration that has been
+        examined by the build queue.
+
+        Passing `None` as revision forces a full scan of the history the next
+        time the build queue is populated.
+        """
+        if not db:
+            db = self.env.get_db_cnx()
+            handle_ta = True
+        else:
+            handle_ta = False
+
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM bitten_scan WHERE config=%s", (self.name,))
+        if rev is not None:
+            cursor.execute("INSERT INTO bitten_scan (config,rev) "
+                           "VALUES (%s,%s)", (self.name, str(rev)))
+
+        if handle_ta:
+            db.commit()
+
     def min_rev_time(self, env):
         """Returns the time of the minimum revision being built for this
         configuration. Returns utcmin if not specified.
@@ -359,11 +414,31 @@ class TargetPlatform(object):
         else:
             where = ""
 
+        args = [wc[1] for wc in where_clauses]
+
         cursor = db.cursor()
-        cursor.execute("SELECT id FROM bitten_platform %s ORDER BY name"
-                       % where, [wc[1] for wc in where_clauses])
-        for (id,) in cursor:
-            yield TargetPlatform.fetch(env, id)
+        cursor.execute("SELECT id,config,name FROM bitten_platform %s "
+                       "ORDER BY name" % where, args)
+        platforms = []
+        for id, config, name in cursor.fetchall():
+            platform = TargetPlatform(env, config=config, name=name)
+            platform.id = id
+            platforms.append(platform)
+        if not platforms:
+            return
+
+        # Load the rules of all matching platforms at once
+        by_id = dict([(platform.id, platform) for platform in platforms])
+        cursor.execute("SELECT id,propname,pattern FROM bitten_rule "
+                       "WHERE id IN (SELECT id FROM bitten_platform %s) "
+                       "ORDER BY id,orderno" % where, args)
+        for id, propname, pattern in cursor.fetchall():
+            platform = by_id.get(id)
+            if platform is not None:
+                platform.rules.append((propname, pattern))
+
+        for platform in platforms:
+            yield platform
 
     select = classmethod(select)
 
@@ -448,6 +523,7 @@ class Build(object):
 
         # Delete attachments
         Attachment.delete_all(self.env, 'build', self.resource.id, db)
+        Build.delete_uploads(self.env, [self.id])
 
         cursor = db.cursor()
         cursor.execute("DELETE FROM bitten_slave WHERE build=%s", (self.id,))
@@ -456,6 +532,60 @@ class Build(object):
         if handle_ta:
             db.commit()
 
+    def delete_many(cls, env, builds, status=None, db=None):
+        """Remove several builds from the database at once, along with their
+        steps, slave information and attachments.
+
+        :param builds: an iterable of build IDs
+        :param status: if given, only builds that still have this status are
+                       removed, so that builds claimed in the meantime are
+                       left alone
+        :return: the IDs of the builds that have been removed
+        """
+        if not db:
+            db = env.get_db_cnx()
+            handle_ta = True
+        else:
+            handle_ta = False
+
+        builds = set([int(build) for build in builds])
+        deleted = []
+        cursor = db.cursor()
+        for chunk in _chunks(builds):
+            in_builds = ",".join(["%s"] * len(chunk))
+            cursor.execute("SELECT id,config FROM bitten_build "
+                           "WHERE id IN (%s)" % in_builds, chunk)
+            configs = dict([(int(row[0]), row[1])
+                            for row in cursor.fetchall()])
+            sql = "DELETE FROM bitten_build WHERE id IN (%s)" % in_builds
+            args = list(chunk)
+            if status is not None:
+                sql += " AND status=%s"
+                args.append(status)
+            cursor.execute(sql, args)
+            # Whatever is left has not been removed
+            cursor.execute("SELECT id FROM bitten_build WHERE id IN (%s)"
+                           % in_builds, chunk)
+            for row in cursor.fetchall():
+                configs.pop(int(row[0]), None)
+            for build_id, config in configs.items():
+                Attachment.delete_all(env, 'build',
+                                      '%s/%s' % (config, build_id), db)
+                deleted.append(build_id)
+
+        if deleted:
+            BuildStep.delete_many(env, deleted, db=db)
+            cls.delete_uploads(env, deleted)
+        for chunk in _chunks(deleted):
+            cursor.execute("DELETE FROM bitten_slave WHERE build IN (%s)"
+                           % ",".join(["%s"] * len(chunk)), chunk)
+
+        if handle_ta:
+            db.commit()
+        return deleted
+
+    delete_many = classmethod(delete_many)
+
     def insert(self, db=None):
         """Insert a new build into the database."""
         assert not self.exists, 'Cannot insert an existing build'
@@ -517,26 +647,126 @@ class Build(object):
         if handle_ta:
             db.commit()
 
+    def reset_many(cls, env, builds, last_activity=None, db=None):
+        """Reset several in-progress builds to pending state, removing their
+        steps, slave information and attachments.
+
+        Builds that are no longer in progress are left alone, so that builds
+        completed in the meantime are not reset.
+
+        :param builds: an iterable of build IDs
+        :param last_activity: if given, builds that have reported activity
+                              after this time are left alone, too
+        :return: the IDs of the builds that have been reset
+        """
+        if not db:
+            db = env.get_db_cnx()
+            handle_ta = True
+        else:
+            handle_ta = False
+
+        builds = set([int(build) for build in builds])
+        reset = []
+        cursor = db.cursor()
+        for chunk in _chunks(builds):
+            sql = "SELECT id,config,slave,started,last_activity " \
+                  "FROM bitten_build WHERE id IN (%s) AND status=%%s" \
+                  % ",".join(["%s"] * len(chunk))
+            args = chunk + [cls.IN_PROGRESS]
+            if last_activity is not None:
+                sql += " AND last_activity<=%s"
+                args.append(int(last_activity))
+            cursor.execute(sql, args)
+            for build_id, config, slave, started, activity in \
+                    cursor.fetchall():
+                # Only reset the build if it is still in the state in which
+                # it was found, like `claim()` does
+                cursor.execute("UPDATE bitten_build SET status=%s,slave=%s,"
+                               "started=0,stopped=0,last_activity=0 "
+                               "WHERE id=%s AND status=%s AND slave=%s "
+                               "AND started=%s AND last_activity=%s",
+                               (cls.PENDING, '', build_id, cls.IN_PROGRESS,
+                                slave, started, activity))
+                if cursor.rowcount != 1:
+                    continue
+                Attachment.delete_all(env, 'build',
+                                      '%s/%s' % (config, build_id), db)
+                reset.append(int(build_id))
+
+        if reset:
+            BuildStep.delete_many(env, reset, db=db)
+            cls.delete_uploads(env, reset)
+        for chunk in _chunks(reset):
+            cursor.execute("DELETE FROM bitten_slave WHERE build IN (%s)"
+                           % ",".join(["%s"] * len(chunk)), chunk)
+
+        if handle_ta:
+            db.commit()
+        return reset
+
+    reset_many = classmethod(reset_many)
+
+    def get_uploads_dir(cls, env, build):
+        """Return the directory in which attachments that are uploaded in
+        several chunks are assembled for the build with the given ID."""
+        return os.path.join(env.path, 'files', 'bitten-uploads', str(build))
+
+    get_uploads_dir = classmethod(get_uploads_dir)
+
+    def delete_uploads(cls, env, builds):
+        """Remove the partial attachment uploads of the given builds.
+
+        :param builds: an iterable of build IDs
+        """
+        for build in builds:
+            shutil.rmtree(cls.get_uploads_dir(env, build), ignore_errors=True)
+
+    delete_uploads = classmethod(delete_uploads)
+
+    def claim(self, slave, db=None):
+        """Mark this pending build as being in progress on the given slave.
+
+        The status is changed with a single conditional ``UPDATE``, so that
+        only one of several concurrent requests can claim the same build.
+
+        :return: whether the build was claimed, `False` if it is no longer
+                 pending
+        """
+        assert self.exists, 'Cannot claim a non-existing build'
+        assert slave, 'A build can only be claimed by a slave'
+        if not db:
+            db = self.env.get_db_cnx()
+            handle_ta = True
+        else:
+            handle_ta = False
+
+        cursor = db.cursor()
+        cursor.execute("UPDATE bitten_build SET slave=%s,status=%s "
+                       "WHERE id=%s AND status=%s",
+                       (slave, self.IN_PROGRESS, self.id, self.PENDING))
+        if cursor.rowcount != 1:
+            return False
+
+        if handle_ta:
+            db.commit()
+        self.slave = slave
+        self.status = self.IN_PROGRESS
+        return True
+
     def fetch(cls, env, id, db=None):
         """Retrieve an existing build from the database by ID."""
         if not db:
             db = env.get_db_cnx()
 
         cursor = db.cursor()
-        cursor.execute("SELECT config,rev,rev_time,platform,slave,started,"
+        cursor.execute("SELECT id,config,rev,rev_time,platform,slave,started,"
                        "stopped,last_activity,status FROM bitten_build WHERE "
                        "id=%s", (id,))
         row = cursor.fetchone()
         if not row:
             return None
 
-        build = Build(env, config=row[0], rev=row[1], rev_time=int(row[2]),
-                      platform=int(row[3]), slave=row[4],
-                      started=row[5] and int(row[5]) or 0,
-                      stopped=row[6] and int(row[6]) or 0, 
-                      last_activity=row[7] and int(row[7]) or 0,
-                      status=row[8])
-        build.id = int(id)
+        build = cls._from_row(env, row)
         cursor.execute("SELECT propname,propvalue FROM bitten_slave "
                        "WHERE build=%s", (id,))
         for propname, propvalue in cursor:
@@ -546,9 +776,18 @@ class Build(object):
     fetch = classmethod(fetch)
 
     def select(cls, env, config=None, rev=None, platform=None, slave=None,
-               status=None, db=None, min_rev_time=None, max_rev_time=None):
+               status=None, db=None, min_rev_time=None, max_rev_time=None,
+               limit=None, offset=None):
         """Retrieve existing builds from the database that match the specified
         criteria.
+
+        The builds are loaded with a single query, and the slave properties of
+        all matching builds with a second one, instead of fetching every build
+        individually.
+
+        :param limit: the maximum number of builds to return
+        :param offset: the number of matching builds to skip (requires
+                       ``limit``)
         """
         if not db:
             db = env.get_db_cnx()
@@ -572,15 +811,108 @@ class Build(object):
             where = "WHERE " + " AND ".join([wc[0] for wc in where_clauses])
         else:
             where = ""
+        args = [wc[1] for wc in where_clauses]
+
+        assert offset is None or limit is not None, \
+               'An offset can only be used together with a limit'
+        paging = ""
+        if limit is not None:
+            paging = " LIMIT %d" % int(limit)
+            if offset:
+                paging += " OFFSET %d" % int(offset)
 
         cursor = db.cursor()
-        cursor.execute("SELECT id FROM bitten_build %s "
-                       "ORDER BY rev_time DESC,config,slave"
-                       % where, [wc[1] for wc in where_clauses])
-        for (id,) in cursor:
-            yield Build.fetch(env, id)
+        cursor.execute("SELECT id,config,rev,rev_time,platform,slave,started,"
+                       "stopped,last_activity,status FROM bitten_build %s "
+                       "ORDER BY rev_time DESC,config,slave,id%s"
+                       % (where, paging), args)
+        builds = [cls._from_row(env, row) for row in cursor.fetchall()]
+        if not builds:
+            return
+
+        by_id = dict([(build.id, build) for build in builds])
+        if limit is None:
+            # Load the slave properties of all matching builds at once
+            cursor.execute("SELECT build,propname,propvalue FROM bitten_slave "
+                           "WHERE build IN (SELECT id FROM bitten_build %s)"
+                           % where, args)
+            rows = cursor.fetchall()
+        else:
+            rows = []
+            for chunk in _chunks(by_id.keys()):
+                cursor.execute("SELECT build,propname,propvalue "
+                               "FROM bitten_slave WHERE build IN (%s)"
+                               % ",".join(["%s"] * len(chunk)), chunk)
+                rows.extend(cursor.fetchall())
+        for build_id, propname, propvalue in rows:
+            build = by_id.get(int(build_id))
+            if build is not None:
+                build.slave_info[propname] = propvalue
+
+        for build in builds:
+            yield build
+
     select = classmethod(select)
 
+    def count(cls, env, config=None, platform=None, status=None, db=None):
+        """Return the number of builds that match the specified criteria."""
+        counts = cls.count_grouped(env, config=config, platform=platform,
+                                   status=status, db=db)
+        return sum(counts.values())
+
+    count = classmethod(count)
+
+    def count_grouped(cls, env, config=None, platform=None, status=None,
+                      db=None):
+        """Count the builds matching the specified criteria with a single
+        ``GROUP BY`` query.
+
+        :return: a dictionary mapping ``(config, platform, status)`` tuples to
+                 the number of builds in that group; groups without builds
+                 are not included
+        """
+        if not db:
+            db = env.get_db_cnx()
+
+        where_clauses = []
+        if config is not None:
+            where_clauses.append(("config=%s", config))
+        if platform is not None:
+            where_clauses.append(("platform=%s", platform))
+        if status is not None:
+            where_clauses.append(("status=%s", status))
+        if where_clauses:
+            where = "WHERE " + " AND ".join([wc[0] for wc in where_clauses])
+        else:
+            where = ""
+
+        cursor = db.cursor()
+        cursor.execute("SELECT config,platform,status,COUNT(*) "
+                       "FROM bitten_build %s GROUP BY config,platform,status"
+                       % where, [wc[1] for wc in where_clauses])
+        counts = {}
+        for config, platform, status, count in cursor:
+            counts[(config, int(platform), status)] = int(count)
+        return counts
+
+    count_grouped = classmethod(count_grouped)
+
+    def _from_row(cls, env, row):
+        """Create a `Build` object from a ``bitten_build`` row of the form
+        ``(id, config, rev, rev_time, platform, slave, started, stopped,
+        last_activity, status)``.
+        """
+        build = Build(env, config=row[1], rev=row[2], rev_time=int(row[3]),
+                      platform=int(row[4]), slave=row[5],
+                      started=row[6] and int(row[6]) or 0,
+                      stopped=row[7] and int(row[7]) or 0,
+                      last_activity=row[8] and int(row[8]) or 0,
+                      status=row[9])
+        build.id = int(row[0])
+        return build
+
+    _from_row = classmethod(_from_row)
+
 
 class BuildStep(object):
     """Represents an individual step of an executed build."""
@@ -676,6 +1008,35 @@ class BuildStep(object):
             db.commit()
         self._exists = True
 
+    def update(self, db=None):
+        """Save changes to an existing build step, leaving its logs and
+        reports alone."""
+        assert self.exists, 'Cannot update a non-existing build step'
+        if not db:
+            db = self.env.get_db_cnx()
+            handle_ta = True
+        else:
+            handle_ta = False
+
+        assert self.status in (self.SUCCESS, self.IN_PROGRESS, self.FAILURE)
+
+        cursor = db.cursor()
+        cursor.execute("UPDATE bitten_step SET description=%s,status=%s,"
+                       "started=%s,stopped=%s WHERE build=%s AND name=%s",
+                       (self.description or '', self.status,
+                        self.started or 0, self.stopped or 0, self.build,
+                        self.name))
+        cursor.execute("DELETE FROM bitten_error WHERE build=%s AND step=%s",
+                       (self.build, self.name))
+        if self.errors:
+            cursor.executemany("INSERT INTO bitten_error (build,step,message,"
+                               "orderno) VALUES (%s,%s,%s,%s)",
+                               [(self.build, self.name, message, idx)
+                                for idx, message in enumerate(self.errors)])
+
+        if handle_ta:
+            db.commit()
+
     def fetch(cls, env, build, name, db=None):
         """Retrieve an existing build from the database by build ID and step
         name."""
@@ -730,6 +1091,96 @@ class BuildStep(object):
 
     select = classmethod(select)
 
+    def select_many(cls, env, builds, status=None, db=None):
+        """Retrieve the steps of several builds at once.
+
+        All steps and their errors are loaded with one query each (per
+        chunk of builds), instead of two queries for every single step.
+
+        :param builds: an iterable of build IDs
+        :param status: only return steps with this status (optional)
+        :return: a dictionary mapping each of the given build IDs to the list
+                 of its steps, ordered by start time
+        """
+        if not db:
+            db = env.get_db_cnx()
+
+        assert status in (None, BuildStep.SUCCESS, BuildStep.IN_PROGRESS, BuildStep.FAILURE)
+
+        ids = set([int(build) for build in builds])
+        steps = dict([(build, []) for build in ids])
+        by_key = {}
+
+        cursor = db.cursor()
+        for chunk in _chunks(ids):
+            where = "build IN (%s)" % ",".join(["%s"] * len(chunk))
+            args = list(chunk)
+            if status is not None:
+                where += " AND status=%s"
+                args.append(status)
+            cursor.execute("SELECT build,name,description,status,started,"
+                           "stopped FROM bitten_step WHERE %s "
+                           "ORDER BY build,started" % where, args)
+            for build, name, description, status_, started, stopped \
+                    in cursor.fetchall():
+                step = BuildStep(env, int(build), name, description or '',
+                                 status_, started and int(started),
+                                 stopped and int(stopped))
+                step._exists = True
+                steps[step.build].append(step)
+                by_key[(step.build, name)] = step
+
+            cursor.execute("SELECT build,step,message FROM bitten_error "
+                           "WHERE build IN (%s) ORDER BY build,step,orderno"
+                           % ",".join(["%s"] * len(chunk)), list(chunk))
+            for build, name, message in cursor.fetchall():
+                step = by_key.get((int(build), name))
+                if step is not None:
+                    step.errors.append(message or '')
+
+        return steps
+
+    select_many = classmethod(select_many)
+
+    def delete_many(cls, env, builds, db=None):
+        """Remove all steps of several builds, including their errors, logs
+        and reports, using a few set-based statements.
+
+        :param builds: an iterable of build IDs
+        """
+        if not db:
+            db = env.get_db_cnx()
+            handle_ta = True
+        else:
+            handle_ta = False
+
+        cursor = db.cursor()
+        for chunk in _chunks(set([int(build) for build in builds])):
+            in_builds = "build IN (%s)" % ",".join(["%s"] * len(chunk))
+
+            cursor.execute("SELECT build,step,filename FROM bitten_log "
+                           "WHERE %s" % in_builds, chunk)
+            for build, step, filename in cursor.fetchall():
+                BuildLog(env, build, step, filename=filename)._delete_files()
+            cursor.execute("DELETE FROM bitten_log WHERE %s" % in_builds,
+                           chunk)
+
+            cursor.execute("DELETE FROM bitten_report_item WHERE report IN "
+                           "(SELECT id FROM bitten_report WHERE %s)"
+                           % in_builds, chunk)
+            cursor.execute("DELETE FROM bitten_report WHERE %s" % in_builds,
+                           chunk)
+
+            cursor.execute("DELETE FROM bitten_error WHERE %s" % in_builds,
+                           chunk)
+            cursor.execute("DELETE FROM bitten_step WHERE %s" % in_builds,
+                           chunk)
+
+        if handle_ta:
+            db.commit()
+
+    delete_many = classmethod(delete_many)
+
 
 class BuildLog(object):
     """Represents a build log."""
@@ -790,6 +1241,17 @@ class BuildLog(object):
         else:
             handle_ta = False
 
+        self._delete_files()
+
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM bitten_log WHERE id=%s", (self.id,))
+
+        if handle_ta:
+            db.commit()
+        self.id = None
+
+    def _delete_files(self):
+        """Remove the log and level files of this build log."""
         if self.filename:
             log_file = self.get_log_file(self.filename)
             if os.path.exists(log_file):
@@ -807,13 +1269,6 @@ class BuildLog(object):
                     self.env.log.warning("Error removing level file %s: %s" \
                                                 % (level_file, e))
 
-        cursor = db.cursor()
-        cursor.execute("DELETE FROM bitten_log WHERE id=%s", (self.id,))
-
-        if handle_ta:
-            db.commit()
-        self.id = None
-
     def insert(self, db=None):
         """Insert a new build log into the database."""
         if not db:
@@ -831,6 +1286,7 @@ class BuildLog(object):
         id = db.get_last_id(cursor, 'bitten_log')
         log_file = "%s.log" % (id,)
         cursor.execute("UPDATE bitten_log SET filename=%s WHERE id=%s", (log_file, id))
+        self.filename = log_file
         if self.messages:
             log_file_name = self.get_log_file(log_file)
             level_file_name = log_file_name + self.LEVELS_SUFFIX
@@ -841,6 +1297,27 @@ class BuildLog(object):
             db.commit()
         self.id = id
 
+    def append(self, messages):
+        """Append messages to the files of an existing build log.
+
+        :param messages: a list of ``(level, message)`` tuples
+        """
+        assert self.exists, 'Cannot append to a non-existing build log'
+        if not messages:
+            return
+        log_file_name = self.get_log_file(self.filename)
+        level_file_name = log_file_name + self.LEVELS_SUFFIX
+        log_file = codecs.open(log_file_name, "ab", "UTF-8")
+        try:
+            log_file.writelines([to_unicode(msg[1]+"\n") for msg in messages])
+        finally:
+            log_file.close()
+        level_file = codecs.open(level_file_name, "ab", "UTF-8")
+        try:
+            level_file.writelines([to_unicode(msg[0]+"\n") for msg in messages])
+        finally:
+            level_file.close()
+
     def fetch(cls, env, id, db=None):
         """Retrieve an existing build from the database by ID."""
         if not db:
@@ -900,6 +1377,26 @@ class BuildLog(object):
 
     select = classmethod(select)
 
+    def fetch_last(cls, env, build, step, db=None):
+        """Retrieve the build log of a build step with the highest order
+        number, without reading the log messages, or `None` if the step has
+        no logs yet."""
+        if not db:
+            db = env.get_db_cnx()
+
+        cursor = db.cursor()
+        cursor.execute("SELECT id,generator,orderno,filename FROM bitten_log "
+                       "WHERE build=%s AND step=%s ORDER BY orderno DESC "
+                       "LIMIT 1", (build, step))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        log = BuildLog(env, build, step, row[1], row[2], row[3])
+        log.id = row[0]
+        return log
+
+    fetch_last = classmethod(fetch_last)
+
 
 class Report(object):
     """Represents a generated report."""
@@ -984,6 +1481,36 @@ class Report(object):
             db.commit()
         self.id = id
 
+    def add_items(self, items, db=None):
+        """Insert more items of an existing report into the database, numbered
+        after the items the report already has.
+
+        Unlike `insert`, this does not add the items to the `items` list.
+        """
+        assert self.exists, 'Cannot add items to a non-existing report'
+        if not db:
+            db = self.env.get_db_cnx()
+            handle_ta = True
+        else:
+            handle_ta = False
+
+        cursor = db.cursor()
+        cursor.execute("SELECT MAX(item) FROM bitten_report_item "
+                       "WHERE report=%s", (self.id,))
+        row = cursor.fetchone()
+        first = row and row[0] is not None and row[0] + 1 or 0
+        rows = []
+        for idx, item in enumerate([item for item in items if item]):
+            rows += [(self.id, first + idx, key, value) for key, value
+                     in item.items()]
+        if rows:
+            cursor.executemany("INSERT INTO bitten_report_item "
+                               "(report,item,name,value) "
+                               "VALUES (%s,%s,%s,%s)", rows)
+
+        if handle_ta:
+            db.commit()
+
     def fetch(cls, env, id, db=None):
         """Retrieve an existing build from the database by ID."""
         if not db:
@@ -1045,4 +1572,4 @@ class Report(object):
 
 schema = BuildConfig._schema + TargetPlatform._schema + Build._schema + \
          BuildStep._schema + BuildLog._schema + Report._schema
-schema_version = 12
+schema_version = 13
@@ -21,19 +21,170 @@ platforms.
 
 from itertools import ifilter
 import re
+import threading
 import time
 
 from trac.util.datefmt import to_timestamp
 from trac.util import pretty_timedelta, format_datetime
-from trac.attachment import Attachment
+from trac.versioncontrol import NoSuchChangeset
 
 
-from bitten.model import BuildConfig, TargetPlatform, Build, BuildStep
+from bitten.model import BuildConfig, TargetPlatform, Build
 
 __docformat__ = 'restructuredtext en'
 
 
-def collect_changes(repos, config, db=None):
+# Whether a repository directory is empty at a given revision never changes,
+# so the answers are kept for the lifetime of the process
+_empty_dirs = {}
+_EMPTY_DIRS_CACHE_SIZE = 10000
+
+def _is_empty_dir(env, repos, path, rev):
+    """Return whether the repository directory `path` is empty at revision
+    `rev`."""
+    key = (env.path, getattr(repos, 'reponame', None), path, str(rev))
+    try:
+        return _empty_dirs[key]
+    except KeyError:
+        pass
+
+    is_empty = True
+    for entry in repos.get_node(path, rev).get_entries():
+        is_empty = False
+        break
+
+    if len(_empty_dirs) >= _EMPTY_DIRS_CACHE_SIZE:
+        _empty_dirs.clear()
+    _empty_dirs[key] = is_empty
+    return is_empty
+
+
+class PlatformIndex(object):
+    """The compiled matching rules of the target platforms of all active
+    build configurations in an environment.
+
+    The results of matching slave properties against the rules are
+    remembered, so that repeated polls of the same slave are cheap.
+    """
+
+    # Maximum number of remembered matching results
+    max_matches = 1000
+
+    def __init__(self, env):
+        self.env = env
+        self.created = time.time()
+        self.platforms = []
+        self.propnames = set()
+        self._matches = {}
+
+        for config in BuildConfig.select(env):
+            for platform in TargetPlatform.select(env, config=config.name):
+                rules = []
+                for propname, pattern in ifilter(None, platform.rules):
+                    try:
+                        rules.append((propname, re.compile(pattern, re.I)))
+                    except re.error:
+                        env.log.error('Invalid platform matching pattern "%s"',
+                                      pattern, exc_info=True)
+                        rules = None
+                        break
+                    self.propnames.add(propname)
+                if rules is not None:
+                    self.platforms.append((config, platform, rules))
+
+    def match(self, properties):
+        """Return the list of ``(config, platform)`` tuples of the target
+        platforms that match the given slave properties."""
+        key = tuple([(propname, properties.get(propname))
+                     for propname in sorted(self.propnames)])
+        try:
+            return self._matches[key]
+        except KeyError:
+            pass
+
+        matches = []
+        for config, platform, rules in self.platforms:
+            for propname, regexp in rules:
+                propvalue = properties.get(propname)
+                if not propvalue or not regexp.match(propvalue):
+                    break
+            else:
+                matches.append((config, platform))
+
+        if len(self._matches) >= self.max_matches:
+            self._matches.clear()
+        self._matches[key] = matches
+        return matches
+
+
+# Platform indexes by environment path
+_platform_indexes = {}
+_platform_indexes_lock = threading.Lock()
+
+# Maximum age of a platform index in seconds, so that changes made by other
+# processes are eventually picked up
+_PLATFORM_INDEX_TTL = 60
+
+def get_platform_index(env):
+    """Return the `PlatformIndex` of the environment, building it if needed."""
+    _platform_indexes_lock.acquire()
+    try:
+        index = _platform_indexes.get(env.path)
+        if index is None or \
+                index.created + _PLATFORM_INDEX_TTL < time.time():
+            index = _platform_indexes[env.path] = PlatformIndex(env)
+        return index
+    finally:
+        _platform_indexes_lock.release()
+
+def invalidate_platform_index(env):
+    """Discard the `PlatformIndex` of the environment, for example after a
+    build configuration or target platform has been changed."""
+    _platform_indexes_lock.acquire()
+    try:
+        _platform_indexes.pop(env.path, None)
+    finally:
+        _platform_indexes_lock.release()
+
+
+# Time of the last orphaned build sweep by environment path
+_orphan_sweeps = {}
+
+# Minimum number of seconds between two orphaned build sweeps
+_ORPHAN_SWEEP_INTERVAL = 60
+
+
+# Time of the last sweep for obsolete builds by environment path
+_obsolete_sweeps = {}
+
+# Minimum number of seconds between two obsolete build sweeps
+_OBSOLETE_SWEEP_INTERVAL = 60
+
+
+# Signalled whenever builds may have become pending, to wake up requests of
+# build slaves that are waiting for a build (long polling)
+_pending_builds = threading.Condition()
+
+def notify_pending_builds():
+    """Wake up all requests of this process that are waiting for a pending
+    build."""
+    _pending_builds.acquire()
+    try:
+        _pending_builds.notifyAll()
+    finally:
+        _pending_builds.release()
+
+def wait_for_pending_builds(timeout):
+    """Block until `notify_pending_builds()` is called or `timeout` seconds
+    have passed."""
+    _pending_builds.acquire()
+    try:
+        _pending_builds.wait(timeout)
+    finally:
+        _pending_builds.release()
+
+
+def collect_changes(repos, config, db=None, newer_than=None):
     """Collect all changes for a build configuration that either have already
     been built, or still need to be built.
     
@@ -44,6 +195,12 @@ def collect_changes(repos, config, db=None):
     :param repos: the version control repository
     :param config: the build configuration
     :param db: a database connection (optional)
+    :param newer_than: only collect changes more recent than this revision
+                       (optional)
+
+    The target platforms and the existing builds of the configuration are
+    loaded once, when the first change is found, rather than queried for every
+    revision.
     """
     env = config.env
     if not db:
@@ -55,6 +212,7 @@ def collect_changes(repos, config, db=None):
                     config.path, config.name, exc_info=True)
         return
 
+    platforms = builds = None
     for path, rev, chg in node.get_history():
 
         # Don't follow moves/copies
@@ -67,27 +225,26 @@ def collect_changes(repos, config, db=None):
         if config.max_rev and repos.rev_older_than(config.max_rev, rev):
             continue
 
+        # Stop at changes that have already been examined
+        if newer_than is not None and \
+                not repos.rev_older_than(newer_than, rev):
+            break
+
         # Make sure the repository directory isn't empty at this
         # revision
-        old_node = repos.get_node(path, rev)
-        is_empty = True
-        for entry in old_node.get_entries():
-            is_empty = False
-            break
-        if is_empty:
+        if _is_empty_dir(env, repos, path, rev):
             continue
 
+        if platforms is None:
+            platforms = list(TargetPlatform.select(env, config.name, db=db))
+            builds = {}
+            for build in Build.select(env, config=config.name, db=db):
+                builds[(build.rev, build.platform)] = build
+
         # For every target platform, check whether there's a build
         # of this revision
-        for platform in TargetPlatform.select(env, config.name, db=db):
-            builds = list(Build.select(env, config.name, rev, platform.id,
-                                       db=db))
-            if builds:
-                build = builds[0]
-            else:
-                build = None
-
-            yield platform, rev, build
+        for platform in platforms:
+            yield platform, rev, builds.get((str(rev), platform.id))
 
 
 class BuildQueue(object):
@@ -134,38 +291,77 @@ class BuildQueue(object):
         assert repos, 'No "(default)" Repository: Add a repository or alias ' \
                       'named "(default)" to Trac.'
 
-        self.reset_orphaned_builds()
+        self._sweep_orphaned_builds()
 
-        # Iterate through pending builds by descending revision timestamp, to
-        # avoid the first configuration/platform getting all the builds
         platforms = [p.id for p in self.match_slave(name, properties)]
-        builds_to_delete = []
-        build_found = False
-        for build in Build.select(self.env, status=Build.PENDING, db=db):
-            if self.should_delete_build(build, repos):
-                self.log.info('Scheduling build %d for deletion', build.id)
-                builds_to_delete.append(build)
-            elif build.platform in platforms:
-                build_found = True
+
+        # Let the database pick the pending build with the most recent
+        # revision timestamp, to avoid the first configuration/platform
+        # getting all the builds. It only picks builds of existing platforms
+        # and active configurations, and unless `build_all` is set, the most
+        # recent build of a platform, so only the revision range is left to
+        # check here.
+        build = None
+        configs = {}
+        while platforms:
+            build = self._next_pending_build(platforms, db)
+            if build is None:
                 break
-        if not build_found:
+            if build.config not in configs:
+                configs[build.config] = BuildConfig.fetch(self.env,
+                                                          build.config, db=db)
+            if self._outside_rev_range(configs[build.config], build.rev,
+                                       repos):
+                self.log.info('Deleting obsolete build %d', build.id)
+                Build.delete_many(self.env, [build.id], status=Build.PENDING,
+                                  db=db)
+                db.commit()
+                continue
+            if build.claim(name, db=db):
+                break
+            # Another request got there first, try the next candidate
+            self.log.debug('Build %d has already been claimed', build.id)
+            db.rollback()
+
+        if not build:
             self.log.debug('No pending builds.')
-            build = None
+            return None
 
-        # delete any obsolete builds
-        for build_to_delete in builds_to_delete:
-            build_to_delete.delete(db=db)
+        build.slave_info.update(properties)
+        build.update(db=db)
+        db.commit()
 
-        if build:
-            build.slave = name
-            build.slave_info.update(properties)
-            build.status = Build.IN_PROGRESS
-            build.update(db=db)
+        return build
 
-        if build or builds_to_delete:
-            db.commit()
+    def _next_pending_build(self, platforms, db):
+        """Return the pending build with the most recent revision timestamp
+        for one of the given target platforms, or `None` if there is none.
 
-        return build
+        Only builds of active configurations are considered, and, unless
+        `build_all` is set, only the most recent build of every configuration
+        and platform.
+        """
+        where_clauses = ["b.status=%s", "c.active=1",
+                         "b.platform IN (%s)" % ",".join(["%s"] * len(platforms))]
+        args = [Build.PENDING] + list(platforms)
+        if not self.build_all:
+            where_clauses.append("NOT EXISTS (SELECT * FROM bitten_build AS n "
+                                 "WHERE n.config=b.config "
+                                 "AND n.platform=b.platform "
+                                 "AND (n.rev_time>b.rev_time OR "
+                                 "(n.rev_time=b.rev_time AND n.id>b.id)))")
+
+        cursor = db.cursor()
+        cursor.execute("SELECT b.id FROM bitten_build AS b "
+                       "INNER JOIN bitten_config AS c ON (c.name=b.config) "
+                       "INNER JOIN bitten_platform AS p "
+                       "ON (p.id=b.platform) "
+                       "WHERE %s ORDER BY b.rev_time DESC,b.config,b.slave "
+                       "LIMIT 1" % " AND ".join(where_clauses), args)
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return Build.fetch(self.env, row[0], db=db)
 
     def match_slave(self, name, properties):
         """Match a build slave against available target platforms.
@@ -178,26 +374,11 @@ class BuildQueue(object):
         """
         platforms = []
 
-        for config in BuildConfig.select(self.env):
-            for platform in TargetPlatform.select(self.env, config=config.name):
-                match = True
-                for propname, pattern in ifilter(None, platform.rules):
-                    try:
-                        propvalue = properties.get(propname)
-                        if not propvalue or not re.match(pattern,
-                                                         propvalue, re.I):
-                            match = False
-                            break
-                    except re.error:
-                        self.log.error('Invalid platform matching pattern "%s"',
-                                       pattern, exc_info=True)
-                        match = False
-                        break
-                if match:
-                    self.log.debug('Slave %r matched target platform %r of '
-                                   'build configuration %r', name,
-                                   platform.name, config.name)
-                    platforms.append(platform)
+        for config, platform in get_platform_index(self.env).match(properties):
+            self.log.debug('Slave %r matched target platform %r of '
+                           'build configuration %r', name,
+                           platform.name, config.name)
+            platforms.append(platform)
 
         if not platforms:
             self.log.warning('Slave %r matched none of the target platforms',
@@ -213,6 +394,11 @@ class BuildQueue(object):
         a corresponding build on each target platform. Repeatedly calling this
         method will eventually result in the entire change history of the build
         configuration being in the build queue.
+
+        The newest revision examined for every configuration is recorded, so
+        that subsequent calls only need to look at changesets more recent than
+        that. Updating a configuration or adding a target platform resets this
+        mark, triggering a full scan of the history.
         """
         repos = self.env.get_repository()
         assert repos, 'No "(default)" Repository: Add a repository or alias ' \
@@ -220,43 +406,29 @@ class BuildQueue(object):
 
         db = self.env.get_db_cnx()
         builds = []
+        scanned = []
 
         for config in BuildConfig.select(self.env, db=db):
-            platforms = []
-            for platform, rev, build in collect_changes(repos, config, db):
-
-                if not self.build_all and platform.id in platforms:
-                    # We've seen this platform already, so these are older
-                    # builds that should only be built if built_all=True
-                    self.log.debug('Ignoring older revisions for configuration '
-                                   '%r on %r', config.name, platform.name)
-                    break
-
-                platforms.append(platform.id)
-
-                if build is None:
-                    self.log.info('Enqueuing build of configuration "%s" at '
-                                  'revision [%s] on %s', config.name, rev,
-                                  platform.name)
-
-                    rev_time = to_timestamp(repos.get_changeset(rev).date)
-                    age = int(time.time()) - rev_time
-                    if self.stabilize_wait and age < self.stabilize_wait:
-                        self.log.info('Delaying build of revision %s until %s '
-                                      'seconds pass. Current age is: %s '
-                                      'seconds' % (rev, self.stabilize_wait,
-                                      age))
-                        continue
-
-                    build = Build(self.env, config=config.name,
-                                  platform=platform.id, rev=str(rev),
-                                  rev_time=rev_time)
-                    builds.append(build)
-
+            scanned_rev = config.get_scanned_rev(db=db)
+            try:
+                config_builds, newest_rev = self._collect_builds(repos,
+                                                    config, scanned_rev, db)
+            except NoSuchChangeset:
+                self.log.warning('Revision [%s] of configuration "%s" no '
+                                 'longer exists, rescanning the history',
+                                 scanned_rev, config.name)
+                config_builds, newest_rev = self._collect_builds(repos,
+                                                    config, None, db)
+            builds.extend(config_builds)
+            if newest_rev is not None:
+                scanned.append((config, newest_rev))
+
+        inserted = 0
         for build in builds:
             try:
                 build.insert(db=db)
                 db.commit()
+                inserted += 1
             except Exception, e:
                 # really only want to catch IntegrityErrors raised when
                 # a second slave attempts to add builds with the same
@@ -265,6 +437,169 @@ class BuildQueue(object):
                     'at revision [%s] on platform [%s]: %s',
                     build.config, build.rev, build.platform, e)
                 db.rollback()
+        if inserted:
+            notify_pending_builds()
+
+        for config, rev in scanned:
+            try:
+                config.set_scanned_rev(rev, db=db)
+                db.commit()
+            except Exception, e:
+                # another process may be recording the same revision
+                self.log.info('Failed to record scanned revision [%s] of '
+                    'configuration "%s": %s', rev, config.name, e)
+                db.rollback()
+
+        self._sweep_obsolete_builds()
+
+    def _collect_builds(self, repos, config, scanned_rev, db):
+        """Determine the builds that need to be added to the queue for a
+        build configuration.
+
+        Only changes more recent than `scanned_rev` are examined, unless it is
+        `None`, in which case the whole history of the configuration is
+        scanned.
+
+        :return: a ``(builds, newest_rev)`` tuple, where ``builds`` is the list
+                 of new `Build` objects, and ``newest_rev`` is the revision up
+                 to which the history has been fully handled, or `None` if
+                 the high-water mark should not be advanced
+        """
+        builds = []
+        platforms = []
+        newest_rev = None
+        delayed = False
+        for platform, rev, build in collect_changes(repos, config, db,
+                                                    newer_than=scanned_rev):
+            if newest_rev is None:
+                newest_rev = rev
+
+            if not self.build_all and platform.id in platforms:
+                # We've seen this platform already, so these are older
+                # builds that should only be built if built_all=True
+                self.log.debug('Ignoring older revisions for configuration '
+                               '%r on %r', config.name, platform.name)
+                break
+
+            platforms.append(platform.id)
+
+            if build is None:
+                self.log.info('Enqueuing build of configuration "%s" at '
+                              'revision [%s] on %s', config.name, rev,
+                              platform.name)
+
+                rev_time = to_timestamp(repos.get_changeset(rev).date)
+                age = int(time.time()) - rev_time
+                if self.stabilize_wait and age < self.stabilize_wait:
+                    self.log.info('Delaying build of revision %s until %s '
+                                  'seconds pass. Current age is: %s '
+                                  'seconds' % (rev, self.stabilize_wait,
+                                  age))
+                    # The revision needs to be looked at again later
+                    delayed = True
+                    continue
+
+                build = Build(self.env, config=config.name,
+                              platform=platform.id, rev=str(rev),
+                              rev_time=rev_time)
+                builds.append(build)
+
+        if delayed:
+            newest_rev = None
+        return builds, newest_rev
+
+    def _sweep_obsolete_builds(self):
+        """Call `delete_obsolete_builds()` unless that has already been done
+        recently in this process.
+
+        Obsolete builds are never handed out to slaves anyway, so there is no
+        need to look for them every time the queue is populated.
+        """
+        last_sweep = _obsolete_sweeps.get(self.env.path)
+        if last_sweep and last_sweep + _OBSOLETE_SWEEP_INTERVAL > time.time():
+            return
+        _obsolete_sweeps[self.env.path] = time.time()
+        self.delete_obsolete_builds()
+
+    def delete_obsolete_builds(self):
+        """Remove all pending builds that should no longer be built.
+
+        These are builds for target platforms or configurations that no
+        longer exist, of deactivated configurations, of revisions outside the
+        revision range of the configuration, and, unless `build_all` is set,
+        builds for which a more recent build of the same configuration and
+        platform exists.
+
+        :return: the number of builds that have been removed
+        """
+        repos = self.env.get_repository()
+        assert repos, 'No "(default)" Repository: Add a repository or alias ' \
+                      'named "(default)" to Trac.'
+
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("SELECT b.id,b.config,b.rev,b.platform "
+                       "FROM bitten_build AS b "
+                       "LEFT OUTER JOIN bitten_config AS c "
+                       "ON (c.name=b.config) "
+                       "LEFT OUTER JOIN bitten_platform AS p "
+                       "ON (p.id=b.platform) "
+                       "WHERE b.status=%s AND (c.name IS NULL OR "
+                       "COALESCE(c.active,0)=0 OR p.id IS NULL)",
+                       (Build.PENDING,))
+        obsolete = cursor.fetchall()
+
+        if not self.build_all:
+            cursor.execute("SELECT b.id,b.config,b.rev,b.platform "
+                           "FROM bitten_build AS b "
+                           "WHERE b.status=%s AND EXISTS (SELECT * "
+                           "FROM bitten_build AS n WHERE n.config=b.config "
+                           "AND n.platform=b.platform "
+                           "AND (n.rev_time>b.rev_time OR "
+                           "(n.rev_time=b.rev_time AND n.id>b.id)))",
+                           (Build.PENDING,))
+            obsolete += cursor.fetchall()
+
+        # The revision range can only be checked against the repository
+        for config in BuildConfig.select(self.env, db=db):
+            if not (config.min_rev or config.max_rev):
+                continue
+            cursor.execute("SELECT id,config,rev,platform FROM bitten_build "
+                           "WHERE config=%s AND status=%s",
+                           (config.name, Build.PENDING))
+            for row in cursor.fetchall():
+                if self._outside_rev_range(config, row[2], repos):
+                    obsolete.append(row)
+
+        builds = dict([(int(row[0]), row) for row in obsolete])
+        deleted = Build.delete_many(self.env, builds.keys(),
+                                    status=Build.PENDING, db=db)
+        db.commit()
+        for build_id in sorted(deleted):
+            self.log.info('Dropping obsolete build of configuration "%s" '
+                          'at revision [%s] on platform %s',
+                          *builds[build_id][1:])
+        return len(deleted)
+
+    def _outside_rev_range(self, config, rev, repos):
+        """Whether the revision is outside of the revision range of the build
+        configuration."""
+        return bool(config and (
+                (config.min_rev and repos.rev_older_than(rev,
+                                                         config.min_rev)) or
+                (config.max_rev and repos.rev_older_than(config.max_rev,
+                                                         rev))))
+
+    def _sweep_orphaned_builds(self):
+        """Call `reset_orphaned_builds()` unless that has already been done
+        recently in this process."""
+        if not self.timeout:
+            return
+        last_sweep = _orphan_sweeps.get(self.env.path)
+        interval = min(_ORPHAN_SWEEP_INTERVAL, self.timeout)
+        if last_sweep and last_sweep + interval > time.time():
+            return
+        self.reset_orphaned_builds()
 
     def reset_orphaned_builds(self):
         """Reset all in-progress builds to ``PENDING`` state if they've been
@@ -273,36 +608,40 @@ class BuildQueue(object):
         This is used to cleanup after slaves that have unexpectedly cancelled
         a build without notifying the master, or are for some other reason not
         reporting back status updates.
+
+        :return: the number of builds that have been reset
         """
         if not self.timeout:
             # If no timeout is set, none of the in-progress builds can be
             # considered orphaned
-            return
+            return 0
 
+        started = time.time()
         db = self.env.get_db_cnx()
-        now = int(time.time())
-        for build in Build.select(self.env, status=Build.IN_PROGRESS, db=db):
-            if now - build.last_activity < self.timeout:
-                # This build has not reached the timeout yet, assume it's still
-                # being executed
-                continue
-
-            self.log.info('Orphaning build %d. Last activity was %s (%s)' % \
-                              (build.id, format_datetime(build.last_activity),
-                               pretty_timedelta(build.last_activity)))
-
-            build.status = Build.PENDING
-            build.slave = None
-            build.slave_info = {}
-            build.started = 0
-            build.stopped = 0
-            build.last_activity = 0
-            for step in list(BuildStep.select(self.env, build=build.id, db=db)):
-                step.delete(db=db)
-            build.update(db=db)
-
-            Attachment.delete_all(self.env, 'build', build.resource.id, db)
+        cursor = db.cursor()
+        deadline = int(started) - self.timeout
+        cursor.execute("SELECT id,last_activity FROM bitten_build "
+                       "WHERE status=%s AND last_activity<=%s",
+                       (Build.IN_PROGRESS, deadline))
+        activity = dict(cursor.fetchall())
+        orphans = []
+        if activity:
+            # Builds that report activity or complete in the meantime, or
+            # that are reset by another process, are left alone
+            orphans = Build.reset_many(self.env, activity.keys(),
+                                       last_activity=deadline, db=db)
         db.commit()
+        for build_id in orphans:
+            self.log.info('Orphaned build %d. Last activity was %s (%s)' % \
+                              (build_id, format_datetime(activity[build_id]),
+                               pretty_timedelta(activity[build_id])))
+        if orphans:
+            notify_pending_builds()
+
+        _orphan_sweeps[self.env.path] = started
+        self.log.debug('Orphaned build sweep reset %d builds in %.3f seconds',
+                       len(orphans), time.time() - started)
+        return len(orphans)
 
     def should_delete_build(self, build, repos):
         config = BuildConfig.fetch(self.env, build.config)
@@ -318,7 +657,7 @@ class BuildQueue(object):
         if not platform:
             self.log.info('Dropping build of configuration "%s" at '
                      'revision [%s] on %s because the platform no longer '
-                     'exists', config.name, build.rev, platform_name)
+                     'exists', config_name, build.rev, platform_name)
             return True
 
         # Ignore pending builds for deactived build configs
@@ -329,22 +668,29 @@ class BuildQueue(object):
             return True
 
         # Stay within the revision limits of the build config
-        if (config.min_rev and repos.rev_older_than(build.rev,
-                                                    config.min_rev)) \
-        or (config.max_rev and repos.rev_older_than(config.max_rev,
-                                                    build.rev)):
+        if self._outside_rev_range(config, build.rev, repos):
             self.log.info('Dropping build of configuration "%s" at revision [%s] on '
                      '"%s" because it is outside of the revision range of the '
                      'configuration', config.name, build.rev, platform_name)
             return True
 
         # If not 'build_all', drop if a more recent revision is available
-        if not self.build_all and \
-                len(list(Build.select(self.env, config=build.config,
-                min_rev_time=build.rev_time, platform=build.platform))) > 1:
+        if not self.build_all and self._has_newer_build(build):
             self.log.info('Dropping build of configuration "%s" at revision [%s] '
                      'on "%s" because a more recent build exists',
                          config.name, build.rev, platform_name)
             return True
 
         return False
+
+    def _has_newer_build(self, build):
+        """Whether a more recent build of the same configuration and platform
+        exists."""
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("SELECT COUNT(*) FROM bitten_build WHERE config=%s "
+                       "AND platform=%s AND (rev_time>%s OR "
+                       "(rev_time=%s AND id>%s))",
+                       (build.config, build.platform, build.rev_time,
+                        build.rev_time, build.id))
+        return cursor.fetchone()[0] > 0
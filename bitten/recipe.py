@@ -25,7 +25,7 @@ except NameError:
     from sets import Set as set
 
 from pkg_resources import WorkingSet
-from bitten.build import BuildError, TimeoutError
+from bitten.build import BuildError, FileIndex, FileSet, TimeoutError
 from bitten.build.config import Configuration
 from bitten.util import xmlio
 
@@ -44,6 +44,8 @@ class Context(object):
 
     step = None # The current step
     generator = None # The current generator (namespace#name)
+    log_handler = None # Called with the generator and XML of log output as
+                       # soon as it is recorded, instead of collecting it
 
     def __init__(self, basedir, config=None, vars=None):
         """Initialize the context.
@@ -59,6 +61,7 @@ class Context(object):
         self.basedir = os.path.realpath(self.config.interpolate(basedir,
                                                                 **self.vars))
         self.vars['basedir'] = self.basedir.replace('\\', '\\\\')
+        self.file_index = FileIndex(self.basedir)
 
     def run(self, step, namespace, name, attr):
         """Run the specified recipe command.
@@ -108,6 +111,8 @@ class Context(object):
         finally:
             self.generator = None
             self.step = None
+            # The command may have added or removed files
+            self.file_index.touch()
 
     def error(self, message):
         """Record an error message.
@@ -121,7 +126,10 @@ class Context(object):
         
         :param xml: an XML fragment containing the log messages
         """
-        self.output.append((Recipe.LOG, None, self.generator, xml))
+        if self.log_handler is not None:
+            self.log_handler(self.generator, xml)
+        else:
+            self.output.append((Recipe.LOG, None, self.generator, xml))
 
     def report(self, category, xml):
         """Record report data.
@@ -181,6 +189,21 @@ class Context(object):
                                 resource=resource or 'build')
         self.output.append((Recipe.ATTACH, None, None, xml_elem))
 
+    def fileset(self, include=None, exclude=None):
+        """Return the set of files in the base directory matching the given
+        patterns.
+        
+        The directory is only walked once per build, unless files are added or
+        removed, so this should be preferred over creating a `FileSet`
+        directly.
+        
+        :param include: a list of patterns that define which files should be
+                        included in the set
+        :param exclude: a list of patterns that define which files should be
+                        excluded from the set
+        """
+        return FileSet(self.basedir, include, exclude, index=self.file_index)
+
     def resolve(self, *path):
         """Return the path of a file relative to the base directory.
         
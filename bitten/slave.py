@@ -12,11 +12,15 @@
 
 from datetime import datetime
 import errno
+import gzip
+import httplib
 import urllib
 import urllib2
 import logging
 import os
 import platform
+import Queue
+import select
 import shutil
 import socket
 import sys
@@ -26,6 +30,7 @@ import re
 import cookielib
 import threading
 import mimetools
+from StringIO import StringIO
 from ConfigParser import MissingSectionHeaderError
 
 from bitten import PROTOCOL_VERSION
@@ -52,6 +57,10 @@ log = logging.getLogger('bitten.slave')
 temp_net_errors = [errno.ENETUNREACH, errno.ENETDOWN, errno.ETIMEDOUT,
                    errno.ECONNREFUSED]
 
+# Number of times the upload of an attachment chunk is retried after a network
+# error or a conflicting upload offset.
+UPLOAD_RETRIES = 5
+
 def _rmtree(root):
     """Catch shutil.rmtree failures on Windows when files are read-only, and only remove if root exists."""
     def _handle_error(fn, path, excinfo):
@@ -63,6 +72,17 @@ def _rmtree(root):
         return False
 
 
+def _gzip(data):
+    """Return the data compressed in gzip format."""
+    buf = StringIO()
+    gzfile = gzip.GzipFile(fileobj=buf, mode='wb')
+    try:
+        gzfile.write(data)
+    finally:
+        gzfile.close()
+    return buf.getvalue()
+
+
 class SaneHTTPRequest(urllib2.Request):
 
     def __init__(self, method, url, data=None, headers={}):
@@ -75,6 +95,202 @@ class SaneHTTPRequest(urllib2.Request):
         return self.method
 
 
+class ConnectionPool(object):
+    """Idle persistent HTTP connections, kept per host so that later requests
+    to the same build master can reuse them instead of connecting again.
+
+    A connection is handed out to one request at a time, so the pool can be
+    shared between threads.
+    """
+
+    max_idle = 4
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return an idle connection for the given key, or `None`.
+
+        Connections that the server has closed in the meantime are discarded.
+        """
+        while True:
+            self.lock.acquire()
+            try:
+                idle = self.connections.get(key)
+                if not idle:
+                    return None
+                conn = idle.pop()
+            finally:
+                self.lock.release()
+            if not _is_dropped(conn):
+                return conn
+            conn.close()
+
+    def put(self, key, conn):
+        """Return a connection to the pool after a complete response has been
+        read from it."""
+        self.lock.acquire()
+        try:
+            idle = self.connections.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        self.lock.acquire()
+        try:
+            for idle in self.connections.values():
+                for conn in idle:
+                    conn.close()
+            self.connections.clear()
+        finally:
+            self.lock.release()
+
+
+def _is_dropped(conn):
+    """Return whether the server has closed an idle connection.
+
+    An idle connection only becomes readable when the server closes it (or
+    sends something unexpected), either way it cannot be used any more.
+    """
+    if conn.sock is None:
+        return False
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, socket.error):
+        return True
+
+
+# Requests that can safely be sent again if the connection is lost before the
+# response arrives
+_IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+
+class _PooledConnectionsMixin:
+    """Replacement for `urllib2.AbstractHTTPHandler.do_open` that takes
+    connections from a `ConnectionPool`, rather than opening a new connection
+    for every request and asking the server to close it afterwards."""
+
+    def do_open(self, http_class, req, **http_conn_args):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        tunnel_host = getattr(req, '_tunnel_host', None)
+        tunnel_headers = {}
+        if tunnel_host and 'Proxy-Authorization' in headers:
+            # Proxy-Authorization should not be sent to origin server
+            tunnel_headers['Proxy-Authorization'] = \
+                    headers.pop('Proxy-Authorization')
+
+        key = (http_class, host, tunnel_host)
+        while True:
+            conn = self.pool.get(key)
+            reused = conn is not None
+            if not reused:
+                conn = self._connect(http_class, host, req, tunnel_host,
+                                     tunnel_headers, http_conn_args)
+            if hasattr(req.data, 'reset'):
+                # Send a streamed body from the start again
+                req.data.reset()
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data,
+                             headers)
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                if reused:
+                    # The server closed the idle connection in the meantime,
+                    # so it cannot have received the complete request
+                    log.debug('Reconnecting to %s: %s', host, e)
+                    continue
+                raise urllib2.URLError(e)
+            try:
+                resp = conn.getresponse()
+                # Responses of the master are small, and reading them
+                # completely frees the connection for the next request
+                data = resp.read()
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                if reused and isinstance(e, httplib.BadStatusLine) and \
+                        req.get_method() in _IDEMPOTENT_METHODS:
+                    # The server may have closed the idle connection without
+                    # handling the request, which can safely be repeated
+                    log.debug('Reconnecting to %s: %s', host, e)
+                    continue
+                raise urllib2.URLError(e)
+            break
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self.pool.put(key, conn)
+
+        fp = urllib2.addinfourl(StringIO(data), resp.msg,
+                                req.get_full_url())
+        fp.code = resp.status
+        fp.msg = resp.reason
+        return fp
+
+    def _connect(self, http_class, host, req, tunnel_host, tunnel_headers,
+                 http_conn_args):
+        """Create a new connection for the request.
+
+        Request timeouts only exist as of Python 2.6, and connecting through
+        a proxy tunnel as of Python 2.6.3 (where the method is still called
+        ``_set_tunnel()``), so they are only used where available.
+        """
+        if hasattr(req, 'timeout'):
+            http_conn_args = dict(http_conn_args, timeout=req.timeout)
+        conn = http_class(host, **http_conn_args)
+        conn.set_debuglevel(self._debuglevel)
+        if tunnel_host:
+            set_tunnel = getattr(conn, 'set_tunnel', None) or \
+                         getattr(conn, '_set_tunnel')
+            set_tunnel(tunnel_host, headers=tunnel_headers)
+        return conn
+
+
+class PooledHTTPHandler(_PooledConnectionsMixin, urllib2.HTTPHandler):
+    """HTTP handler that reuses connections from a `ConnectionPool`."""
+
+    def __init__(self, pool, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool
+
+
+if hasattr(urllib2, 'HTTPSHandler'):
+
+    class PooledHTTPSHandler(_PooledConnectionsMixin, urllib2.HTTPSHandler):
+        """HTTPS handler that reuses connections from a `ConnectionPool`, which
+        also saves the TLS handshakes."""
+
+        def __init__(self, pool, debuglevel=0):
+            urllib2.HTTPSHandler.__init__(self, debuglevel)
+            self.pool = pool
+
+else:
+    PooledHTTPSHandler = None
+
+
+_MULTIPART_FIELD = "--%(boundary)s\r\n" \
+    "Content-Disposition: form-data; name=\"%(name)s\"\r\n" \
+    "\r\n%(value)s\r\n"
+_MULTIPART_FILE = "--%(boundary)s\r\n" \
+    "Content-Disposition: form-data; name=\"%(name)s\"; " \
+            "filename=\"%(filename)s\"\r\n" \
+    "Content-Type: %(contenttype)s\r\n" \
+    "\r\n"
+
 def encode_multipart_formdata(fields):
     """
     Given a dictionary field parameters, returns the HTTP request body and the
@@ -96,28 +312,19 @@ def encode_multipart_formdata(fields):
     """
 
     BOUNDARY = mimetools.choose_boundary()
-    ENCODE_TEMPLATE= "--%(boundary)s\r\n" \
-        "Content-Disposition: form-data; name=\"%(name)s\"\r\n" \
-        "\r\n%(value)s\r\n"
-    ENCODE_TEMPLATE_FILE = "--%(boundary)s\r\n" \
-        "Content-Disposition: form-data; name=\"%(name)s\"; " \
-                "filename=\"%(filename)s\"\r\n" \
-        "Content-Type: %(contenttype)s\r\n" \
-        "\r\n%(value)s\r\n"
 
     body = ""
     for key, value in fields.iteritems():
         if isinstance(value, tuple):
             filename, value = value
-            body += ENCODE_TEMPLATE_FILE % {
+            body += _MULTIPART_FILE % {
                         'boundary': BOUNDARY,
                         'name': str(key),
-                        'value': str(value),
                         'filename': str(filename),
                         'contenttype': 'application/octet-stream'
-                    }
+                    } + str(value) + '\r\n'
         else:
-            body += ENCODE_TEMPLATE % {
+            body += _MULTIPART_FIELD % {
                         'boundary': BOUNDARY,
                         'name': str(key),
                         'value': str(value)
@@ -127,6 +334,121 @@ def encode_multipart_formdata(fields):
     return body, content_type
 
 
+class StreamedBody(object):
+    """A request body that reads the content of files only while it is being
+    sent, so that large files go straight from disk to the socket.
+
+    The body is made up of parts, which are either strings, or
+    ``(fileobj, start, size)`` tuples for ``size`` bytes of a file starting at
+    offset ``start``.
+
+    >>> body = StreamedBody(['<', (StringIO('foobar'), 1, 3), '>'])
+    >>> len(body)
+    5
+    >>> body.read()
+    '<oob>'
+
+    Once the end of the body has been reached, it starts over from the
+    beginning, so that it can be sent again if the request needs to be
+    repeated (for example to authenticate).
+
+    >>> body.read()
+    ''
+    >>> body.read(3)
+    '<oo'
+    """
+
+    blocksize = 65536
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.length = 0
+        for part in self.parts:
+            if isinstance(part, tuple):
+                self.length += part[2]
+            else:
+                self.length += len(part)
+        self._index = self._offset = 0
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        """Return up to `size` bytes of the body, or the rest of the body if
+        `size` is negative."""
+        if size < 0:
+            size = self.length
+        chunks = []
+        while size > 0 and self._index < len(self.parts):
+            part = self.parts[self._index]
+            if isinstance(part, tuple):
+                fileobj, start, length = part
+                if not self._offset:
+                    fileobj.seek(start)
+                chunk = fileobj.read(min(size, length - self._offset,
+                                         self.blocksize))
+                if not chunk and self._offset < length:
+                    raise IOError('File shrunk while being uploaded')
+            else:
+                length = len(part)
+                chunk = part[self._offset:self._offset + size]
+            chunks.append(chunk)
+            size -= len(chunk)
+            self._offset += len(chunk)
+            if self._offset >= length:
+                self._index += 1
+                self._offset = 0
+        if not chunks:
+            # Start over for the next time the body is sent
+            self.reset()
+        return ''.join(chunks)
+
+    def reset(self):
+        """Start over from the beginning of the body."""
+        self._index = self._offset = 0
+
+
+class MultipartBody(StreamedBody):
+    """A ``multipart/form-data`` request body, which streams the content of
+    files.
+
+    Fields are given as for `encode_multipart_formdata`, except that the value
+    tuple of a file is a ``(filename, fileobj, size)`` tuple. The body covers
+    ``size`` bytes of the file, starting at its current position.
+
+    >>> body = MultipartBody({'file': ('foo.txt', StringIO('foobar'), 3)})
+    >>> data = body.read()
+    >>> len(data) == len(body)
+    True
+    >>> 'foo\\r\\n--' in data, 'bar' in data
+    (True, False)
+    """
+
+    def __init__(self, fields):
+        boundary = mimetools.choose_boundary()
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+        parts = []
+        for key, value in fields.iteritems():
+            if isinstance(value, tuple):
+                filename, fileobj, size = value
+                parts.append(_MULTIPART_FILE % {
+                    'boundary': boundary,
+                    'name': str(key),
+                    'filename': str(filename),
+                    'contenttype': 'application/octet-stream'
+                })
+                parts.append((fileobj, fileobj.tell(), size))
+                parts.append('\r\n')
+            else:
+                parts.append(_MULTIPART_FIELD % {
+                    'boundary': boundary,
+                    'name': str(key),
+                    'value': str(value)
+                })
+        parts.append('--%s--\r\n' % boundary)
+        StreamedBody.__init__(self, parts)
+
+
 class KeepAliveThread(threading.Thread):
     "A thread to periodically send keep-alive messages to the master"
     
@@ -182,6 +504,298 @@ class KeepAliveThread(threading.Thread):
         log.debug('Keepalive thread stopped')
         
 
+class ResultUploader(threading.Thread):
+    """Sends the results of build steps and attachments to the master in the
+    background, so that the build can go on while they are being uploaded.
+
+    Everything is written to a spool directory first, and sent in the order
+    in which it was queued. While the master cannot be reached, uploads are
+    retried with increasing delays for up to `timeout` seconds, so that a
+    restart of the master does not cost the build. Once the master rejects a
+    step result, or it could not be sent in time, the error is raised in the
+    build thread and later uploads are dropped. A step result that the master
+    rejects as already processed after it had to be sent again is considered
+    delivered. Attachments that cannot be sent only fail the step they
+    belong to, see `attach_errors()`.
+    """
+
+    max_delay = 300
+
+    def __init__(self, slave, spool_dir, timeout=3600):
+        threading.Thread.__init__(self, None, None, "ResultUploader")
+        self.setDaemon(True)
+        self.slave = slave
+        self.spool_dir = spool_dir
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+        self.timeout = timeout
+        self.queue = Queue.Queue()
+        # Notified whenever a queued upload has been handled
+        self.lock = threading.Condition()
+        self.sequence = 0
+        self.count = 0
+        self.error = None
+        self._attach_errors = []
+        self.aborted = False
+        self.wakeup = threading.Event()
+
+    def _spool(self):
+        """Return the path of the spool file for the next upload."""
+        self.check()
+        self.lock.acquire()
+        try:
+            self.sequence += 1
+            self.count += 1
+        finally:
+            self.lock.release()
+        return os.path.join(self.spool_dir, '%04d' % self.sequence)
+
+    def upload(self, url, body, headers, compress=False):
+        """Queue a step result for upload.
+
+        The body is either a string, or an XML element that is serialized
+        straight into the spool. If `compress` is true, it is compressed in
+        gzip format.
+        """
+        path = self._spool()
+        fileobj = open(path, 'wb')
+        try:
+            out = fileobj
+            if compress:
+                out = gzip.GzipFile(fileobj=fileobj, mode='wb')
+            try:
+                if isinstance(body, basestring):
+                    out.write(body)
+                else:
+                    body.write(out)
+            finally:
+                if compress:
+                    out.close()
+        finally:
+            fileobj.close()
+        self.queue.put((self._send_result, url, path, headers))
+
+    def attach(self, url, fields, filename, fileobj):
+        """Queue the upload of a file as the ``file`` field of a form."""
+        path = self._spool()
+        spooled = open(path, 'wb')
+        try:
+            shutil.copyfileobj(fileobj, spooled)
+        finally:
+            spooled.close()
+        self.queue.put((self._send_attachment, url, path, fields, filename))
+
+    def pending(self):
+        """Whether there are uploads that have not been sent yet."""
+        return self.count > 0
+
+    def check(self):
+        """Raise the error of a failed upload, if any."""
+        if self.error is not None:
+            raise self.error
+
+    def drain(self):
+        """Wait until everything queued so far has been sent."""
+        self.lock.acquire()
+        try:
+            while self.count > 0 and self.isAlive():
+                self.lock.wait(1)
+        finally:
+            self.lock.release()
+
+    def attach_errors(self):
+        """Return the errors of the attachments that could not be sent since
+        the last call."""
+        self.lock.acquire()
+        try:
+            errors, self._attach_errors = self._attach_errors, []
+        finally:
+            self.lock.release()
+        return errors
+
+    def close(self):
+        """Wait until everything queued has been sent, and raise the error
+        of a failed upload, if any."""
+        self.queue.put(None)
+        self.join()
+        _rmtree(self.spool_dir)
+        self.check()
+
+    def abort(self):
+        """Stop without sending what is still queued."""
+        self.aborted = True
+        self.wakeup.set()
+        self.queue.put(None)
+        if self.isAlive():
+            self.join(30)
+        _rmtree(self.spool_dir)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None and not self.aborted:
+                try:
+                    self._replay(*item)
+                except Exception, e:
+                    if not isinstance(e, (urllib2.URLError, socket.error,
+                                          BuildError)):
+                        log.error('Internal error uploading to the master',
+                                  exc_info=True)
+                    self.lock.acquire()
+                    try:
+                        if item[0] == self._send_attachment:
+                            self._attach_errors.append(e)
+                        else:
+                            self.error = e
+                    finally:
+                        self.lock.release()
+            if os.path.isfile(item[2]):
+                os.remove(item[2])
+            self.lock.acquire()
+            try:
+                self.count -= 1
+                self.lock.notifyAll()
+            finally:
+                self.lock.release()
+
+    def _replay(self, send, url, *args):
+        deadline = time.time() + self.timeout
+        delay = 1
+        failed = False
+        while True:
+            try:
+                return send(url, *args)
+            except urllib2.HTTPError, e:
+                if failed and e.code == 409 and send == self._send_result:
+                    # The master may have processed the step result before
+                    # the connection was lost, and rejects it the second time
+                    log.info('Step result sent to %s had already been '
+                             'received', url)
+                    return
+                log.error('Server rejected upload to %s (%d): %s', url,
+                          e.code, e.msg)
+                raise
+            except (urllib2.URLError, socket.error), e:
+                failed = True
+                if self.aborted or time.time() + delay > deadline:
+                    log.error('Failed to upload to %s: %s', url, e)
+                    raise
+                log.warning('Uploading to %s failed, retrying in %d seconds: '
+                            '%s', url, delay, e)
+                self.wakeup.wait(delay)
+                delay = min(delay * 2, self.max_delay)
+
+    def _send_result(self, url, path, headers):
+        fileobj = open(path, 'rb')
+        try:
+            body = StreamedBody([(fileobj, 0, os.path.getsize(path))])
+            headers = dict(headers, **{'Content-Length': str(len(body))})
+            resp = self.slave.request('POST', url, body, headers)
+        finally:
+            fileobj.close()
+        if resp.code != 201:
+            log.error('Unexpected response (%d): %s', resp.code, resp.msg)
+
+    def _send_attachment(self, url, path, fields, filename):
+        fileobj = open(path, 'rb')
+        try:
+            resp = self.slave._upload_file(url, fields, filename, fileobj,
+                                           os.path.getsize(path))
+        finally:
+            fileobj.close()
+        if resp.code != 201:
+            msg = 'Error attaching %s to %s' % (filename, url)
+            log.error(msg)
+            raise BuildError(msg)
+
+
+class LogStreamer(object):
+    """Sends the log output of a build step to the master while the step is
+    running, rather than only along with the step result.
+
+    Log output that has not been sent yet is kept in `xmlio.SpooledFragment`
+    instances, so that it does not fill up memory while the master cannot be
+    reached, and so that it can be included in the step result instead. If
+    the master does not accept the log output, the log handler of the build
+    context `ctxt` is removed, so that further output is collected with the
+    step result right away.
+    """
+
+    def __init__(self, slave, build_url, step, interval, ctxt=None):
+        self.slave = slave
+        self.url = '%s/steps/%s/log' % (build_url, urllib.quote(step.id))
+        self.interval = interval
+        self.ctxt = ctxt
+        self.pending = []
+        self.last_sent = time.time()
+        self.enabled = True
+
+    def log(self, generator, xml):
+        """Handle log output recorded by the build context."""
+        if not xml.children:
+            return
+        if not self.pending or self.pending[-1][0] != generator:
+            self.pending.append((generator, xmlio.SpooledFragment()))
+        self.pending[-1][1].append(xml)
+        if self.enabled and time.time() - self.last_sent >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Send the pending log output to the master."""
+        self.last_sent = time.time()
+        uploader = self.slave.uploader
+        if uploader is not None and uploader.pending():
+            # The master only accepts log output for the step it considers
+            # running, so wait until the results of earlier steps are in
+            return
+        while self.pending and self.enabled:
+            # Send consecutive output of the same generator as one log
+            generator = self.pending[0][0]
+            count = 1
+            while count < len(self.pending) and \
+                    self.pending[count][0] == generator:
+                count += 1
+            fileobj = tempfile.TemporaryFile()
+            try:
+                try:
+                    xmlio.Element('log', generator=generator)[
+                        [output for _, output in self.pending[:count]]
+                    ].write(fileobj)
+                    body = StreamedBody([(fileobj, 0, fileobj.tell())])
+                    self.slave.request('POST', self.url, body, {
+                        'Content-Type': 'application/x-bitten+xml',
+                        'Content-Length': str(len(body))
+                    })
+                except urllib2.HTTPError, e:
+                    if e.code in (404, 405):
+                        log.info('Build master does not accept log output '
+                                 'of running steps')
+                        self.slave.stream_logs = False
+                    else:
+                        log.warning('Server returned error %d for build '
+                                    'log: %s', e.code, e.msg)
+                    self.enabled = False
+                    if self.ctxt is not None and \
+                            self.ctxt.log_handler == self.log:
+                        self.ctxt.log_handler = None
+                    return
+                except (urllib2.URLError, socket.error), e:
+                    log.warning('Failed to send build log: %s', e)
+                    return
+            finally:
+                fileobj.close()
+            del self.pending[:count]
+
+    def close(self):
+        """Send the remaining log output, and return the output that could
+        not be sent as a list of ``(generator, xml)`` tuples."""
+        self.flush()
+        pending, self.pending = self.pending, []
+        return pending
+
+
 class BuildSlave(object):
     """HTTP client implementation for the build slave."""
 
@@ -190,7 +804,9 @@ class BuildSlave(object):
                  keep_files=False, single_build=False,
                  poll_interval=300, keepalive_interval = 60,
                  username=None, password=None,
-                 dump_reports=False, no_loop=False, form_auth=False):
+                 dump_reports=False, no_loop=False, form_auth=False,
+                 long_poll=0, log_interval=10, slots=1, slot_cpu_time=None,
+                 slot_memory=None, spool_timeout=3600):
         """Create the build slave instance.
         
         :param urls: a list of URLs of the build masters to connect to, or a
@@ -221,6 +837,27 @@ class BuildSlave(object):
                         of whether a build is done or not
         :param form_auth: login using AccountManager HTML form instead of
                                 HTTP authentication for all urls
+        :param long_poll: the time in seconds the build master may wait for a
+                          build to become available before answering a
+                          request for a build; masters that do not support
+                          this answer immediately, in which case the slave
+                          falls back to waiting `poll_interval` between
+                          requests (default is 0, disabling long polling)
+        :param log_interval: the time in seconds between sending the log
+                             output of a running build step to the master
+                             (default is 10 seconds, 0 only sends the log
+                             output with the result of the step)
+        :param slots: the number of builds to run in parallel, each in a
+                      worker process of its own (default is 1, running builds
+                      in the slave process itself)
+        :param slot_cpu_time: the CPU time in seconds that each process of a
+                              build running in a slot may use
+        :param slot_memory: the address space in megabytes that each process
+                            of a build running in a slot may use
+        :param spool_timeout: the time in seconds for which step results and
+                              attachments are kept and sent again while the
+                              build master cannot be reached (default is one
+                              hour)
         """
         self.local = len(urls) == 1 and not urls[0].startswith('http://') \
                                     and not urls[0].startswith('https://')
@@ -246,9 +883,24 @@ class BuildSlave(object):
         self.single_build = single_build
         self.no_loop = no_loop
         self.poll_interval = poll_interval
+        self.long_poll = long_poll
+        self.long_polled = False
+        self.log_interval = log_interval
+        self.stream_logs = False
+        self.upload_encoding = None
+        self.upload_chunk_size = None
+        self.slots = slots
+        self.slot_cpu_time = slot_cpu_time
+        self.slot_memory = slot_memory
+        self.workers = {}
+        self.uploader = None
+        self.spool_timeout = spool_timeout
         self.keepalive_interval = keepalive_interval
         self.dump_reports = dump_reports
         self.cookiejar = cookielib.CookieJar()
+        # Persistent connections to the masters, shared by all requests of
+        # the slave including the keepalive thread
+        self.connections = ConnectionPool()
         self.username = username \
                         or self.config['authentication.username'] or ''
 
@@ -267,7 +919,11 @@ class BuildSlave(object):
                 self.auth_map = dict(map(lambda x: (x, False), urls))
 
     def _get_opener(self):
-        opener = urllib2.build_opener(urllib2.HTTPErrorProcessor())
+        handlers = [urllib2.HTTPErrorProcessor(),
+                    PooledHTTPHandler(self.connections)]
+        if PooledHTTPSHandler is not None:
+            handlers.append(PooledHTTPSHandler(self.connections))
+        opener = urllib2.build_opener(*handlers)
         opener.add_handler(HTTPBasicAuthHandler(self.password_mgr))
         opener.add_handler(urllib2.HTTPDigestAuthHandler(self.password_mgr))
         opener.add_handler(urllib2.HTTPCookieProcessor(self.cookiejar))
@@ -304,6 +960,12 @@ class BuildSlave(object):
                 fileobj.close()
             return EX_OK
 
+        try:
+            return self._poll()
+        finally:
+            self._join_workers()
+
+    def _poll(self):
         urls = []
         while True:
             if not urls:
@@ -311,6 +973,7 @@ class BuildSlave(object):
             url = urls.pop(0)
             try:
                 try:
+                    self._wait_for_slot()
                     if self.username and not self.auth_map.get(url):
                         login_url = '%s/login?referer=%s' % (url[:-7],
                                                         urllib.quote_plus(url))
@@ -341,6 +1004,9 @@ class BuildSlave(object):
                         log.debug('Authentication not provided. Attempting to '
                                   'execute build anonymously.')
                     job_done = self._create_build(url)
+                    if job_done and self.single_build and self.workers:
+                        # The build runs in a worker, which exits after it
+                        break
                     if job_done:
                         continue
                 except urllib2.HTTPError, e:
@@ -360,7 +1026,8 @@ class BuildSlave(object):
                 return e.exit_code
             if self.no_loop:
                 break
-            time.sleep(self.poll_interval)
+            if not self.long_polled:
+                time.sleep(self.poll_interval)
 
     def quit(self):
         log.info('Shutting down')
@@ -377,10 +1044,14 @@ class BuildSlave(object):
             ],
         ]
 
+        if self.long_poll:
+            xml.attr['wait'] = self.long_poll
+
         log.debug('Configured packages: %s', self.config.packages)
         for package, properties in self.config.packages.items():
             xml.append(xmlio.Element('package', name=package, **properties))
 
+        self.long_polled = False
         body = str(xml)
         log.debug('Sending slave configuration: %s', body)
         resp = self.request('POST', url, body, {
@@ -388,8 +1059,21 @@ class BuildSlave(object):
             'Content-Type': 'application/x-bitten+xml'
         })
 
+        # Masters that support long polling have already waited for a build
+        # to become available
+        self.long_polled = bool(self.long_poll and
+                                resp.info().get('X-Bitten-Long-Poll'))
         if resp.code == 201:
-            self._initiate_build(resp.info().get('location'))
+            # Masters that accept compressed uploads say so when handing out
+            # a build
+            if 'gzip' in resp.info().get('Accept-Encoding', ''):
+                self.upload_encoding = 'gzip'
+            else:
+                self.upload_encoding = None
+            # ... and whether attachments may be uploaded in resumable chunks
+            self.upload_chunk_size = int(resp.info().get(
+                                    'X-Bitten-Upload-Chunk-Size', 0)) or None
+            self._start_build(resp.info().get('location'))
             return True
         elif resp.code == 204:
             log.info('No pending builds')
@@ -398,11 +1082,73 @@ class BuildSlave(object):
             log.error('Unexpected response (%d %s)', resp.code, resp.msg)
             raise ExitSlave(EX_PROTOCOL)
 
+    def _wait_for_slot(self):
+        """Wait until a slot is free for another build, if builds run in
+        worker processes."""
+        if self.slots <= 1:
+            return
+        while True:
+            for slot, worker in self.workers.items():
+                if not worker.is_alive():
+                    worker.join()
+                    log.debug('Build slot %d finished (exit code %s)', slot,
+                              worker.exitcode)
+                    del self.workers[slot]
+            if len(self.workers) < self.slots:
+                return
+            time.sleep(1)
+
+    def _join_workers(self):
+        """Wait for the builds running in worker processes to finish."""
+        for slot, worker in self.workers.items():
+            log.debug('Waiting for the build in slot %d', slot)
+            worker.join()
+            del self.workers[slot]
+
+    def _start_build(self, build_url):
+        if self.slots <= 1:
+            return self._initiate_build(build_url)
+        # Only needed for slots, as it requires Python 2.6
+        import multiprocessing
+        slot = min(set(range(self.slots)) - set(self.workers))
+        log.info('Starting build %s in slot %d', build_url, slot)
+        worker = multiprocessing.Process(target=self._run_slot,
+                                         args=(slot, build_url),
+                                         name='slot%d' % slot)
+        worker.start()
+        self.workers[slot] = worker
+
+    def _run_slot(self, slot, build_url):
+        """Run a build in the worker process of a slot."""
+        # Each slot works in a directory of its own, and must not use the
+        # connections of the process that started it
+        self.work_dir = os.path.join(self.work_dir, 'slot%d' % slot)
+        if not os.path.isdir(self.work_dir):
+            os.makedirs(self.work_dir)
+        self.connections = ConnectionPool()
+        self.workers = {}
+        if self.slot_cpu_time or self.slot_memory:
+            import resource
+            if self.slot_cpu_time:
+                resource.setrlimit(resource.RLIMIT_CPU,
+                                   (self.slot_cpu_time, self.slot_cpu_time))
+            if self.slot_memory:
+                limit = self.slot_memory * 1024 * 1024
+                resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        try:
+            self._initiate_build(build_url)
+        except ExitSlave, e:
+            sys.exit(e.exit_code)
+
     def _initiate_build(self, build_url):
         log.info('Build pending at %s', build_url)
         try:
-            resp = self.request('GET', build_url)
+            resp = self.request('GET', build_url, headers={
+                'Accept-Encoding': 'gzip'
+            })
             if resp.code == 200:
+                if resp.info().get('Content-Encoding') == 'gzip':
+                    resp = gzip.GzipFile(fileobj=StringIO(resp.read()))
                 self._execute_build(build_url, resp)
             else:
                 log.error('Unexpected response (%d): %s', resp.code, resp.msg)
@@ -414,12 +1160,19 @@ class BuildSlave(object):
     def _execute_build(self, build_url, fileobj):
         build_id = build_url and int(build_url.split('/')[-1]) or 0
         xml = xmlio.parse(fileobj)
+        self.stream_logs = bool(not self.local and not self.dry_run and
+                                self.log_interval)
         basedir = ''
         try:
             if not self.local:
                 keepalive_thread = KeepAliveThread(self.opener, build_url,
                                     self.single_build, self.keepalive_interval)
                 keepalive_thread.start()
+                if not self.dry_run:
+                    self.uploader = ResultUploader(self,
+                            os.path.join(self.work_dir, 'spool_%d' % build_id),
+                            self.spool_timeout)
+                    self.uploader.start()
             recipe = Recipe(xml, os.path.join(self.work_dir, self.build_dir), 
                             self.config)
             basedir = recipe.ctxt.basedir
@@ -438,9 +1191,14 @@ class BuildSlave(object):
                     raise
             else:
                 log.info('Build completed')
+            if self.uploader is not None:
+                self.uploader.close()
             if self.dry_run:
                 self._cancel_build(build_url)
         finally:
+            if self.uploader is not None:
+                self.uploader.abort()
+                self.uploader = None
             if not self.local:
                 keepalive_thread.stop()
             if not self.keep_files and os.path.isdir(basedir):
@@ -451,9 +1209,18 @@ class BuildSlave(object):
                 raise ExitSlave(EX_OK)
 
     def _execute_step(self, build_url, recipe, step):
+        if self.uploader is not None:
+            # Don't run any further steps once a result was rejected
+            self.uploader.check()
         failed = False
         started = int(time.time())
         xml = xmlio.Element('result', step=step.id)
+        attached = False
+        streamer = None
+        if self.stream_logs:
+            streamer = LogStreamer(self, build_url, step, self.log_interval,
+                                   recipe.ctxt)
+            recipe.ctxt.log_handler = streamer.log
         try:
             for type, category, generator, output in \
                     step.execute(recipe.ctxt):
@@ -465,6 +1232,7 @@ class BuildSlave(object):
                     # Attachments are added out-of-band due to major
                     # performance issues with inlined base64 xml content
                     self._attach_file(build_url, recipe, output)
+                    attached = True
                 xml.append(xmlio.Element(type, category=category,
                                          generator=generator)[
                     output
@@ -478,6 +1246,21 @@ class BuildSlave(object):
         except Exception, e:
             log.error('Internal error in build step %r', step.id, exc_info=True)
             failed = True
+        if attached and self.uploader is not None:
+            # The step fails if its attachments cannot be sent, just as when
+            # they are sent right away
+            self.uploader.drain()
+            for e in self.uploader.attach_errors():
+                xml.append(xmlio.Element(Recipe.ERROR)[
+                    'Failed to attach file: %s' % e
+                ])
+                failed = True
+        if streamer is not None:
+            recipe.ctxt.log_handler = None
+            for generator, output in streamer.close():
+                xml.append(xmlio.Element(Recipe.LOG, generator=generator)[
+                    output
+                ])
         xml.attr['duration'] = (time.time() - started)
         if failed:
             xml.attr['status'] = 'failure'
@@ -486,13 +1269,25 @@ class BuildSlave(object):
             log.info('Build step %s completed successfully', step.id)
 
         if not self.local and not self.dry_run:
+            headers = {'Content-Type': 'application/x-bitten+xml'}
+            compress = self.upload_encoding == 'gzip'
+            if compress:
+                headers['Content-Encoding'] = 'gzip'
             try:
-                resp = self.request('POST', build_url + '/steps/', str(xml), {
-                    'Content-Type': 'application/x-bitten+xml'
-                })
-                if resp.code != 201:
-                    log.error('Unexpected response (%d): %s', resp.code,
-                              resp.msg)
+                if self.uploader is not None:
+                    # The result is serialized into the spool rather than
+                    # into memory, as it may contain a lot of log output
+                    self.uploader.upload(build_url + '/steps/', xml, headers,
+                                         compress)
+                else:
+                    body = str(xml)
+                    if compress:
+                        body = _gzip(body)
+                    resp = self.request('POST', build_url + '/steps/', body,
+                                        headers)
+                    if resp.code != 201:
+                        log.error('Unexpected response (%d): %s', resp.code,
+                                  resp.msg)
             except KeyboardInterrupt:
                 log.warning('Build interrupted')
                 self._cancel_build(build_url)
@@ -520,19 +1315,83 @@ class BuildSlave(object):
                                                     resource_type)
         f = open(path, 'rb')
         try:
-            data, content_type = encode_multipart_formdata({
-                                'file': (filename, f.read()),
-                                'description': attachment.attr['description'],
-                                '__FORM_TOKEN': form_token})
+            fields = {'description': attachment.attr['description'],
+                      '__FORM_TOKEN': form_token}
+            if self.upload_encoding == 'gzip':
+                # Compress to a temporary file rather than into memory
+                fileobj = tempfile.TemporaryFile()
+                gzfile = gzip.GzipFile(fileobj=fileobj, mode='wb')
+                try:
+                    shutil.copyfileobj(f, gzfile)
+                finally:
+                    gzfile.close()
+                f.close()
+                f = fileobj
+                fields['encoding'] = 'gzip'
+                f.seek(0)
+            if self.uploader is not None:
+                # Sent in the background from a copy in the spool
+                self.uploader.attach(url, fields, filename, f)
+                return
+            f.seek(0, 2)
+            size = f.tell()
+            f.seek(0)
+            resp = self._upload_file(url, fields, filename, f, size)
         finally:
             f.close()
-        resp = self.request('POST', url , data, {
-                                'Content-Type': content_type})
         if not resp.code == 201:
             msg = 'Error attaching %s to %s'
             log.error(msg, filename, resource_type)
             raise BuildError(msg, filename, resource_type)
 
+    def _upload_file(self, url, fields, filename, fileobj, size):
+        """Upload `size` bytes of the file as the ``file`` field of a form.
+
+        If the master accepts chunked uploads, the file is sent in chunks that
+        the master puts together again, and an upload interrupted by a network
+        error resumes at the offset the master reports back.
+        """
+        if not self.upload_chunk_size:
+            body = MultipartBody(dict(fields, file=(filename, fileobj, size)))
+            return self.request('POST', url, body, {
+                'Content-Type': body.content_type,
+                'Content-Length': str(len(body))
+            })
+
+        offset = 0
+        retries = 0
+        while True:
+            fileobj.seek(offset)
+            length = min(self.upload_chunk_size, size - offset)
+            body = MultipartBody(dict(fields, offset=offset, size=size,
+                                      file=(filename, fileobj, length)))
+            log.debug('Uploading bytes %d-%d of %d of %s', offset,
+                      offset + length, size, filename)
+            try:
+                resp = self.request('POST', url, body, {
+                    'Content-Type': body.content_type,
+                    'Content-Length': str(len(body))
+                })
+            except urllib2.HTTPError, e:
+                if e.code != 409 or retries >= UPLOAD_RETRIES:
+                    raise
+                # The master holds a different part of the file than we
+                # thought, so continue from where it actually is
+                retries += 1
+                resp = e
+            except (urllib2.URLError, socket.error), e:
+                if retries >= UPLOAD_RETRIES:
+                    raise
+                retries += 1
+                log.warning('Uploading %s failed, retrying: %s', filename, e)
+                time.sleep(retries)
+                continue
+            else:
+                if resp.code != 202:
+                    return resp
+                retries = 0
+            offset = int(resp.info().get('X-Bitten-Upload-Offset'))
+
 class ExitSlave(Exception):
     """Exception used internally by the slave to signal that the slave process
     should be stopped.
@@ -588,6 +1447,28 @@ def main():
                      help='don\'t report results back to master')
     group.add_option('-i', '--interval', dest='interval', metavar='SECONDS',
                      type='int', help='time to wait between requesting builds')
+    group.add_option('--long-poll', dest='long_poll', metavar='SECONDS',
+                     type='int', help='time the master may wait for a build '
+                                      'to become available before answering')
+    group.add_option('--log-interval', dest='log_interval',
+                     metavar='SECONDS', type='int',
+                     help='time to wait between sending the log output of '
+                          'running build steps (0 to disable)')
+    group.add_option('--spool-timeout', dest='spool_timeout',
+                     metavar='SECONDS', type='int',
+                     help='time to keep sending build results while the '
+                          'master cannot be reached [%default]')
+    group.add_option('--slots', dest='slots', metavar='N', type='int',
+                     help='number of builds to run in parallel, requires '
+                          'Python 2.6 [%default]')
+    group.add_option('--slot-cpu-time', dest='slot_cpu_time',
+                     metavar='SECONDS', type='int',
+                     help='CPU time limit for each process of a build '
+                          'running in a slot')
+    group.add_option('--slot-memory', dest='slot_memory', metavar='MB',
+                     type='int',
+                     help='memory limit for each process of a build running '
+                          'in a slot')
     group.add_option('-b', '--keepalive_interval', dest='keepalive_interval', metavar='SECONDS', type='int', help='time to wait between keepalive heartbeats')
     group = parser.add_option_group('logging')
     group.add_option('-l', '--log', dest='logfile', metavar='FILENAME',
@@ -602,11 +1483,25 @@ def main():
     parser.set_defaults(dry_run=False, keep_files=False,
                         loglevel=logging.INFO, single_build=False, no_loop=False,
                         dump_reports=False, interval=300, keepalive_interval=60,
-                        form_auth=False)
+                        long_poll=0, log_interval=10, form_auth=False,
+                        slots=1, spool_timeout=3600)
     options, args = parser.parse_args()
 
     if len(args) < 1:
         parser.error('incorrect number of arguments')
+    if options.slots < 1:
+        parser.error('the number of slots must be at least 1')
+    if options.slots > 1 and not hasattr(os, 'fork'):
+        parser.error('running builds in slots is not supported on this '
+                     'platform')
+    if options.slots > 1:
+        try:
+            import multiprocessing
+        except ImportError:
+            parser.error('running builds in slots requires Python 2.6 or '
+                         'later')
+    if (options.slot_cpu_time or options.slot_memory) and options.slots < 2:
+        parser.error('slot limits require more than one slot')
     urls = args
 
     logger = logging.getLogger('bitten')
@@ -637,6 +1532,12 @@ def main():
                        no_loop=options.no_loop,
                        poll_interval=options.interval,
                        keepalive_interval=options.keepalive_interval,
+                       long_poll=options.long_poll,
+                       log_interval=options.log_interval,
+                       slots=options.slots,
+                       slot_cpu_time=options.slot_cpu_time,
+                       slot_memory=options.slot_memory,
+                       spool_timeout=options.spool_timeout,
                        username=options.username, password=options.password,
                        dump_reports=options.dump_reports,
                        form_auth=options.form_auth)
@@ -13,8 +13,10 @@ import re
 import shutil
 from StringIO import StringIO
 import tempfile
+import time
 import unittest
 import cgi
+import gzip
 from Cookie import SimpleCookie as Cookie
 
 from trac.attachment import Attachment
@@ -25,7 +27,8 @@ from trac.util.datefmt import to_datetime, utc
 from trac.web.api import RequestDone
 from trac.web.href import Href
 
-from bitten.master import BuildMaster
+from bitten.master import BuildMaster, BuildQueueUpdater, get_recipe, \
+                          invalidate_recipe
 from bitten.slave import encode_multipart_formdata
 from bitten.model import BuildConfig, TargetPlatform, Build, BuildStep, \
                          BuildLog, Report, schema
@@ -101,6 +104,7 @@ class BuildMasterTestCase(unittest.TestCase):
 
         self.assertEqual(201, outheaders['Status'])
         self.assertEqual('text/plain', outheaders['Content-Type'])
+        self.assertEqual('gzip', outheaders['Accept-Encoding'])
         location = outheaders['Location']
         mo = re.match('http://example.org/trac/builds/(\d+)', location)
         assert mo, 'Location was %r' % location
@@ -109,6 +113,96 @@ class BuildMasterTestCase(unittest.TestCase):
         self.assertEqual(Build.IN_PROGRESS, build.status)
         self.assertEqual('hal', build.slave)
 
+    def test_create_build_no_populate_on_poll(self):
+        self.env.config.set('bitten', 'populate_on_poll', 'no')
+        BuildConfig(self.env, 'test', path='somepath', active=True).insert()
+        platform = TargetPlatform(self.env, config='test', name="Unix")
+        platform.insert()
+
+        def get_node(path, rev=None):
+            self.fail('Repository should not be accessed')
+        self.repos = Mock(get_node=get_node)
+
+        inheaders = {'Content-Type': 'application/x-bitten+xml'}
+        inbody = StringIO("""<slave name="hal" version="%d">
+  <platform>Power Macintosh</platform>
+  <os family="posix" version="8.1.0">Darwin</os>
+</slave>""" % PROTOCOL_VERSION)
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='', path_info='/builds',
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: inheaders.get(x), read=inbody.read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth='))
+
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual(204, outheaders['Status'])
+        self.assertEqual([], list(Build.select(self.env)))
+
+    def test_create_build_long_poll(self):
+        self.env.config.set('bitten', 'populate_on_poll', 'no')
+        self.env.config.set('bitten', 'long_poll_timeout', '1')
+
+        inheaders = {'Content-Type': 'application/x-bitten+xml'}
+        inbody = StringIO("""<slave name="hal" version="%d" wait="30">
+  <platform>Power Macintosh</platform>
+  <os family="posix" version="8.1.0">Darwin</os>
+</slave>""" % PROTOCOL_VERSION)
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='', path_info='/builds',
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: inheaders.get(x), read=inbody.read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth='))
+
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+
+        # The wait time requested by the slave is limited by the master
+        started = time.time()
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.failUnless(1 <= time.time() - started < 30)
+        self.assertEqual(204, outheaders['Status'])
+        self.assertEqual('1', outheaders['X-Bitten-Long-Poll'])
+
+    def test_create_build_invalid_wait(self):
+        inheaders = {'Content-Type': 'application/x-bitten+xml'}
+        inbody = StringIO("""<slave name="hal" version="%d" wait="soon">
+  <platform>Power Macintosh</platform>
+  <os family="posix" version="8.1.0">Darwin</os>
+</slave>""" % PROTOCOL_VERSION)
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='', path_info='/builds',
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: inheaders.get(x), read=inbody.read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth='))
+
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual(400, outheaders['Status'])
+        self.assertEqual("Invalid wait time 'soon'", outbody.getvalue())
+
     def test_create_build_invalid_xml(self):
         inheaders = {'Content-Type': 'application/x-bitten+xml'}
         inbody = StringIO('<slave></salve>')
@@ -237,6 +331,8 @@ class BuildMasterTestCase(unittest.TestCase):
         build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
                       status=Build.IN_PROGRESS, started=42)
         build.insert()
+        BuildStep(self.env, build=build.id, name='s1', started=42,
+                  status=BuildStep.SUCCESS).insert()
 
         outheaders = {}
         outbody = StringIO()
@@ -261,6 +357,7 @@ class BuildMasterTestCase(unittest.TestCase):
         build = Build.fetch(self.env, build.id)
         self.assertEqual(Build.PENDING, build.status)
         assert not build.started
+        self.assertEqual([], list(BuildStep.select(self.env, build=build.id)))
 
     def test_initiate_build(self):
         config = BuildConfig(self.env, 'test', path='somepath', active=True,
@@ -280,6 +377,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    path_info='/builds/%d' % build.id,
                    href=Href('/trac'), remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: None,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -306,6 +404,43 @@ class BuildMasterTestCase(unittest.TestCase):
         build = Build.fetch(self.env, build.id)
         assert build.started
 
+    def test_initiate_build_gzip(self):
+        config = BuildConfig(self.env, 'test', path='somepath', active=True,
+                             recipe='<build><step id="s1"></step></build>')
+        config.insert()
+        platform = TargetPlatform(self.env, config='test', name="Unix")
+        platform.insert()
+        build = Build(self.env, 'test', '123', platform.id, slave='hal',
+                      rev_time=42)
+        build.insert()
+
+        inheaders = {'Accept-Encoding': 'gzip, deflate'}
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='GET', base_path='',
+                   path_info='/builds/%d' % build.id,
+                   href=Href('/trac'), remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: inheaders.get(x),
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   form_token="12345",
+                   incookie=Cookie('trac_auth='))
+
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+        self.assertRaises(RequestDone, module.process_request, req)
+
+        self.assertEqual(200, outheaders['Status'])
+        self.assertEqual('gzip', outheaders['Content-Encoding'])
+        self.assertEqual(str(len(outbody.getvalue())),
+                         outheaders['Content-Length'])
+        body = gzip.GzipFile(fileobj=StringIO(outbody.getvalue())).read()
+        self.assertEqual('<build build="1" config="test" form_token="12345" '
+                         'name="hal" path="somepath" platform="Unix"'
+                         ' revision="123"><step id="s1"/></build>', body)
+
     def test_initiate_build_no_such_build(self):
         outheaders = {}
         outbody = StringIO()
@@ -374,7 +509,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -429,7 +564,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -465,6 +600,169 @@ class BuildMasterTestCase(unittest.TestCase):
         self.assertEqual((u'info', u'Doing stuff'), logs[0].messages[0])
         self.assertEqual((u'error', u'Ouch that hurt'), logs[0].messages[1])
 
+    def test_process_build_step_repeated(self):
+        recipe = """<build>
+  <step id="foo">
+  </step>
+  <step id="bar">
+  </step>
+</build>"""
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe=recipe).insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+        module = BuildMaster(self.env)
+        module._start_new_step(build, 'foo').insert()
+
+        statuses = []
+        for idx in range(2):
+            inbody = StringIO("""<result step="foo" status="success"
+                                     time="2007-04-01T15:30:00.0000"
+                                     duration="3.45">
+    <log generator="http://bitten.edgewall.org/tools/python#unittest">
+        <message level="info">Doing stuff</message>
+    </log>
+    <report category="test"
+            generator="http://bitten.edgewall.org/tools/python#unittest">
+        <test fixture="my.Fixture" file="my/test/file.py">
+            <stdout>Doing my thing</stdout>
+        </test>
+    </report>
+</result>""")
+            outheaders = {}
+            outbody = StringIO()
+            req = Mock(method='POST', base_path='',
+                       path_info='/builds/%d/steps/' % build.id,
+                       href=Href('/trac'),
+                       abs_href=Href('http://example.org/trac'),
+                       remote_addr='127.0.0.1', args={},
+                       perm=PermissionCache(self.env, 'hal'),
+                       get_header=lambda x: None, read=inbody.read,
+                       send_response=lambda x: outheaders.setdefault('Status',
+                                                                     x),
+                       send_header=lambda x, y: outheaders.setdefault(x, y),
+                       write=outbody.write,
+                       incookie=Cookie('trac_auth=123'))
+            assert module.match_request(req)
+            self.assertRaises(RequestDone, module.process_request, req)
+            statuses.append(outheaders['Status'])
+
+        # The result sent again is not stored a second time
+        self.assertEqual([201, 409], statuses)
+        self.assertEqual('Build step has already been processed.',
+                         outbody.getvalue())
+        self.assertEqual(1, len(list(BuildLog.select(self.env,
+                                                     build=build.id))))
+        self.assertEqual(1, len(list(Report.select(self.env,
+                                                   build=build.id))))
+        steps = list(BuildStep.select(self.env, build.id))
+        self.assertEqual([('bar', BuildStep.IN_PROGRESS),
+                          ('foo', BuildStep.SUCCESS)],
+                         sorted([(step.name, step.status) for step in steps]))
+        self.assertEqual(Build.IN_PROGRESS,
+                         Build.fetch(self.env, build.id).status)
+
+    def _log_request(self, build, stepname, body, outheaders, outbody):
+        return Mock(method='POST', base_path='',
+                    path_info='/builds/%d/steps/%s/log' % (build.id, stepname),
+                    href=Href('/trac'),
+                    abs_href=Href('http://example.org/trac'),
+                    remote_addr='127.0.0.1', args={},
+                    perm=PermissionCache(self.env, 'hal'),
+                    read=StringIO(body).read,
+                    send_response=lambda x: outheaders.setdefault('Status', x),
+                    send_header=lambda x, y: outheaders.setdefault(x, y),
+                    write=outbody.write,
+                    incookie=Cookie('trac_auth=123'))
+
+    def test_process_build_log(self):
+        recipe = """<build>
+  <step id="foo">
+  </step>
+</build>"""
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe=recipe).insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+        module = BuildMaster(self.env)
+        module._start_new_step(build, 'foo').insert()
+
+        for body in ["""<log generator="sh#exec">
+    <message level="info">Doing stuff</message>
+</log>""", """<log generator="sh#exec">
+    <message level="error">Ouch that hurt</message>
+</log>""", """<log generator="python#unittest">
+    <message level="info">Testing</message>
+</log>"""]:
+            outheaders = {}
+            outbody = StringIO()
+            req = self._log_request(build, 'foo', body, outheaders, outbody)
+            assert module.match_request(req)
+            self.assertRaises(RequestDone, module.process_request, req)
+            self.assertEqual(201, outheaders['Status'])
+            self.assertEqual('Build log appended', outbody.getvalue())
+
+        # Consecutive output of the same generator goes into one log
+        logs = list(BuildLog.select(self.env, build=build.id, step='foo'))
+        self.assertEqual(['sh#exec', 'python#unittest'],
+                         [log.generator for log in logs])
+        self.assertEqual([(u'info', u'Doing stuff'),
+                          (u'error', u'Ouch that hurt')], logs[0].messages)
+        self.assertEqual([(u'info', u'Testing')], logs[1].messages)
+
+        # Completing the step keeps the logs, and adds those of the result
+        inbody = StringIO("""<result step="foo" status="success"
+                                     time="2007-04-01T15:30:00.0000"
+                                     duration="3.45">
+    <log generator="python#unittest">
+        <message level="info">Done</message>
+    </log>
+</result>""")
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/steps/' % build.id,
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: None, read=inbody.read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth=123'))
+        assert module.match_request(req)
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual(201, outheaders['Status'])
+
+        logs = list(BuildLog.select(self.env, build=build.id, step='foo'))
+        self.assertEqual([0, 1, 2], [log.orderno for log in logs])
+        self.assertEqual([(u'info', u'Done')], logs[2].messages)
+
+    def test_process_build_log_step_not_in_progress(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='<build><step id="foo"></step></build>').insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+        BuildStep(self.env, build=build.id, name='foo',
+                  status=BuildStep.SUCCESS).insert()
+
+        outheaders = {}
+        outbody = StringIO()
+        req = self._log_request(build, 'foo', """<log generator="sh#exec">
+    <message level="info">Doing stuff</message>
+</log>""", outheaders, outbody)
+        module = BuildMaster(self.env)
+        assert module.match_request(req)
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual(409, outheaders['Status'])
+        self.assertEqual([], list(BuildLog.select(self.env, build=build.id)))
+
     def test_process_build_step_success_with_report(self):
         recipe = """<build>
   <step id="foo">
@@ -494,7 +792,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -535,6 +833,103 @@ class BuildMasterTestCase(unittest.TestCase):
             'type': 'test',
         }, reports[0].items[0])
 
+    def test_process_build_step_gzip(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='<build><step id="foo"></step></build>').insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        buf = StringIO()
+        gzfile = gzip.GzipFile(fileobj=buf, mode='wb')
+        gzfile.write('<result step="foo" status="success">'
+                     '<log generator="sh#exec">%s</log></result>' %
+                     ''.join(['<message level="info">line %d</message>' % idx
+                              for idx in range(5000)]))
+        gzfile.close()
+        body = buf.getvalue()
+        inbody = StringIO(body)
+        inheaders = {'Content-Length': str(len(body)),
+                     'Content-Encoding': 'gzip'}
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/steps/' % build.id,
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: inheaders.get(x), read=inbody.read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth=123'))
+        module = BuildMaster(self.env)
+        module._start_new_step(build, 'foo').insert()
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual(201, outheaders['Status'])
+
+        logs = list(BuildLog.select(self.env, build=build.id, step='foo'))
+        self.assertEqual(5000, len(logs[0].messages))
+        self.assertEqual((u'info', u'line 4999'), logs[0].messages[-1])
+
+    def test_process_build_step_large_result(self):
+        BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='<build><step id="foo"></step></build>').insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.slave_info[Build.TOKEN] = '123';
+        build.insert()
+
+        # Large enough to be read in several blocks and stored in batches
+        messages = ['<message level="info">line %d</message>' % idx
+                    for idx in range(2500)]
+        items = ['<test status="success" name="test_%d"><traceback>'
+                 '</traceback></test>' % idx for idx in range(1500)]
+        body = '<result step="foo" status="success">' \
+               '<log generator="sh#exec">%s</log>' \
+               '<error>Oops</error>' \
+               '<report category="test" generator="unittest">%s</report>' \
+               '</result>' % (''.join(messages), ''.join(items))
+        inbody = StringIO(body)
+        inheaders = {'Content-Length': str(len(body))}
+        outheaders = {}
+        outbody = StringIO()
+        req = Mock(method='POST', base_path='',
+                   path_info='/builds/%d/steps/' % build.id,
+                   href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   remote_addr='127.0.0.1', args={},
+                   perm=PermissionCache(self.env, 'hal'),
+                   get_header=lambda x: inheaders.get(x), read=inbody.read,
+                   send_response=lambda x: outheaders.setdefault('Status', x),
+                   send_header=lambda x, y: outheaders.setdefault(x, y),
+                   write=outbody.write,
+                   incookie=Cookie('trac_auth=123'))
+        module = BuildMaster(self.env)
+        module._start_new_step(build, 'foo').insert()
+        assert module.match_request(req)
+
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual(201, outheaders['Status'])
+
+        step = BuildStep.fetch(self.env, build.id, 'foo')
+        self.assertEqual(BuildStep.SUCCESS, step.status)
+        self.assertEqual(['Oops'], step.errors)
+
+        logs = list(BuildLog.select(self.env, build=build.id, step='foo'))
+        self.assertEqual(1, len(logs))
+        self.assertEqual(2500, len(logs[0].messages))
+        self.assertEqual((u'info', u'line 2499'), logs[0].messages[-1])
+
+        reports = list(Report.select(self.env, build=build.id, step='foo'))
+        self.assertEqual(1, len(reports))
+        self.assertEqual(1500, len(reports[0].items))
+        self.assertEqual({'type': 'test', 'status': 'success',
+                          'name': 'test_1499', 'traceback': ''},
+                         reports[0].items[-1])
+
     def test_process_build_step_wrong_slave(self):
         recipe = """<build>
   <step id="foo">
@@ -562,7 +957,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -615,7 +1010,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -660,7 +1055,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -703,7 +1098,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -755,7 +1150,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -808,7 +1203,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    href=Href('/trac'), abs_href=Href('http://example.org/trac'),
                    remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -854,7 +1249,7 @@ class BuildMasterTestCase(unittest.TestCase):
                    path_info='/builds/%d/steps/' % build.id,
                    href=Href('/trac'), remote_addr='127.0.0.1', args={},
                    perm=PermissionCache(self.env, 'hal'),
-                   read=inbody.read,
+                   get_header=lambda x: None, read=inbody.read,
                    send_response=lambda x: outheaders.setdefault('Status', x),
                    send_header=lambda x, y: outheaders.setdefault(x, y),
                    write=outbody.write,
@@ -1023,11 +1418,153 @@ class BuildMasterTestCase(unittest.TestCase):
         self.assertEquals('hello baz',
                         build_atts[0].open().read())
 
+    def _attach_chunk(self, module, config, build, data, offset, size):
+        body, content_type = encode_multipart_formdata({
+                'description': 'baz baz',
+                'file': ('baz.txt', data),
+                'offset': str(offset),
+                'size': str(size),
+                '__FORM_TOKEN': '123456'})
+        args = {}
+        for k, v in dict(cgi.FieldStorage(fp=StringIO(body), environ={
+                    'REQUEST_METHOD': 'POST',
+                    'CONTENT_TYPE': content_type})
+                    ).items():
+            if v.filename:
+                args[k] = v
+            else:
+                args[k] = v.value
+        args.update({'collection': 'attach', 'member': 'build'})
+
+        outheaders = {}
+        req = Mock(args=args, form_token='123456', authname='hal',
+                remote_addr='127.0.0.1',
+                send_response=lambda x: outheaders.setdefault('Status', x),
+                send_header=lambda x, y: outheaders.setdefault(x, y),
+                write=lambda x: None)
+        self.assertRaises(RequestDone, module._process_attachment,
+                                                req, config, build)
+        return outheaders
+
+    def test_process_attach_build_chunks(self):
+        config = BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='')
+        config.insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.insert()
+        module = BuildMaster(self.env)
+
+        outheaders = self._attach_chunk(module, config, build, 'hello', 0, 9)
+        self.assertEqual(202, outheaders['Status'])
+        self.assertEqual('5', outheaders['X-Bitten-Upload-Offset'])
+        self.assertEquals([], list(Attachment.select(self.env, 'build',
+                                                     'test/1')))
+
+        # A chunk sent again is refused, telling where to continue
+        outheaders = self._attach_chunk(module, config, build, 'hello', 0, 9)
+        outheaders = self._attach_chunk(module, config, build, ' baz', 9, 9)
+        self.assertEqual(409, outheaders['Status'])
+        self.assertEqual('5', outheaders['X-Bitten-Upload-Offset'])
+
+        outheaders = self._attach_chunk(module, config, build, ' baz', 5, 9)
+        self.assertEqual(201, outheaders['Status'])
+        build_atts = list(Attachment.select(self.env, 'build', 'test/1'))
+        self.assertEquals(1, len(build_atts))
+        self.assertEquals('baz.txt', build_atts[0].filename)
+        self.assertEquals('hello baz', build_atts[0].open().read())
+        self.assertEquals([], os.listdir(Build.get_uploads_dir(self.env,
+                                                               build.id)))
+
+    def test_cancel_build_removes_uploads(self):
+        config = BuildConfig(self.env, 'test', path='somepath', active=True,
+                    recipe='')
+        config.insert()
+        build = Build(self.env, 'test', '123', 1, slave='hal', rev_time=42,
+                      started=42, status=Build.IN_PROGRESS)
+        build.insert()
+        module = BuildMaster(self.env)
+
+        outheaders = self._attach_chunk(module, config, build, 'hello', 0, 9)
+        self.assertEqual(202, outheaders['Status'])
+        uploads_dir = Build.get_uploads_dir(self.env, build.id)
+        self.assertEqual(1, len(os.listdir(uploads_dir)))
+
+        req = Mock(send_response=lambda x: None,
+                   send_header=lambda x, y: None, write=lambda x: None)
+        self.assertRaises(RequestDone, module._process_build_cancellation,
+                          req, config, build)
+        self.failIf(os.path.exists(uploads_dir))
+
+    def test_get_recipe_cached(self):
+        config = BuildConfig(self.env, 'test', recipe="""<build>
+<step id="foo"><cmd/></step><step id="bar"><cmd/></step>
+</build>""")
+        recipe = get_recipe(self.env, config)
+        self.assertEqual(['foo', 'bar'], [step.id for step in recipe.steps])
+        self.assertEqual({'foo': 0, 'bar': 1}, recipe.index)
+        self.failUnless(recipe is get_recipe(self.env, config))
+
+        # A changed recipe is parsed again
+        config.recipe = """<build><step id="baz"><cmd/></step></build>"""
+        changed = get_recipe(self.env, config)
+        self.assertEqual(['baz'], [step.id for step in changed.steps])
+
+        invalidate_recipe(self.env, 'test')
+        self.failIf(changed is get_recipe(self.env, config))
+
+
+class BuildQueueUpdaterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'bitten.*'])
+        self.env.path = tempfile.mkdtemp()
+
+        # Create tables
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        connector, _ = DatabaseManager(self.env)._get_connector()
+        for table in schema:
+            for stmt in connector.to_sql(table):
+                cursor.execute(stmt)
+
+        self.repos = Mock(
+            reponame='',
+            get_node=lambda path, rev=None: Mock(
+                get_entries=lambda: [Mock(), Mock()],
+                get_history=lambda: [('somepath', 123, 'edit')]
+            ),
+            get_changeset=lambda rev: Mock(date=to_datetime(42, utc)),
+            normalize_path=lambda path: path,
+            rev_older_than=lambda rev1, rev2: int(rev1) < int(rev2)
+        )
+        self.env.get_repository = lambda authname=None: self.repos
+
+        BuildConfig(self.env, 'test', path='somepath', active=True).insert()
+        TargetPlatform(self.env, config='test', name="Unix").insert()
+
+    def tearDown(self):
+        shutil.rmtree(self.env.path)
+
+    def test_changeset_added(self):
+        updater = BuildQueueUpdater(self.env)
+        updater.changeset_added(self.repos, Mock(rev=123))
+
+        builds = list(Build.select(self.env, config='test'))
+        self.assertEqual(['123'], [build.rev for build in builds])
+        self.assertEqual(Build.PENDING, builds[0].status)
+
+    def test_changeset_added_other_repository(self):
+        updater = BuildQueueUpdater(self.env)
+        updater.changeset_added(Mock(reponame='other'), Mock(rev=123))
+
+        self.assertEqual([], list(Build.select(self.env, config='test')))
 
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(BuildMasterTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(BuildQueueUpdaterTestCase, 'test'))
     return suite
 
 if __name__ == '__main__':
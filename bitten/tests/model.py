@@ -169,6 +169,27 @@ class BuildConfigTestCase(BaseModelTestCase):
         config = BuildConfig(self.env, 'test')
         self.assertRaises(AssertionError, config.delete)
 
+    def test_scanned_rev(self):
+        config = BuildConfig(self.env, name='test', path='trunk')
+        config.insert()
+        self.assertEqual(None, config.get_scanned_rev())
+
+        config.set_scanned_rev(42)
+        self.assertEqual('42', config.get_scanned_rev())
+        config.set_scanned_rev(43)
+        self.assertEqual('43', config.get_scanned_rev())
+        config.set_scanned_rev(None)
+        self.assertEqual(None, config.get_scanned_rev())
+
+    def test_update_resets_scanned_rev(self):
+        config = BuildConfig(self.env, name='test', path='trunk')
+        config.insert()
+        config.set_scanned_rev(42)
+
+        config.path = 'some_branch'
+        config.update()
+        self.assertEqual(None, config.get_scanned_rev())
+
 
 class TargetPlatformTestCase(BaseModelTestCase):
 
@@ -219,7 +240,8 @@ class TargetPlatformTestCase(BaseModelTestCase):
 
 class BuildTestCase(BaseModelTestCase):
 
-    schemas = [Build._schema]
+    schemas = [Build._schema, BuildStep._schema, BuildLog._schema,
+               Report._schema]
 
     def test_new(self):
         build = Build(self.env)
@@ -315,6 +337,212 @@ class BuildTestCase(BaseModelTestCase):
         build.status = Build.FAILURE
         build.update()
 
+    def test_claim(self):
+        build = Build(self.env, config='test', rev='42', rev_time=12039,
+                      platform=1)
+        build.insert()
+
+        other = Build.fetch(self.env, build.id)
+        self.assertEqual(True, build.claim('tehbox'))
+        self.assertEqual('tehbox', build.slave)
+        self.assertEqual(Build.IN_PROGRESS, build.status)
+
+        # The build is no longer pending
+        self.assertEqual(False, other.claim('otherbox'))
+        self.assertEqual(Build.PENDING, other.status)
+        build = Build.fetch(self.env, build.id)
+        self.assertEqual('tehbox', build.slave)
+        self.assertEqual(Build.IN_PROGRESS, build.status)
+
+    def test_delete_many(self):
+        pending = Build(self.env, config='test', rev='42', rev_time=12039,
+                        platform=1)
+        pending.slave_info[Build.IP_ADDRESS] = '127.0.0.1'
+        pending.insert()
+        claimed = Build(self.env, config='test', rev='43', rev_time=12040,
+                        platform=1, slave='tehbox', started=15006,
+                        status=Build.IN_PROGRESS)
+        claimed.insert()
+        for build in (pending, claimed):
+            BuildStep(self.env, build=build.id, name='test', started=15006,
+                      status=BuildStep.SUCCESS).insert()
+
+        # Builds that have been claimed in the meantime are not removed
+        self.assertEqual([pending.id],
+                         Build.delete_many(self.env, [pending.id, claimed.id,
+                                                      4711],
+                                           status=Build.PENDING))
+        self.assertEqual(None, Build.fetch(self.env, pending.id))
+        self.assertEqual([], list(BuildStep.select(self.env,
+                                                   build=pending.id)))
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("SELECT COUNT(*) FROM bitten_slave WHERE build=%s",
+                       (pending.id,))
+        self.assertEqual(0, cursor.fetchone()[0])
+        self.assertEqual(Build.IN_PROGRESS,
+                         Build.fetch(self.env, claimed.id).status)
+        self.assertEqual(1, len(list(BuildStep.select(self.env,
+                                                      build=claimed.id))))
+
+    def test_reset_many(self):
+        build = Build(self.env, config='test', rev='42', rev_time=12039,
+                      platform=1, slave='tehbox', started=15006,
+                      last_activity=15007, status=Build.IN_PROGRESS)
+        build.slave_info[Build.IP_ADDRESS] = '127.0.0.1'
+        build.insert()
+        other = Build(self.env, config='test', rev='43', rev_time=12040,
+                      platform=1, slave='tehbox', started=15006,
+                      last_activity=15007, status=Build.IN_PROGRESS)
+        other.insert()
+        step = BuildStep(self.env, build=build.id, name='test',
+                         started=15006, status=BuildStep.FAILURE)
+        step.errors = ['oops']
+        step.insert()
+        BuildStep(self.env, build=other.id, name='test', started=15006,
+                  status=BuildStep.SUCCESS).insert()
+        log = BuildLog(self.env, build=build.id, step='test',
+                       filename='%s.log' % build.id)
+        log.messages = [(BuildLog.INFO, 'running tests')]
+        log.insert()
+        log_file = log.get_log_file(log.filename)
+        self.failUnless(os.path.exists(log_file))
+        Report(self.env, build=build.id, step='test',
+               category='test').insert()
+        uploads_dir = Build.get_uploads_dir(self.env, build.id)
+        os.makedirs(uploads_dir)
+        open(os.path.join(uploads_dir, 'partial'), 'wb').close()
+
+        Build.reset_many(self.env, [build.id])
+
+        build = Build.fetch(self.env, build.id)
+        self.assertEqual(Build.PENDING, build.status)
+        self.assertEqual('', build.slave)
+        self.assertEqual(0, build.started)
+        self.assertEqual(0, build.last_activity)
+        self.assertEqual({}, build.slave_info)
+        self.assertEqual([], list(BuildStep.select(self.env, build=build.id)))
+        self.assertEqual([], list(BuildLog.select(self.env, build=build.id)))
+        self.assertEqual([], list(Report.select(self.env, build=build.id)))
+        self.failIf(os.path.exists(log_file))
+        self.failIf(os.path.exists(uploads_dir))
+
+        # Other builds are left alone
+        other = Build.fetch(self.env, other.id)
+        self.assertEqual(Build.IN_PROGRESS, other.status)
+        self.assertEqual(1, len(list(BuildStep.select(self.env,
+                                                      build=other.id))))
+
+    def test_reset_many_changed_builds(self):
+        active = Build(self.env, config='test', rev='42', rev_time=12039,
+                       platform=1, slave='tehbox', started=15006,
+                       last_activity=15020, status=Build.IN_PROGRESS)
+        active.insert()
+        done = Build(self.env, config='test', rev='43', rev_time=12040,
+                     platform=1, slave='tehbox', started=15006, stopped=15008,
+                     last_activity=15008, status=Build.SUCCESS)
+        done.insert()
+        orphan = Build(self.env, config='test', rev='44', rev_time=12041,
+                       platform=1, slave='tehbox', started=15006,
+                       last_activity=15007, status=Build.IN_PROGRESS)
+        orphan.insert()
+        for build in (active, done, orphan):
+            BuildStep(self.env, build=build.id, name='test', started=15006,
+                      status=BuildStep.SUCCESS).insert()
+
+        # Builds that have been active or completed since they were found to
+        # be orphaned are not reset
+        self.assertEqual([orphan.id],
+                         Build.reset_many(self.env,
+                                          [active.id, done.id, orphan.id],
+                                          last_activity=15010))
+        self.assertEqual(Build.IN_PROGRESS,
+                         Build.fetch(self.env, active.id).status)
+        self.assertEqual(15020, Build.fetch(self.env, active.id).last_activity)
+        self.assertEqual(Build.SUCCESS, Build.fetch(self.env, done.id).status)
+        self.assertEqual(Build.PENDING,
+                         Build.fetch(self.env, orphan.id).status)
+        self.assertEqual(0, Build.fetch(self.env, orphan.id).last_activity)
+        self.assertEqual([1, 1, 0],
+                         [len(list(BuildStep.select(self.env, build=build.id)))
+                          for build in (active, done, orphan)])
+
+    def test_select(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.executemany("INSERT INTO bitten_build (config,rev,rev_time,"
+                           "platform,slave,started,stopped,status) "
+                           "VALUES (%s,%s,%s,%s,%s,%s,%s,%s)",
+                           [('test', '42', 12039, 1, 'tehbox', 15006, 16007,
+                             Build.SUCCESS),
+                            ('test', '43', 12040, 1, '', 0, 0, Build.PENDING),
+                            ('other', '43', 12040, 2, '', 0, 0,
+                             Build.PENDING)])
+        cursor.executemany("INSERT INTO bitten_slave VALUES (%s,%s,%s)",
+                           [(1, Build.IP_ADDRESS, '127.0.0.1'),
+                            (1, Build.MAINTAINER, 'joe@example.org'),
+                            (3, Build.IP_ADDRESS, '127.0.0.2')])
+
+        builds = list(Build.select(self.env, config='test'))
+        self.assertEqual([2, 1], [build.id for build in builds])
+        self.assertEqual({}, builds[0].slave_info)
+        self.assertEqual(Build.SUCCESS, builds[1].status)
+        self.assertEqual('tehbox', builds[1].slave)
+        self.assertEqual(16007, builds[1].stopped)
+        self.assertEqual({Build.IP_ADDRESS: '127.0.0.1',
+                          Build.MAINTAINER: 'joe@example.org'},
+                         builds[1].slave_info)
+
+        builds = list(Build.select(self.env, status=Build.PENDING))
+        self.assertEqual([3, 2], [build.id for build in builds])
+        self.assertEqual({Build.IP_ADDRESS: '127.0.0.2'},
+                         builds[0].slave_info)
+
+    def test_select_limit_offset(self):
+        for idx in range(5):
+            build = Build(self.env, config='test', rev=str(idx),
+                          rev_time=12000 + idx, platform=1)
+            build.slave_info[Build.IP_ADDRESS] = '10.0.0.%d' % idx
+            build.insert()
+
+        builds = list(Build.select(self.env, config='test', limit=2))
+        self.assertEqual(['4', '3'], [build.rev for build in builds])
+        builds = list(Build.select(self.env, config='test', limit=2,
+                                   offset=2))
+        self.assertEqual(['2', '1'], [build.rev for build in builds])
+        self.assertEqual('10.0.0.1', builds[1].slave_info[Build.IP_ADDRESS])
+        builds = list(Build.select(self.env, config='test', limit=2,
+                                   offset=4))
+        self.assertEqual(['0'], [build.rev for build in builds])
+        self.assertRaises(AssertionError, list,
+                          Build.select(self.env, config='test', offset=2))
+
+    def test_count(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.executemany("INSERT INTO bitten_build (config,rev,rev_time,"
+                           "platform,slave,status) "
+                           "VALUES (%s,%s,%s,%s,%s,%s)",
+                           [('test', '41', 12038, 1, '', Build.PENDING),
+                            ('test', '42', 12039, 1, '', Build.PENDING),
+                            ('test', '42', 12039, 2, 'tehbox',
+                             Build.IN_PROGRESS),
+                            ('other', '42', 12039, 3, '', Build.PENDING)])
+
+        self.assertEqual(4, Build.count(self.env))
+        self.assertEqual(3, Build.count(self.env, status=Build.PENDING))
+        self.assertEqual(2, Build.count(self.env, config='test', platform=1))
+        self.assertEqual(0, Build.count(self.env, config='test',
+                                        status=Build.SUCCESS))
+
+        self.assertEqual({('test', 1, Build.PENDING): 2,
+                          ('test', 2, Build.IN_PROGRESS): 1,
+                          ('other', 3, Build.PENDING): 1},
+                         Build.count_grouped(self.env))
+        self.assertEqual({('test', 1, Build.PENDING): 2},
+                         Build.count_grouped(self.env, config='test',
+                                             status=Build.PENDING))
+
 
 class BuildStepTestCase(BaseModelTestCase):
 
@@ -356,6 +584,26 @@ class BuildStepTestCase(BaseModelTestCase):
         self.assertEqual(('Foo',), cursor.fetchone())
         self.assertEqual(('Bar',), cursor.fetchone())
 
+    def test_update(self):
+        step = BuildStep(self.env, build=1, name='test', description='Foo bar',
+                         status=BuildStep.IN_PROGRESS, started=42)
+        step.errors += ['Foo']
+        step.insert()
+
+        step.status = BuildStep.FAILURE
+        step.stopped = 43
+        step.errors = ['Bar', 'Baz']
+        step.update()
+
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("SELECT build,name,description,status,started,stopped "
+                       "FROM bitten_step")
+        self.assertEqual([(1, 'test', 'Foo bar', BuildStep.FAILURE, 42, 43)],
+                         cursor.fetchall())
+        cursor.execute("SELECT message FROM bitten_error ORDER BY orderno")
+        self.assertEqual([('Bar',), ('Baz',)], cursor.fetchall())
+
     def test_insert_no_build_or_name(self):
         step = BuildStep(self.env, name='test')
         self.assertRaises(AssertionError, step.insert) # No build
@@ -407,6 +655,35 @@ class BuildStepTestCase(BaseModelTestCase):
         self.assertEqual('Foo baz', steps[1].description)
         self.assertEqual(BuildStep.FAILURE, steps[1].status)
 
+    def test_select_many(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.executemany("INSERT INTO bitten_step VALUES (%s,%s,%s,%s,%s,%s)",
+                           [(1, 'test', 'Foo bar', BuildStep.SUCCESS, 1, 2),
+                            (1, 'dist', 'Foo baz', BuildStep.FAILURE, 2, 3),
+                            (2, 'test', 'Foo bar', BuildStep.FAILURE, 4, 5),
+                            (3, 'test', 'Foo bar', BuildStep.SUCCESS, 6, 7)])
+        cursor.executemany("INSERT INTO bitten_error VALUES (%s,%s,%s,%s)",
+                           [(1, 'dist', 'Foo', 0), (1, 'dist', 'Bar', 1),
+                            (2, 'test', 'Baz', 0)])
+
+        steps = BuildStep.select_many(self.env, [1, 2, 4])
+        self.assertEqual([1, 2, 4], sorted(steps.keys()))
+        self.assertEqual(['test', 'dist'], [step.name for step in steps[1]])
+        self.assertEqual('Foo baz', steps[1][1].description)
+        self.assertEqual(BuildStep.FAILURE, steps[1][1].status)
+        self.assertEqual(2, steps[1][1].started)
+        self.assertEqual([], steps[1][0].errors)
+        self.assertEqual(['Foo', 'Bar'], steps[1][1].errors)
+        self.assertEqual(['Baz'], steps[2][0].errors)
+        self.assertEqual(True, steps[2][0].exists)
+        self.assertEqual([], steps[4])
+
+        steps = BuildStep.select_many(self.env, [1, 3],
+                                      status=BuildStep.FAILURE)
+        self.assertEqual(['dist'], [step.name for step in steps[1]])
+        self.assertEqual([], steps[3])
+
 
 class BuildLogTestCase(BaseModelTestCase):
 
@@ -463,6 +740,30 @@ class BuildLogTestCase(BaseModelTestCase):
             os.remove(full_file)
         assert not file_exists
 
+    def test_append(self):
+        log = BuildLog(self.env, build=1, step='test', generator='distutils')
+        log.insert()
+        log.append([(BuildLog.INFO, 'running tests')])
+        log.append([(BuildLog.ERROR, 'tests failed')])
+
+        log = BuildLog.fetch(self.env, log.id)
+        self.assertEqual([(BuildLog.INFO, 'running tests'),
+                          (BuildLog.ERROR, 'tests failed')], log.messages)
+
+    def test_fetch_last(self):
+        self.assertEqual(None, BuildLog.fetch_last(self.env, 1, 'test'))
+        BuildLog(self.env, build=1, step='test', generator='foo',
+                 orderno=0).insert()
+        BuildLog(self.env, build=1, step='test', generator='bar',
+                 orderno=1).insert()
+        BuildLog(self.env, build=1, step='other', generator='baz',
+                 orderno=2).insert()
+
+        log = BuildLog.fetch_last(self.env, 1, 'test')
+        self.assertEqual('bar', log.generator)
+        self.assertEqual(1, log.orderno)
+        self.assertEqual(True, log.exists)
+
     def test_insert_no_build_or_step(self):
         log = BuildLog(self.env, step='test')
         self.assertRaises(AssertionError, log.insert) # No build
@@ -635,6 +936,17 @@ class ReportTestCase(BaseModelTestCase):
                 seen_bar = True
         self.assertEquals((True, True), (seen_foo, seen_bar))
 
+    def test_add_items(self):
+        report = Report(self.env, build=1, step='test', category='test')
+        report.items = [{'file': 'tests/foo.c', 'status': 'failure'}]
+        report.insert()
+        report.add_items([{'file': 'tests/bar.c', 'status': 'success'},
+                          {'file': 'tests/baz.c', 'status': 'success'}])
+
+        report = Report.fetch(self.env, report.id)
+        self.assertEqual(['tests/foo.c', 'tests/bar.c', 'tests/baz.c'],
+                         [item['file'] for item in report.items])
+
     def test_insert_dupe(self):
         report = Report(self.env, build=1, step='test', category='test',
                         generator='unittest')
@@ -19,7 +19,8 @@ from trac.db import DatabaseManager
 from trac.test import EnvironmentStub, Mock
 from trac.util.datefmt import to_datetime, utc
 from bitten.model import BuildConfig, TargetPlatform, Build, schema
-from bitten.queue import BuildQueue, collect_changes
+from bitten.queue import BuildQueue, collect_changes, \
+                         invalidate_platform_index
 
 
 class CollectChangesTestCase(unittest.TestCase):
@@ -122,6 +123,51 @@ class CollectChangesTestCase(unittest.TestCase):
         self.assertEqual(123, retval[0][1])
         self.assertEqual(120, retval[1][1])
 
+    def test_existing_builds(self):
+        self.env.get_repository = lambda authname=None: Mock(
+            get_node=lambda path, rev=None: Mock(
+                get_entries=lambda: [Mock(), Mock()],
+                get_history=lambda: [('somepath', 123, 'edit'),
+                                     ('somepath', 121, 'edit')]
+            ),
+            normalize_path=lambda path: path,
+            rev_older_than=lambda rev1, rev2: rev1 < rev2
+        )
+        platform2 = TargetPlatform(self.env, config='test', name='Bar')
+        platform2.insert()
+        build = Build(self.env, config='test', platform=self.platform.id,
+                      rev=121, rev_time=42)
+        build.insert()
+
+        retval = list(collect_changes(self.env.get_repository(), self.config))
+        self.assertEqual([(platform2.id, 123, None),
+                          (self.platform.id, 123, None),
+                          (platform2.id, 121, None),
+                          (self.platform.id, 121, build.id)],
+                         [(platform.id, rev, build and build.id)
+                          for platform, rev, build in retval])
+
+    def test_empty_dir_cached(self):
+        nodes = []
+        def _mock_get_node(path, rev=None):
+            nodes.append(rev)
+            return Mock(
+                get_entries=lambda: [Mock(), Mock()],
+                get_history=lambda: [('somepath', 123, 'edit'),
+                                     ('somepath', 121, 'edit')]
+            )
+        self.env.get_repository = lambda authname=None: Mock(
+            get_node=_mock_get_node,
+            normalize_path=lambda path: path,
+            rev_older_than=lambda rev1, rev2: rev1 < rev2
+        )
+
+        list(collect_changes(self.env.get_repository(), self.config))
+        self.assertEqual([None, 123, 121], nodes)
+        del nodes[:]
+        list(collect_changes(self.env.get_repository(), self.config))
+        self.assertEqual([None], nodes)
+
 
 class BuildQueueTestCase(unittest.TestCase):
 
@@ -269,6 +315,80 @@ class BuildQueueTestCase(unittest.TestCase):
         self.assertEqual(platform2.id, builds[5].platform)
         self.assertEqual('120', builds[5].rev)
 
+    def test_populate_incremental(self):
+        history = [('somepath', 121, 'edit'), ('somepath', 120, 'edit')]
+        examined = []
+        def get_history():
+            for path, rev, chg in history:
+                examined.append(rev)
+                yield path, rev, chg
+        self.env.get_repository = lambda authname=None: Mock(
+            get_changeset=lambda rev: Mock(date=to_datetime(rev * 1000, utc)),
+            get_node=lambda path, rev=None: Mock(
+                get_entries=lambda: [Mock(), Mock()],
+                get_history=get_history
+            ),
+            normalize_path=lambda path: path,
+            rev_older_than=lambda rev1, rev2: int(rev1) < int(rev2)
+        )
+        config = BuildConfig(self.env, 'test', path='somepath', active=True)
+        config.insert()
+        platform1 = TargetPlatform(self.env, config='test', name='P1')
+        platform1.insert()
+
+        queue = BuildQueue(self.env)
+        queue.populate()
+        self.assertEqual('121', config.get_scanned_rev())
+        builds = list(Build.select(self.env, config='test'))
+        self.assertEqual(['121'], [build.rev for build in builds])
+
+        # Only the new changesets are looked at
+        history.insert(0, ('somepath', 123, 'edit'))
+        del examined[:]
+        queue.populate()
+        self.assertEqual([123, 121], examined)
+        self.assertEqual('123', config.get_scanned_rev())
+        # The pending build of the older revision is obsolete now, and
+        # removed by the next sweep
+        self.assertEqual(['121', '123'],
+                         sorted([build.rev for build in
+                                 Build.select(self.env, config='test')]))
+        self.assertEqual(1, queue.delete_obsolete_builds())
+        builds = list(Build.select(self.env, config='test'))
+        self.assertEqual(['123'], [build.rev for build in builds])
+
+        # Nothing new, nothing to do
+        del examined[:]
+        queue.populate()
+        self.assertEqual([123], examined)
+
+        # Updating the configuration triggers a full rescan
+        config.update()
+        del examined[:]
+        queue.populate()
+        self.assertEqual([123, 121], examined)
+
+    def test_populate_incremental_stabilize_wait(self):
+        now = int(time.time())
+        self.env.get_repository = lambda authname=None: Mock(
+            get_changeset=lambda rev: Mock(date=to_datetime(now - 10, utc)),
+            get_node=lambda path, rev=None: Mock(
+                get_entries=lambda: [Mock(), Mock()],
+                get_history=lambda: [('somepath', 123, 'edit')]
+            ),
+            normalize_path=lambda path: path,
+            rev_older_than=lambda rev1, rev2: int(rev1) < int(rev2)
+        )
+        config = BuildConfig(self.env, 'test', path='somepath', active=True)
+        config.insert()
+        TargetPlatform(self.env, config='test', name='P1').insert()
+
+        queue = BuildQueue(self.env, stabilize_wait=3600)
+        queue.populate()
+        self.assertEqual([], list(Build.select(self.env, config='test')))
+        # The delayed revision needs to be examined again later
+        self.assertEqual(None, config.get_scanned_rev())
+
     def test_populate_thread_race_condition(self):
         messages = []
         self.env.log = Mock(info=lambda msg, *args: messages.append(msg))
@@ -337,6 +457,19 @@ class BuildQueueTestCase(unittest.TestCase):
         self.assertEqual(True, queue.should_delete_build(build, self.repos))
         self.assert_("platform no longer exists" in messages[0])
 
+    def test_should_delete_build_platform_and_config_dont_exist(self):
+        out = []
+        self.env.log = Mock(
+                        info=lambda msg, *args: out.extend([msg] + list(args)))
+        build = Build(self.env, config='does_not_exist', rev=42,
+                        platform=4711, rev_time=123456)
+        build.insert()
+        queue = BuildQueue(self.env, build_all=True)
+
+        self.assertEqual(True, queue.should_delete_build(build, self.repos))
+        self.assert_("platform no longer exists" in out[0])
+        self.assertEquals('unknown config "does_not_exist"', out[1])
+
     def test_should_delete_build_config_deactivated(self):
         messages = []
         self.env.log = Mock(info=lambda msg, *args: messages.append(msg))
@@ -408,6 +541,125 @@ class BuildQueueTestCase(unittest.TestCase):
         self.assertEqual(True, queue.should_delete_build(build1, self.repos))
         self.assert_("more recent build exists" in messages[0])
 
+    def test_get_build_for_slave_most_recent(self):
+        BuildConfig(self.env, 'test', active=True).insert()
+        platform = TargetPlatform(self.env, config='test', name='Foo')
+        platform.insert()
+        build1 = Build(self.env, config='test', platform=platform.id, rev=123,
+                       rev_time=42, status=Build.PENDING)
+        build1.insert()
+        build2 = Build(self.env, config='test', platform=platform.id, rev=124,
+                       rev_time=43, status=Build.PENDING)
+        build2.insert()
+
+        queue = BuildQueue(self.env)
+        build = queue.get_build_for_slave('foobar', {})
+        self.assertEqual(build2.id, build.id)
+        self.assertEqual(Build.IN_PROGRESS,
+                         Build.fetch(self.env, build2.id).status)
+        # The older revision is not handed out, as a newer build exists
+        self.assertEqual(None, queue.get_build_for_slave('foobar', {}))
+
+        queue = BuildQueue(self.env, build_all=True)
+        build = queue.get_build_for_slave('foobar', {})
+        self.assertEqual(build1.id, build.id)
+
+    def test_get_build_for_slave_outside_revision_range(self):
+        self.repos.rev_older_than = lambda rev1, rev2: int(rev1) < int(rev2)
+        BuildConfig(self.env, 'test', active=True, max_rev=123).insert()
+        platform = TargetPlatform(self.env, config='test', name='Foo')
+        platform.insert()
+        build1 = Build(self.env, config='test', platform=platform.id, rev=123,
+                       rev_time=42, status=Build.PENDING)
+        build1.insert()
+        build2 = Build(self.env, config='test', platform=platform.id, rev=124,
+                       rev_time=43, status=Build.PENDING)
+        build2.insert()
+
+        queue = BuildQueue(self.env, build_all=True)
+        build = queue.get_build_for_slave('foobar', {})
+        self.assertEqual(build1.id, build.id)
+        self.assertEqual(None, Build.fetch(self.env, build2.id))
+
+    def test_get_build_for_slave_already_claimed(self):
+        BuildConfig(self.env, 'test', active=True).insert()
+        platform = TargetPlatform(self.env, config='test', name='Foo')
+        platform.insert()
+        build1 = Build(self.env, config='test', platform=platform.id, rev=123,
+                       rev_time=42, status=Build.PENDING)
+        build1.insert()
+        build2 = Build(self.env, config='test', platform=platform.id, rev=124,
+                       rev_time=43, status=Build.PENDING)
+        build2.insert()
+
+        queue = BuildQueue(self.env, build_all=True)
+        next_pending_build = queue._next_pending_build
+        def _next_pending_build(platforms, db):
+            build = next_pending_build(platforms, db)
+            if build and build.id == build2.id:
+                # Simulate another slave claiming the build concurrently
+                Build.fetch(self.env, build.id).claim('other')
+            return build
+        queue._next_pending_build = _next_pending_build
+
+        build = queue.get_build_for_slave('foobar', {})
+        self.assertEqual(build1.id, build.id)
+        self.assertEqual('foobar', Build.fetch(self.env, build1.id).slave)
+        self.assertEqual('other', Build.fetch(self.env, build2.id).slave)
+
+    def test_delete_obsolete_builds(self):
+        self.repos.rev_older_than = lambda rev1, rev2: int(rev1) < int(rev2)
+        BuildConfig(self.env, 'test', active=True, min_rev=100).insert()
+        BuildConfig(self.env, 'inactive').insert()
+        platform = TargetPlatform(self.env, config='test', name='Foo')
+        platform.insert()
+        other = TargetPlatform(self.env, config='inactive', name='Foo')
+        other.insert()
+
+        def insert_build(config, platform, rev, status=Build.PENDING):
+            build = Build(self.env, config=config, platform=platform, rev=rev,
+                          rev_time=rev, status=status,
+                          slave=status != Build.PENDING and 'heinz' or None)
+            build.insert()
+            return build.id
+        newest = insert_build('test', platform.id, 124)
+        insert_build('test', platform.id, 123)
+        insert_build('test', platform.id, 99, status=Build.SUCCESS)
+        insert_build('test', platform.id + 10, 124)
+        insert_build('inactive', other.id, 124)
+        insert_build('gone', platform.id, 124)
+
+        BuildQueue(self.env, build_all=True).delete_obsolete_builds()
+        self.assertEqual(['123', '124', '99'],
+                         sorted([build.rev for build in
+                                 Build.select(self.env)]))
+
+        BuildQueue(self.env).delete_obsolete_builds()
+        self.assertEqual([(newest, Build.PENDING), (None, Build.SUCCESS)],
+                         [(build.status == Build.PENDING and build.id or None,
+                           build.status) for build in Build.select(self.env)])
+
+    def test_delete_obsolete_builds_throttled(self):
+        BuildConfig(self.env, 'inactive').insert()
+        platform = TargetPlatform(self.env, config='inactive', name='Foo')
+        platform.insert()
+        self.env.get_repository = lambda authname=None: Mock(
+            get_node=lambda path, rev=None: Mock(get_history=lambda: []))
+
+        def insert_build(rev):
+            build = Build(self.env, config='inactive', platform=platform.id,
+                          rev=rev, rev_time=rev)
+            build.insert()
+        insert_build(123)
+        queue = BuildQueue(self.env)
+        queue.populate()
+        self.assertEqual(0, Build.count(self.env))
+
+        # Populating the queue again right away does not sweep again
+        insert_build(124)
+        queue.populate()
+        self.assertEqual(1, Build.count(self.env))
+
     def test_reset_orphaned_builds(self):
         BuildConfig(self.env, 'test').insert()
         platform = TargetPlatform(self.env, config='test', name='Foo')
@@ -428,6 +680,32 @@ class BuildQueueTestCase(unittest.TestCase):
         self.assertEqual(Build.IN_PROGRESS,
                          Build.fetch(self.env, build2.id).status)
 
+    def test_reset_orphaned_builds_throttled(self):
+        BuildConfig(self.env, 'test', active=True).insert()
+        platform = TargetPlatform(self.env, config='test', name='Foo')
+        platform.rules.append(('family', 'nt'))
+        platform.insert()
+        build = Build(self.env, config='test', platform=platform.id, rev=123,
+                      rev_time=42, status=Build.IN_PROGRESS, slave='heinz',
+                      last_activity=time.time() - 600) # active ten minutes ago
+        build.insert()
+
+        # The polling slave does not match the platform, so the reset build
+        # stays pending
+        queue = BuildQueue(self.env, timeout=300) # 5 minutes timeout
+        queue.get_build_for_slave('heinz', {'family': 'posix'})
+        self.assertEqual(Build.PENDING, Build.fetch(self.env, build.id).status)
+
+        # A second poll right away does not sweep again
+        Build.fetch(self.env, build.id).claim('heinz')
+        db = self.env.get_db_cnx()
+        db.cursor().execute("UPDATE bitten_build SET last_activity=%s "
+                            "WHERE id=%s", (int(time.time()) - 600, build.id))
+        db.commit()
+        queue.get_build_for_slave('heinz', {'family': 'posix'})
+        self.assertEqual(Build.IN_PROGRESS,
+                         Build.fetch(self.env, build.id).status)
+
     def test_match_slave_match(self):
         BuildConfig(self.env, 'test', active=True).insert()
         platform = TargetPlatform(self.env, config='test', name="Unix")
@@ -507,6 +785,26 @@ class BuildQueueTestCase(unittest.TestCase):
         platforms = queue.match_slave('foo', {'version': '7.8.1'})
         self.assertEqual([], platforms)
 
+    def test_match_slave_cached(self):
+        BuildConfig(self.env, 'test', active=True).insert()
+        platform = TargetPlatform(self.env, config='test', name="Unix")
+        platform.rules.append(('family', 'posix'))
+        platform.insert()
+
+        queue = BuildQueue(self.env)
+        platforms = queue.match_slave('foo', {'family': 'posix'})
+        self.assertEqual([platform.id], [p.id for p in platforms])
+
+        platform2 = TargetPlatform(self.env, config='test', name="Any")
+        platform2.insert()
+        platforms = queue.match_slave('foo', {'family': 'posix'})
+        self.assertEqual([platform.id], [p.id for p in platforms])
+
+        invalidate_platform_index(self.env)
+        platforms = queue.match_slave('foo', {'family': 'posix'})
+        self.assertEqual([platform2.id, platform.id],
+                         [p.id for p in platforms])
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -8,13 +8,28 @@
 # you should have received as part of this distribution. The terms
 # are also available at http://bitten.edgewall.org/wiki/License.
 
+import BaseHTTPServer
+import cgi
+import doctest
+import errno
+import gzip
+import httplib
 import os
 import sys
 import shutil
+import socket
 import tempfile
+import threading
 import unittest
+import urllib2
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
 
-from bitten.slave import BuildSlave, ExitSlave
+from bitten import slave as slave_module
+from bitten.slave import BuildSlave, ExitSlave, LogStreamer, MultipartBody, \
+                         PooledHTTPHandler, ResultUploader, StreamedBody
+from bitten.build import BuildError
+from bitten.recipe import Context
 from bitten.util import xmlio
 from bitten.slave import encode_multipart_formdata
 
@@ -40,6 +55,25 @@ class TestSlave(BuildSlave):
         finally:
             self.local, self.request = old_local, old_request
 
+class DummyStep(object):
+    def __init__(self, id):
+        self.id = id
+
+class DummyPollResponse(DummyResponse):
+    def __init__(self, code, headers):
+        DummyResponse.__init__(self, code)
+        self.headers = headers
+
+    def info(self):
+        return self.headers
+
+class SlotSlave(BuildSlave):
+
+    def _initiate_build(self, build_url):
+        fd = file(os.path.join(self.work_dir, 'build'), 'w')
+        fd.write('%s %d' % (build_url, os.getpid()))
+        fd.close()
+
 class BuildSlaveTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -69,6 +103,82 @@ class BuildSlaveTestCase(unittest.TestCase):
         self.slave = BuildSlave([], work_dir=self.work_dir)
         self.assertRaises(ExitSlave, self.slave.quit)
 
+    def test_create_build_long_poll(self):
+        slave = BuildSlave(['http://example.org/trac'], work_dir=self.work_dir,
+                           long_poll=60)
+        requests = []
+        def request(method, url, body=None, headers=None):
+            requests.append(xmlio.parse(body))
+            return DummyPollResponse(204, {'X-Bitten-Long-Poll': '60'})
+        slave.request = request
+        self.assertEqual(False, slave._create_build(slave.urls[0]))
+        self.assertEqual('60', requests[0].attr['wait'])
+        self.assertEqual(True, slave.long_polled)
+
+    def test_create_build_long_poll_unsupported(self):
+        slave = BuildSlave(['http://example.org/trac'], work_dir=self.work_dir,
+                           long_poll=60)
+        slave.request = lambda method, url, body=None, headers=None: \
+                            DummyPollResponse(204, {})
+        self.assertEqual(False, slave._create_build(slave.urls[0]))
+        self.assertEqual(False, slave.long_polled)
+
+    def test_slots(self):
+        slave = SlotSlave(['http://example.org/trac'], work_dir=self.work_dir,
+                          slots=2)
+        build_ids = iter([1, 2])
+        slave.request = lambda method, url, body=None, headers=None: \
+                DummyPollResponse(201, {'location':
+                    'http://example.org/trac/builds/%d' % build_ids.next()})
+        self.assertEqual(True, slave._create_build(slave.urls[0]))
+        self.assertEqual(True, slave._create_build(slave.urls[0]))
+        self.assertEqual([0, 1], sorted(slave.workers))
+        workers = slave.workers.values()
+        slave._join_workers()
+        self.assertEqual({}, slave.workers)
+        self.assertEqual([0, 0], [worker.exitcode for worker in workers])
+
+        for slot, build_id in [(0, 1), (1, 2)]:
+            fd = file(os.path.join(self.work_dir, 'slot%d' % slot, 'build'))
+            build_url, pid = fd.read().split()
+            fd.close()
+            self.assertEqual('http://example.org/trac/builds/%d' % build_id,
+                             build_url)
+            self.assertNotEqual(os.getpid(), int(pid))
+
+    def test_upload_file_chunks(self):
+        slave = BuildSlave(['http://example.org/trac'], work_dir=self.work_dir)
+        slave.upload_chunk_size = 4
+        received = []
+        # The response to the second chunk gets lost
+        errors = [None, socket.error('Connection reset by peer')]
+        def request(method, url, body=None, headers=None):
+            self.assertEqual(str(len(body)), headers['Content-Length'])
+            form = cgi.FieldStorage(fp=StringIO(body.read()), environ={
+                'REQUEST_METHOD': 'POST',
+                'CONTENT_TYPE': headers['Content-Type']})
+            offset = int(form['offset'].value)
+            if offset != len(''.join(received)):
+                raise urllib2.HTTPError(url, 409, 'Conflict', {
+                    'X-Bitten-Upload-Offset': str(len(''.join(received)))
+                }, None)
+            received.append(form['file'].value)
+            error = errors and errors.pop(0)
+            if error:
+                raise error
+            if len(''.join(received)) < int(form['size'].value):
+                return DummyPollResponse(202, {
+                    'X-Bitten-Upload-Offset': str(len(''.join(received)))
+                })
+            return DummyPollResponse(201, {})
+        slave.request = request
+
+        resp = slave._upload_file('http://example.org/trac/builds/1/attach/'
+                                  'build', {'description': 'foo'}, 'foo.txt',
+                                  StringIO('hello world!'), 12)
+        self.assertEqual(201, resp.code)
+        self.assertEqual(['hell', 'o wo', 'rld!'], received)
+
     def test_simple_recipe(self):
         results = self._run_slave("""
         <build xmlns:sh="http://bitten.edgewall.org/tools/sh"
@@ -103,6 +213,380 @@ class BuildSlaveTestCase(unittest.TestCase):
         self.assertEqual(str(msg).decode("utf-8"),
             u'<message level="info">\uFFFD</message>')
 
+class LogStreamerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.error = None
+        self.slave = BuildSlave([], work_dir=tempfile.mkdtemp())
+        self.slave.stream_logs = True
+        self.slave.request = self._request
+
+    def tearDown(self):
+        shutil.rmtree(self.slave.work_dir)
+
+    def _request(self, method, url, body=None, headers=None):
+        if self.error:
+            if isinstance(self.error, int):
+                raise urllib2.HTTPError(url, self.error, 'Error', {}, None)
+            raise self.error
+        body = body.read()
+        self.assertEqual(str(len(body)), headers['Content-Length'])
+        self.requests.append((url, xmlio.parse(body)))
+        return DummyResponse(201)
+
+    def _message(self, text):
+        return xmlio.Fragment()[xmlio.Element('message', level='info')[text]]
+
+    def test_log(self):
+        step = DummyStep('test step')
+        streamer = LogStreamer(self.slave, 'http://example.org/builds/1',
+                               step, 0)
+        streamer.log('sh#exec', self._message('foo'))
+        streamer.log('sh#exec', xmlio.Fragment())
+        self.assertEqual(1, len(self.requests))
+        url, xml = self.requests[0]
+        self.assertEqual('http://example.org/builds/1/steps/test%20step/log',
+                         url)
+        self.assertEqual('sh#exec', xml.attr['generator'])
+        self.assertEqual(['foo'], [m.gettext() for m in xml.children()])
+        self.assertEqual([], streamer.close())
+
+    def test_log_interval(self):
+        streamer = LogStreamer(self.slave, 'http://example.org/builds/1',
+                               DummyStep('test'), 3600)
+        streamer.log('sh#exec', self._message('foo'))
+        streamer.log('sh#exec', self._message('bar'))
+        streamer.log('python#unittest', self._message('baz'))
+        self.assertEqual([], self.requests)
+
+        # Consecutive output of the same generator is sent together
+        self.assertEqual([], streamer.close())
+        self.assertEqual(['sh#exec', 'python#unittest'],
+                         [xml.attr['generator'] for _, xml in self.requests])
+        self.assertEqual(['foo', 'bar'],
+                         [m.gettext() for m in self.requests[0][1].children()])
+
+    def test_log_unsupported(self):
+        self.error = 404
+        streamer = LogStreamer(self.slave, 'http://example.org/builds/1',
+                               DummyStep('test'), 0)
+        foo = self._message('foo')
+        streamer.log('sh#exec', foo)
+        self.assertEqual(False, self.slave.stream_logs)
+        self.assertEqual([('sh#exec', str(foo))],
+                         [(generator, str(xml))
+                          for generator, xml in streamer.close()])
+
+    def test_log_rejected(self):
+        self.error = 500
+        ctxt = Context(self.slave.work_dir)
+        streamer = LogStreamer(self.slave, 'http://example.org/builds/1',
+                               DummyStep('test'), 0, ctxt)
+        ctxt.log_handler = streamer.log
+        ctxt.generator = 'sh#exec'
+        ctxt.log(self._message('foo'))
+        # Further output goes to the step result instead
+        self.assertEqual(None, ctxt.log_handler)
+        ctxt.log(self._message('bar'))
+        self.assertEqual(1, len(ctxt.output))
+        self.assertEqual(1, len(streamer.close()))
+
+    def test_log_master_unreachable(self):
+        self.error = urllib2.URLError(socket.error(111, 'refused'))
+        streamer = LogStreamer(self.slave, 'http://example.org/builds/1',
+                               DummyStep('test'), 0)
+        for idx in range(5):
+            streamer.log('sh#exec', self._message(str(idx)))
+        streamer.log('python#unittest', self._message('5'))
+        # Output of the same generator is collected in one spooled fragment
+        self.assertEqual(['sh#exec', 'python#unittest'],
+                         [generator for generator, _ in streamer.pending])
+        self.assert_(isinstance(streamer.pending[0][1],
+                                xmlio.SpooledFragment))
+
+        self.error = None
+        self.assertEqual([], streamer.close())
+        self.assertEqual([str(idx) for idx in range(5)],
+                         [m.gettext() for m in self.requests[0][1].children()])
+
+class ResultUploaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.errors = {}
+        self.released = threading.Event()
+        self.released.set()
+        self.slave = BuildSlave([], work_dir=tempfile.mkdtemp())
+        self.slave.request = self._request
+        self.spool_dir = os.path.join(self.slave.work_dir, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.slave.work_dir)
+
+    def _request(self, method, url, body=None, headers=None):
+        self.released.wait()
+        if hasattr(body, 'read'):
+            body = body.read()
+            self.assertEqual(str(len(body)), headers['Content-Length'])
+        error = self.errors.get(body)
+        if isinstance(error, list):
+            error = error and error.pop(0)
+        if isinstance(error, int):
+            raise urllib2.HTTPError(url, error, 'Error', {}, None)
+        elif error:
+            raise error
+        self.requests.append((url, body))
+        return DummyResponse(201)
+
+    def test_upload(self):
+        uploader = ResultUploader(self.slave, self.spool_dir)
+        uploader.start()
+        self.released.clear()
+        for body in ('foo', 'bar', 'baz'):
+            uploader.upload('http://example.org/builds/1/steps/', body, {})
+        self.assertEqual(True, uploader.pending())
+        self.released.set()
+        uploader.close()
+        self.assertEqual(False, uploader.pending())
+        self.assertEqual(['foo', 'bar', 'baz'],
+                         [body for _, body in self.requests])
+
+    def test_upload_rejected(self):
+        self.errors['foo'] = 409
+        uploader = ResultUploader(self.slave, self.spool_dir)
+        uploader.start()
+        uploader.upload('http://example.org/builds/1/steps/', 'foo', {})
+        uploader.upload('http://example.org/builds/1/steps/', 'bar', {})
+        self.assertRaises(urllib2.HTTPError, uploader.close)
+        self.assertEqual([], self.requests)
+        self.assertRaises(urllib2.HTTPError, uploader.upload,
+                          'http://example.org/builds/1/steps/', 'baz', {})
+
+    def test_upload_replayed(self):
+        # The master is down for a while
+        self.errors['foo'] = [urllib2.URLError(socket.error(111, 'refused'))]
+        uploader = ResultUploader(self.slave, self.spool_dir)
+        uploader.start()
+        uploader.upload('http://example.org/builds/1/steps/', 'foo', {})
+        uploader.upload('http://example.org/builds/1/steps/', 'bar', {})
+        uploader.close()
+        self.assertEqual(['foo', 'bar'], [body for _, body in self.requests])
+        self.assertEqual(False, os.path.exists(self.spool_dir))
+
+    def test_upload_already_received(self):
+        # The response to the step result is lost, and the master rejects
+        # the result when it is sent again
+        self.errors['foo'] = [urllib2.URLError(socket.error(104, 'reset')),
+                              409]
+        uploader = ResultUploader(self.slave, self.spool_dir)
+        uploader.start()
+        uploader.upload('http://example.org/builds/1/steps/', 'foo', {})
+        uploader.upload('http://example.org/builds/1/steps/', 'bar', {})
+        uploader.close()
+        self.assertEqual(['bar'], [body for _, body in self.requests])
+
+    def test_upload_xml(self):
+        uploader = ResultUploader(self.slave, self.spool_dir)
+        uploader.start()
+        log = xmlio.SpooledFragment(max_size=2)
+        for idx in range(5):
+            log.append(xmlio.Element('message')[idx])
+        xml = xmlio.Element('result')[xmlio.Element('log')[log]]
+        uploader.upload('http://example.org/builds/1/steps/', xml, {},
+                        compress=True)
+        uploader.close()
+        body = gzip.GzipFile(fileobj=StringIO(self.requests[0][1])).read()
+        self.assertEqual(str(xml), body)
+        self.assertEqual(5, len(list(xmlio.parse(body).children('log'
+                                                    ).next().children())))
+
+    def test_upload_replay_timeout(self):
+        self.errors['foo'] = urllib2.URLError(socket.error(111, 'refused'))
+        uploader = ResultUploader(self.slave, self.spool_dir, timeout=0)
+        uploader.start()
+        uploader.upload('http://example.org/builds/1/steps/', 'foo', {})
+        self.assertRaises(urllib2.URLError, uploader.close)
+
+    def test_attach(self):
+        uploads = []
+        def upload_file(url, fields, filename, fileobj, size):
+            uploads.append((url, fields, filename, fileobj.read(), size))
+            return DummyResponse(201)
+        self.slave._upload_file = upload_file
+        uploader = ResultUploader(self.slave, self.spool_dir)
+        fileobj = StringIO('hello world')
+        uploader.attach('http://example.org/builds/1/attach/build',
+                        {'description': 'foo'}, 'foo.txt', fileobj)
+        # The file has been copied to the spool
+        fileobj.close()
+        self.assertEqual(1, len(os.listdir(self.spool_dir)))
+        uploader.start()
+        uploader.close()
+        self.assertEqual([('http://example.org/builds/1/attach/build',
+                           {'description': 'foo'}, 'foo.txt', 'hello world',
+                           11)], uploads)
+
+    def test_attach_failed(self):
+        def upload_file(url, fields, filename, fileobj, size):
+            return DummyResponse(500)
+        self.slave._upload_file = upload_file
+        uploader = ResultUploader(self.slave, self.spool_dir)
+        uploader.start()
+        uploader.attach('http://example.org/builds/1/attach/build', {},
+                        'foo.txt', StringIO('hello world'))
+        uploader.drain()
+        errors = uploader.attach_errors()
+        self.assertEqual(1, len(errors))
+        self.assert_(isinstance(errors[0], BuildError))
+        self.assertEqual([], uploader.attach_errors())
+        # Only the step is failed, later results are still sent
+        uploader.upload('http://example.org/builds/1/steps/', 'foo', {})
+        uploader.close()
+        self.assertEqual(['foo'], [body for _, body in self.requests])
+
+    def test_log_waits_for_upload(self):
+        self.slave.uploader = ResultUploader(self.slave, self.spool_dir)
+        self.slave.uploader.start()
+        self.released.clear()
+        self.slave.uploader.upload('http://example.org/builds/1/steps/',
+                                   'foo', {})
+        streamer = LogStreamer(self.slave, 'http://example.org/builds/1',
+                               DummyStep('test'), 0)
+        streamer.log('sh#exec', xmlio.Fragment()[
+            xmlio.Element('message', level='info')['bar']
+        ])
+        self.released.set()
+        self.slave.uploader.close()
+        self.assertEqual(1, len(self.requests))
+        self.assertEqual([], streamer.close())
+        self.assertEqual('http://example.org/builds/1/steps/test/log',
+                         self.requests[1][0])
+
+class DummyMasterHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(201)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # Drop the connection without telling the client
+        self.close_connection = self.server.drop_connections
+
+    def log_message(self, *args):
+        pass
+
+class DummyMaster(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    connections = 0
+    drop_connections = False
+
+    def __init__(self, *args):
+        BaseHTTPServer.HTTPServer.__init__(self, *args)
+        self.closed = threading.Event()
+
+    def shutdown_request(self, request):
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+        self.closed.set()
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='bitten_test')
+        self.master = DummyMaster(('127.0.0.1', 0), DummyMasterHandler)
+        self.thread = threading.Thread(target=self.master.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/trac/builds' % \
+                        self.master.server_port
+        self.slave = BuildSlave([self.url], work_dir=self.work_dir)
+
+    def tearDown(self):
+        self.slave.connections.close()
+        self.master.shutdown()
+        self.thread.join()
+        self.master.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def test_connection_reused(self):
+        for body in ('foo', 'bar', 'baz'):
+            resp = self.slave.request('POST', self.url, body)
+            self.assertEqual(201, resp.code)
+            self.assertEqual(body, resp.read())
+        self.assertEqual(1, self.master.connections)
+
+    def test_connection_closed_by_master(self):
+        self.master.drop_connections = True
+        for body in ('foo', 'bar'):
+            resp = self.slave.request('POST', self.url, body)
+            self.assertEqual(201, resp.code)
+            self.assertEqual(body, resp.read())
+            # The closed connection is not reused
+            self.master.closed.wait(5)
+            self.master.closed.clear()
+        self.assertEqual(2, self.master.connections)
+
+    def _break_idle_connection(self, fail_on_response):
+        class BrokenConnection(object):
+            sock = None
+            def request(self, method, url, body=None, headers={}):
+                body.read(fail_on_response and -1 or 5)
+                if not fail_on_response:
+                    raise socket.error(errno.EPIPE, 'Broken pipe')
+            def getresponse(self):
+                raise httplib.BadStatusLine('')
+            def close(self):
+                pass
+        key = (httplib.HTTPConnection, '127.0.0.1:%d' %
+               self.master.server_port, None)
+        self.slave.connections.put(key, BrokenConnection())
+
+    def test_streamed_body_resent(self):
+        # The body is sent again from the start if the idle connection turns
+        # out to be closed while sending the request
+        self._break_idle_connection(fail_on_response=False)
+        body = StreamedBody(['foo', (StringIO('bar'), 0, 3), 'baz'])
+        resp = self.slave.request('POST', self.url, body)
+        self.assertEqual(201, resp.code)
+        self.assertEqual('foobarbaz', resp.read())
+        self.assertEqual(1, self.master.connections)
+
+    def test_post_not_repeated(self):
+        # The master may have handled a request that was sent completely
+        self._break_idle_connection(fail_on_response=True)
+        body = StreamedBody(['foo', (StringIO('bar'), 0, 3), 'baz'])
+        self.assertRaises(urllib2.URLError, self.slave.request, 'POST',
+                          self.url, body)
+        self.assertEqual(0, self.master.connections)
+
+    def test_connect_older_python(self):
+        # Requests have no timeout before Python 2.6, and tunnels are set up
+        # with _set_tunnel() in Python 2.6
+        connections = []
+        class OldConnection(object):
+            def __init__(self, host, **kwargs):
+                self.host = host
+                self.kwargs = kwargs
+                self.tunnel = None
+                connections.append(self)
+            def set_debuglevel(self, level):
+                pass
+            def _set_tunnel(self, host, headers=None):
+                self.tunnel = (host, headers)
+        class OldRequest(object):
+            pass
+        handler = PooledHTTPHandler(self.slave.connections)
+        conn = handler._connect(OldConnection, 'proxy:3128', OldRequest(),
+                                'example.org:443', {'X-Foo': 'bar'}, {})
+        self.assertEqual([conn], connections)
+        self.assertEqual({}, conn.kwargs)
+        self.assertEqual(('example.org:443', {'X-Foo': 'bar'}), conn.tunnel)
+
 class MultiPartEncodeTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -127,9 +611,30 @@ class MultiPartEncodeTestCase(unittest.TestCase):
                 'contents of foofile\r\n--%s--\r\n' % (
                             boundary,boundary,boundary), body)
 
+    def test_multipart_body(self):
+        fileobj = StringIO('skip contents of foofile')
+        fileobj.seek(5)
+        body = MultipartBody({
+            'foo': 'bar',
+            'foofile': ('test.txt', fileobj, 19),
+        })
+        data = ''.join(iter(lambda: body.read(7), ''))
+        self.assertEquals(len(body), len(data))
+        form = cgi.FieldStorage(fp=StringIO(data), environ={
+            'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': body.content_type})
+        self.assertEquals('bar', form['foo'].value)
+        self.assertEquals('test.txt', form['foofile'].filename)
+        self.assertEquals('contents of foofile', form['foofile'].value)
+        # The body can be sent again
+        self.assertEquals(data, body.read())
+
 def suite():
     suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(slave_module))
     suite.addTest(unittest.makeSuite(BuildSlaveTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(LogStreamerTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ResultUploaderTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ConnectionPoolTestCase, 'test'))
     suite.addTest(unittest.makeSuite(MultiPartEncodeTestCase, 'test'))
     return suite
 
@@ -610,6 +610,18 @@ def add_config_platform_rev_index_to_build(env, db):
     else:
         raise TracError('')
 
+def add_scan_table(env, db):
+    """Add the bitten_scan table for recording the newest revision of each
+    build configuration that has been examined by the build queue."""
+    table = Table('bitten_scan', key='config')[
+                Column('config'), Column('rev')
+            ]
+    cursor = db.cursor()
+
+    connector, _ = DatabaseManager(env)._get_connector()
+    for stmt in connector.to_sql(table):
+        cursor.execute(stmt)
+
 def fix_sequences(env, db):
     """Fixes any auto increment sequences that might have been left in an inconsistent state.
 
@@ -633,4 +645,5 @@ map = {
    10: [add_config_platform_rev_index_to_build, fix_sequences],
    11: [fix_log_levels_misnaming, remove_stray_log_levels_files],
    12: [add_last_activity_to_build],
+   13: [add_scan_table],
 }
@@ -12,6 +12,7 @@ import os
 import shutil
 import tempfile
 import unittest
+from StringIO import StringIO
 
 from bitten.util import xmlio
 
@@ -27,6 +28,24 @@ class XMLIOTestCase(unittest.TestCase):
         x = xmlio.parse(s)
         assert x.name == "build"
 
+    def test_iterparse(self):
+        events = list(xmlio.iterparse(StringIO(
+            '<result step="foo"><log><message level="info">'
+            'b\xc3\xa4r<![CDATA[ <baz> ]]></message></log></result>'),
+            bufsize=8))
+        self.assertEqual([
+            ('start', 'result', {'step': 'foo'}, None),
+            ('start', 'log', {}, None),
+            ('start', 'message', {'level': 'info'}, None),
+            ('end', 'message', {'level': 'info'}, 'b\xc3\xa4r <baz> '),
+            ('end', 'log', {}, ''),
+            ('end', 'result', {'step': 'foo'}, '')
+        ], events)
+
+    def test_iterparse_error(self):
+        events = xmlio.iterparse(StringIO('<result></rsleut>'))
+        self.assertRaises(xmlio.ParseError, list, events)
+
     def test_Element_encoding(self):
         self.assertEquals('<\xc3\xb8\xc3\xbc arg="\xc3\xa9\xe2\x82\xac"/>',
             str(xmlio.Element(u'\xf8\xfc', arg=u'\xe9\u20ac'.encode('utf-8'))))
@@ -68,6 +87,31 @@ class XMLIOTestCase(unittest.TestCase):
         # not basestring
         self.assertEquals(42, xmlio._escape_text(42))
 
+    def test_SpooledFragment_spill(self):
+        frag = xmlio.SpooledFragment(max_size=3)
+        for idx in range(10):
+            frag.append(xmlio.Element('line')['<%d>' % idx])
+        self.assertEquals(1, len(frag.nodes))
+        self.assertEquals('<log>' + ''.join(['<line><![CDATA[<%d>]]></line>'
+                                             % idx for idx in range(10)]) +
+                          '</log>', str(xmlio.Element('log')[frag]))
+
+    def test_SpooledFragment_tail(self):
+        frag = xmlio.SpooledFragment(max_size=2, tail=2,
+                                     omitted=lambda n: 'skipped %d' % n)
+        for idx in range(6):
+            frag.append(xmlio.Element('line')[idx])
+        self.assertEquals('<log>skipped 4<line>4</line><line>5</line></log>',
+                          str(xmlio.Element('log')[frag]))
+
+    def test_SpooledFragment_head(self):
+        frag = xmlio.SpooledFragment(max_size=2, head=1,
+                                     omitted=lambda n: 'skipped %d' % n)
+        for idx in range(6):
+            frag.append(xmlio.Element('line')[idx])
+        self.assertEquals('<log><line>0</line>skipped 5</log>',
+                          str(xmlio.Element('log')[frag]))
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(XMLIOTestCase, 'test'))
@@ -14,16 +14,19 @@ The current implementation uses ``xml.dom.minidom`` under the hood for parsing.
 """
 
 import os
+import shutil
+import tempfile
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
+from collections import deque
 from UserDict import DictMixin
 
 import cgi
 import string
 
-__all__ = ['Fragment', 'Element', 'ParsedElement', 'parse']
+__all__ = ['Fragment', 'Element', 'SpooledFragment', 'ParsedElement', 'parse']
 __docformat__ = 'restructuredtext en'
 
 def _from_utf8(text):
@@ -69,6 +72,17 @@ def _escape_attr(attr):
         return attr
 
 
+def _write_nodes(nodes, out, newlines=False):
+    """Serialize the given elements and text nodes to the output stream."""
+    for node in nodes:
+        if not isinstance(node, basestring):
+            node.write(out, newlines=newlines)
+        elif node.startswith('<'):
+            out.write('<![CDATA[' + _to_utf8(node) + ']]>')
+        else:
+            out.write(_to_utf8(_escape_text(node)))
+
+
 class Fragment(object):
     """A collection of XML elements."""
     __slots__ = ['children']
@@ -107,14 +121,7 @@ class Fragment(object):
         """Serializes the element and writes the XML to the given output
         stream.
         """
-        for child in self.children:
-            if isinstance(child, (Element, ParsedElement)):
-                child.write(out, newlines=newlines)
-            else:
-                if child.startswith('<'):
-                    out.write('<![CDATA[' + _to_utf8(child) + ']]>')
-                else:
-                    out.write(_to_utf8(_escape_text(child)))
+        _write_nodes(self.children, out, newlines)
 
 
 class Element(Fragment):
@@ -202,6 +209,106 @@ class Element(Fragment):
             out.write(os.linesep)
 
 
+class _Spool(object):
+    """Serialized XML kept in a temporary file."""
+    __slots__ = ['fileobj']
+
+    def __init__(self):
+        self.fileobj = tempfile.TemporaryFile()
+
+    def write(self, out, newlines=False):
+        self.fileobj.seek(0)
+        shutil.copyfileobj(self.fileobj, out)
+
+
+class SpooledFragment(Fragment):
+    """A fragment for a possibly very large number of nodes, which only keeps
+    up to `max_size` of them in memory and serializes the rest to a temporary
+    file.
+
+    >>> frag = SpooledFragment(max_size=2)
+    >>> for idx in range(5):
+    ...     frag.append(Element('line')[idx])
+    >>> print Element('log')[frag]
+    <log><line>0</line><line>1</line><line>2</line><line>3</line><line>4</line></log>
+
+    Optionally, only the first `head` and the last `tail` nodes are kept. The
+    nodes in between are dropped, and replaced by the node returned by the
+    `omitted` function for the number of nodes dropped:
+
+    >>> frag = SpooledFragment(head=1, tail=2,
+    ...                        omitted=lambda n: '[%d omitted]' % n)
+    >>> for idx in range(5):
+    ...     frag.append(Element('line')[idx])
+    >>> print Element('log')[frag]
+    <log><line>0</line>[2 omitted]<line>3</line><line>4</line></log>
+    """
+    __slots__ = ['max_size', 'head', 'omitted', 'count', 'dropped', 'nodes',
+                 'spool', 'tail', 'tail_size']
+
+    def __init__(self, max_size=10000, head=None, tail=None, omitted=None):
+        """Create the fragment.
+
+        :param max_size: the number of nodes to keep in memory before writing
+                         them to the temporary file
+        :param head: the number of nodes to keep at the start, if the fragment
+                     should be truncated
+        :param tail: the number of nodes to keep at the end, if the fragment
+                     should be truncated
+        :param omitted: function returning the node to insert where nodes
+                        have been dropped, given their number
+        """
+        self.max_size = max_size
+        if tail is not None and head is None:
+            head = 0
+        self.head = head
+        self.omitted = omitted
+        self.count = 0
+        self.dropped = 0
+        self.nodes = []
+        self.spool = None
+        self.tail = None
+        self.tail_size = tail or 0
+        if head is not None:
+            self.tail = deque()
+
+    def _get_children(self):
+        children = self.nodes[:]
+        if self.spool is not None:
+            children.insert(0, self.spool)
+        if self.dropped and self.omitted is not None:
+            children.append(self.omitted(self.dropped))
+        if self.tail:
+            children += self.tail
+        return children
+    children = property(_get_children, doc="""The child nodes, with those
+    that have been written to the temporary file replaced by a single node
+    (read-only)""")
+
+    def append(self, node):
+        """Append an element or fragment as child."""
+        frag = Fragment()
+        frag.append(node)
+        for child in frag.children:
+            self.count += 1
+            if self.head is not None and self.count > self.head:
+                self.tail.append(child)
+                if len(self.tail) > self.tail_size:
+                    self.tail.popleft()
+                    self.dropped += 1
+                continue
+            self.nodes.append(child)
+            if len(self.nodes) >= self.max_size:
+                self._spill()
+
+    def _spill(self):
+        if self.spool is None:
+            self.spool = _Spool()
+        self.spool.fileobj.seek(0, 2)
+        _write_nodes(self.nodes, self.spool.fileobj)
+        self.nodes = []
+
+
 class ParseError(Exception):
     """Exception thrown when there's an error parsing an XML document."""
 
@@ -224,6 +331,64 @@ def parse(text_or_file):
         raise ParseError(e)
 
 
+def iterparse(fileobj, bufsize=65536):
+    """Incrementally parse an XML document read from a file-like object.
+    
+    Instead of building a tree of the whole document, this reads the document
+    in blocks of `bufsize` bytes and yields an ``(event, name, attr, text)``
+    tuple for every element as soon as it has been parsed:
+    
+     - ``('start', name, attr, None)`` after the start tag of an element
+     - ``('end', name, attr, text)`` after the end tag, where ``text`` is the
+       text content that is directly contained in the element, as returned by
+       `ParsedElement.gettext()`
+    
+    >>> from StringIO import StringIO
+    >>> for event in iterparse(StringIO('<root a="1"><b>foo</b></root>')):
+    ...     print event
+    ('start', u'root', {'a': '1'}, None)
+    ('start', u'b', {}, None)
+    ('end', u'b', {}, 'foo')
+    ('end', u'root', {'a': '1'}, '')
+    
+    Attribute values and text are returned as utf-8 strings.
+    
+    :raise ParseError: if the document is not well-formed
+    """
+    from xml.parsers import expat
+    events = []
+    stack = []
+
+    def start_element(name, attrs):
+        attr = dict([(_to_utf8(key), _to_utf8(value))
+                     for key, value in attrs.items()])
+        stack.append((name, attr, []))
+        events.append(('start', name, attr, None))
+    def end_element(name):
+        name, attr, text = stack.pop()
+        events.append(('end', name, attr, _to_utf8(u''.join(text))))
+    def character_data(data):
+        if stack:
+            stack[-1][2].append(data)
+
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    try:
+        while True:
+            data = fileobj.read(bufsize)
+            parser.Parse(data, not data)
+            for event in events:
+                yield event
+            del events[:]
+            if not data:
+                break
+    except expat.error, e:
+        raise ParseError(e)
+
+
 class ParsedElement(object):
     """Representation of an XML element that was parsed from a string or
     file.
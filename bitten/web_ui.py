@@ -81,6 +81,17 @@ def _get_build_data(env, req, build):
     }
     return data
 
+def _count_builds(counts, config=None, platform=None, status=None):
+    """Sum up the build counts returned by `Build.count_grouped` that match
+    the given criteria."""
+    total = 0
+    for (b_config, b_platform, b_status), count in counts.iteritems():
+        if (config is None or b_config == config) and \
+                (platform is None or b_platform == platform) and \
+                (status is None or b_status == status):
+            total += count
+    return total
+
 def _has_permission(perm, repos, path, rev=None, raise_error=False):
     if hasattr(repos, 'authz'):
         if not repos.authz.has_permission(path):
@@ -217,6 +228,8 @@ class BuildConfigController(Component):
         assert repos, 'No "(default)" Repository: Add a repository or alias ' \
                       'named "(default)" to Trac.'
 
+        build_counts = Build.count_grouped(self.env)
+
         configs = []
         for config in BuildConfig.select(self.env, include_inactive=show_all):
             rev = config.max_rev or repos.youngest_rev
@@ -237,12 +250,12 @@ class BuildConfigController(Component):
             for platform in TargetPlatform.select(self.env, config=config.name):
                 pd = { 'name': platform.name,
                        'id': platform.id,
-                       'builds_pending': len(list(Build.select(self.env,
+                       'builds_pending': _count_builds(build_counts,
                                 config=config.name, status=Build.PENDING,
-                                platform=platform.id))),
-                       'builds_inprogress': len(list(Build.select(self.env,
+                                platform=platform.id),
+                       'builds_inprogress': _count_builds(build_counts,
                                 config=config.name, status=Build.IN_PROGRESS,
-                                platform=platform.id)))
+                                platform=platform.id)
                 }
                 platforms_data.append(pd)
 
@@ -250,12 +263,12 @@ class BuildConfigController(Component):
                 'name': config.name, 'label': config.label or config.name,
                 'active': config.active, 'path': config.path,
                 'description': description,
-                'builds_pending' : len(list(Build.select(self.env,
+                'builds_pending' : _count_builds(build_counts,
                                                 config=config.name,
-                                                status=Build.PENDING))),
-                'builds_inprogress' : len(list(Build.select(self.env,
+                                                status=Build.PENDING),
+                'builds_inprogress' : _count_builds(build_counts,
                                                 config=config.name,
-                                                status=Build.IN_PROGRESS))),
+                                                status=Build.IN_PROGRESS),
                 'href': req.href.build(config.name),
                 'builds': [],
                 'platforms': platforms_data
@@ -292,11 +305,10 @@ class BuildConfigController(Component):
         data['configs'] = sorted(configs, key=lambda x:x['label'].lower())
         data['page_mode'] = 'overview'
 
-        in_progress_builds = Build.select(self.env, status=Build.IN_PROGRESS)
-        pending_builds = Build.select(self.env, status=Build.PENDING)
-
-        data['builds_pending'] = len(list(pending_builds))
-        data['builds_inprogress'] = len(list(in_progress_builds))
+        data['builds_pending'] = _count_builds(build_counts,
+                                               status=Build.PENDING)
+        data['builds_inprogress'] = _count_builds(build_counts,
+                                                  status=Build.IN_PROGRESS)
 
         add_link(req, 'views', req.href.build(view='inprogress'),
                  'In Progress Builds')
@@ -330,8 +342,13 @@ class BuildConfigController(Component):
             if not config.active:
                 continue
 
-            in_progress_builds = Build.select(self.env, config=config.name,
-                                              status=Build.IN_PROGRESS, db=db)
+            in_progress_builds = list(Build.select(self.env,
+                                                   config=config.name,
+                                                   status=Build.IN_PROGRESS,
+                                                   db=db))
+            build_steps = BuildStep.select_many(self.env,
+                                [build.id for build in in_progress_builds],
+                                db=db)
 
             current_builds = 0
             builds = []
@@ -346,7 +363,7 @@ class BuildConfigController(Component):
                 build_data['platform'] = platform.name
                 build_data['steps'] = []
 
-                for step in BuildStep.select(self.env, build=build.id, db=db):
+                for step in build_steps[build.id]:
                     build_data['steps'].append({
                         'name': step.name,
                         'description': step.description,
@@ -405,10 +422,8 @@ class BuildConfigController(Component):
         if description:
             description = wiki_to_html(description, self.env, req)
 
-        pending_builds = list(Build.select(self.env,
-                                config=config.name, status=Build.PENDING))
-        inprogress_builds = list(Build.select(self.env,
-                                config=config.name, status=Build.IN_PROGRESS))
+        build_counts = Build.count_grouped(self.env, config=config.name,
+                                           db=db)
 
         data['config'] = {
             'name': config.name, 'label': config.label, 'path': config.path,
@@ -418,8 +433,10 @@ class BuildConfigController(Component):
             'max_rev_href': req.href.changeset(config.max_rev),
             'active': config.active, 'description': description,
             'browser_href': req.href.browser(config.path),
-            'builds_pending' : len(pending_builds),
-            'builds_inprogress' : len(inprogress_builds)
+            'builds_pending' : _count_builds(build_counts,
+                                             status=Build.PENDING),
+            'builds_inprogress' : _count_builds(build_counts,
+                                                status=Build.IN_PROGRESS)
         }
 
         context = Context.from_request(req, config.resource)
@@ -431,14 +448,12 @@ class BuildConfigController(Component):
         data['config']['platforms'] = [
             { 'name': platform.name,
               'id': platform.id,
-              'builds_pending': len(list(Build.select(self.env,
-                                                    config=config.name,
-                                                    status=Build.PENDING,
-                                                    platform=platform.id))),
-              'builds_inprogress': len(list(Build.select(self.env,
-                                                    config=config.name,
-                                                    status=Build.IN_PROGRESS,
-                                                    platform=platform.id)))
+              'builds_pending': _count_builds(build_counts,
+                                              platform=platform.id,
+                                              status=Build.PENDING),
+              'builds_inprogress': _count_builds(build_counts,
+                                                 platform=platform.id,
+                                                 status=Build.IN_PROGRESS)
               }
             for platform in platforms
         ]
@@ -471,36 +486,45 @@ class BuildConfigController(Component):
 
         builds_per_page = 12 * len(platforms)
         idx = 0
-        builds = {}
-        revisions = []
+        page_changes = []
         for platform, rev, build in collect_changes(repos, config):
             if idx >= page * builds_per_page:
                 more = True
                 break
             elif idx >= (page - 1) * builds_per_page:
-                if rev not in builds:
-                    revisions.append(rev)
-                builds.setdefault(rev, {})
-                builds[rev].setdefault('href', req.href.changeset(rev))
-                builds[rev].setdefault('display_rev', repos.normalize_rev(rev))
-                if build and build.status != Build.PENDING:
-                    build_data = _get_build_data(self.env, req, build)
-                    build_data['steps'] = []
-                    for step in BuildStep.select(self.env, build=build.id,
-                                                 db=db):
-                        build_data['steps'].append({
-                            'name': step.name,
-                            'description': step.description,
-                            'duration': to_datetime(step.stopped or int(time.time()), utc) - \
-                                        to_datetime(step.started, utc),
-                            'status': _step_status_label[step.status],
-                            'cls': _step_status_label[step.status].replace(' ', '-'),
-
-                            'errors': step.errors,
-                            'href': build_data['href'] + '#step_' + step.name
-                        })
-                    builds[rev][platform.id] = build_data
+                page_changes.append((platform, rev, build))
             idx += 1
+
+        # Load the steps of all builds shown on this page at once
+        build_steps = BuildStep.select_many(self.env,
+                            [build.id for platform, rev, build in page_changes
+                             if build and build.status != Build.PENDING],
+                            db=db)
+
+        builds = {}
+        revisions = []
+        for platform, rev, build in page_changes:
+            if rev not in builds:
+                revisions.append(rev)
+            builds.setdefault(rev, {})
+            builds[rev].setdefault('href', req.href.changeset(rev))
+            builds[rev].setdefault('display_rev', repos.normalize_rev(rev))
+            if build and build.status != Build.PENDING:
+                build_data = _get_build_data(self.env, req, build)
+                build_data['steps'] = []
+                for step in build_steps[build.id]:
+                    build_data['steps'].append({
+                        'name': step.name,
+                        'description': step.description,
+                        'duration': to_datetime(step.stopped or int(time.time()), utc) - \
+                                    to_datetime(step.started, utc),
+                        'status': _step_status_label[step.status],
+                        'cls': _step_status_label[step.status].replace(' ', '-'),
+
+                        'errors': step.errors,
+                        'href': build_data['href'] + '#step_' + step.name
+                    })
+                builds[rev][platform.id] = build_data
         data['config']['builds'] = builds
         data['config']['revisions'] = revisions
 
@@ -673,14 +697,17 @@ class BuildController(Component):
         event_kinds = {Build.SUCCESS: 'successbuild',
                        Build.FAILURE: 'failedbuild'}
 
-        for id_, config, label, path, rev, platform, stopped, status in cursor:
-            if not _has_permission(req.perm, repos, path, rev=rev):
-                continue
+        rows = [row for row in cursor.fetchall()
+                if _has_permission(req.perm, repos, row[3], rev=row[4])]
+        failed_steps = BuildStep.select_many(self.env,
+                                [row[0] for row in rows
+                                 if row[7] == Build.FAILURE],
+                                status=BuildStep.FAILURE, db=db)
+
+        for id_, config, label, path, rev, platform, stopped, status in rows:
             errors = []
             if status == Build.FAILURE:
-                for step in BuildStep.select(self.env, build=id_,
-                                             status=BuildStep.FAILURE,
-                                             db=db):
+                for step in failed_steps[id_]:
                     errors += [(step.name, error) for error
                                in step.errors]
             display_rev = repos.normalize_rev(rev)
@@ -749,6 +776,7 @@ class BuildController(Component):
         build.update()
 
         Attachment.delete_all(self.env, 'build', build.resource.id, db)
+        Build.delete_uploads(self.env, [build.id])
 
         db.commit()
 